@@ -5,10 +5,10 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
-from . import merge, patch, utils
+from . import compile, merge, patch, search, utils
 from .vis import make_visualization
 
-__all__ = ["utils", "merge", "patch", "make_visualization"]
+__all__ = ["utils", "merge", "patch", "compile", "search", "make_visualization"]
 
 
 
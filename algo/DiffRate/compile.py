@@ -0,0 +1,130 @@
+'''
+Compiles a searched DiffRate model into a static inference model.
+
+After the search only the kept token number of every layer matters: at inference the
+blocks slice and merge with block.prune_ddp.kept_token_number and
+block.merge_ddp.kept_token_number, while the DiffRate modules still carry their
+candidates and selected_probability parameters. compile_static replaces them by
+StaticRate modules holding the plain integers, so the state dict of the compiled model
+is the one of the unpatched timm / CLIP model, and the schedule itself is stored as a
+typed JSON / npz file instead of a python string.
+'''
+
+import json
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import torch.nn as nn
+
+from .ddp import DiffRate
+
+
+class StaticRate(nn.Module):
+    '''
+    Parameter-free stand-in of DiffRate with a fixed kept token number (class token included).
+    '''
+    def __init__(self, kept_token_number: int) -> None:
+        super().__init__()
+        self.kept_token_number = int(kept_token_number)
+
+    def update_kept_token_number(self):
+        raise RuntimeError("a compiled DiffRate model has a fixed schedule and only supports inference")
+
+    def get_token_mask(self, token_number=None):
+        raise RuntimeError("a compiled DiffRate model has a fixed schedule and only supports inference")
+
+    def extra_repr(self) -> str:
+        return f"kept_token_number={self.kept_token_number}"
+
+
+def _static(rate):
+    if isinstance(rate, DiffRate):
+        return StaticRate(rate.kept_token_number)
+    return rate
+
+
+def compile_static(model: nn.Module) -> nn.Module:
+    '''
+    Freezes the current kept token numbers of a DiffRate-patched model (deit, mae, aug, clip,
+    clip_hf, blip, ...) and removes the DiffRate modules with their architecture parameters.
+    The model is compiled in place, put in eval mode and returned.
+    '''
+    for module in list(model.modules()):
+        for name in ("prune_ddp", "merge_ddp"):
+            rate = getattr(module, name, None)
+            if isinstance(rate, list):
+                # clip_hf keeps one DiffRate per layer in a plain list
+                setattr(module, name, [_static(r) for r in rate])
+            elif isinstance(rate, DiffRate):
+                setattr(module, name, _static(rate))
+    return model.eval()
+
+
+def _check_schedule(prune_kept_num: List[int], merge_kept_num: List[int]) -> Tuple[List[int], List[int]]:
+    prune_kept_num = [int(n) for n in prune_kept_num]
+    merge_kept_num = [int(n) for n in merge_kept_num]
+    if len(prune_kept_num) != len(merge_kept_num):
+        raise ValueError(f"the schedule has {len(prune_kept_num)} prune and {len(merge_kept_num)} merge entries")
+    if min(prune_kept_num + merge_kept_num) < 1:
+        raise ValueError("every layer has to keep at least the class token")
+    return prune_kept_num, merge_kept_num
+
+
+def parse_kept_num(value: Union[str, List[int]]) -> List[int]:
+    '''
+    Reads a kept token list of compression_rate.json, either an int list or the legacy
+    "[197,196,...]" string.
+    '''
+    if isinstance(value, str):
+        value = json.loads(value)
+    return [int(n) for n in value]
+
+
+def save_schedule(
+    path: str, prune_kept_num: List[int], merge_kept_num: List[int], **meta
+) -> Dict:
+    '''
+    Writes a schedule as JSON (int lists) or, for a path ending in .npz, as int64 arrays.
+    meta (e.g. model="ViT-S-DeiT", flops=2.3) is stored alongside. Returns the schedule.
+    '''
+    prune_kept_num, merge_kept_num = _check_schedule(prune_kept_num, merge_kept_num)
+    schedule = {"prune_kept_num": prune_kept_num, "merge_kept_num": merge_kept_num, **meta}
+    if path.endswith(".npz"):
+        np.savez(
+            path,
+            prune_kept_num=np.asarray(prune_kept_num, dtype=np.int64),
+            merge_kept_num=np.asarray(merge_kept_num, dtype=np.int64),
+            meta=json.dumps(meta),
+        )
+    else:
+        with open(path, "w") as f:
+            json.dump(schedule, f, indent=4)
+    return schedule
+
+
+def load_schedule(path: str) -> Tuple[List[int], List[int]]:
+    '''
+    Reads a schedule written by save_schedule, returns (prune_kept_num, merge_kept_num).
+    '''
+    if path.endswith(".npz"):
+        with np.load(path) as f:
+            return _check_schedule(f["prune_kept_num"].tolist(), f["merge_kept_num"].tolist())
+    with open(path, "r") as f:
+        schedule = json.load(f)
+    return _check_schedule(schedule["prune_kept_num"], schedule["merge_kept_num"])
+
+
+def export_schedule(model: nn.Module, path: str, **meta) -> Dict:
+    '''
+    Writes the current kept token numbers of a DiffRate-patched model, see save_schedule.
+    '''
+    prune_kept_num, merge_kept_num = model.get_kept_num()
+    return save_schedule(path, prune_kept_num, merge_kept_num, **meta)
+
+
+def load_compiled(model: nn.Module, path: str) -> nn.Module:
+    '''
+    Sets the schedule at path on a DiffRate-patched model and compiles it, see compile_static.
+    '''
+    model.set_kept_num(*load_schedule(path))
+    return compile_static(model)
@@ -40,6 +40,12 @@ class DiffRate(nn.Module):
         kept_token_number = ste_ceil(torch.matmul(self.kept_token_candidate,self.selected_probability_softmax)) + self.class_token_num
         self.kept_token_number = int(kept_token_number)
         return kept_token_number
+
+    def __getstate__(self):
+        # the softmax is a non-leaf tensor, which deepcopy and pickle reject, it is recomputed on the next update
+        state = dict(super().__getstate__())
+        state["selected_probability_softmax"] = self.selected_probability_softmax.detach()
+        return state
         
     def get_token_probability(self):
         token_probability =  torch.zeros((self.patch_number+self.class_token_num), device=self.selected_probability_softmax.device) 
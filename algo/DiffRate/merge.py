@@ -1,6 +1,8 @@
 import math
 import torch
 
+from ..common.source import remap_source
+
 
 
 def get_merge_func(metric: torch.Tensor, kept_number: int, class_token: bool = True):
@@ -23,20 +25,44 @@ def get_merge_func(metric: torch.Tensor, kept_number: int, class_token: bool = T
             return torch.cat([dst, src], dim=1)
         else:
             return dst
-    return merge, node_max
+    return merge, node_max, node_idx
+
+
+def sort_source(source: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+    '''
+    input:
+        source: [B, N] group index of every initial token, -1 if pruned
+        idx: [B, N'] new order of the current tokens
+    '''
+    token_map = torch.empty_like(idx)
+    token_map.scatter_(1, idx, torch.arange(idx.shape[1], device=idx.device).expand_as(idx))
+    return remap_source(source, token_map)
+
+
+def prune_source(source: torch.Tensor, kept_number: int) -> torch.Tensor:
+    return torch.where(source < kept_number, source, -1)
+
+
+def merge_source(source: torch.Tensor, node_idx: torch.Tensor, kept_number: int) -> torch.Tensor:
+    '''
+    input:
+        source: [B, N] group index of every initial token, -1 if pruned
+        node_idx: [B, N'-kept_number] kept token every compressed token is merged into
+    '''
+    B = node_idx.shape[0]
+    kept = torch.arange(kept_number, device=node_idx.device).expand(B, -1)
+    return remap_source(source, torch.cat([kept, node_idx], dim=1))
+
 
 def uncompress(x, source):
     '''
     input: 
         x: [B, N', C]
-        source: [B, N', N]
-        size: [B, N', 1]
+        source: [B, N] group index of every initial token
     output:
         x: [B, N, C]
-        source: [B, N, N]
-        size: [B, N, 1]
     '''
-    index = source.argmax(dim=1)
+    index = source.clamp(min=0).long()
     # print(index)
     uncompressed_x = torch.gather(x, dim=1, index=index.unsqueeze(-1).expand(-1,-1,x.shape[-1]))
     return uncompressed_x
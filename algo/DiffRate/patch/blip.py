@@ -3,7 +3,8 @@ from typing import Tuple
 from lavis.models.vit import VisionTransformer, Attention, Block
 # import DiffRate.ddp as ddp
 from ..ddp import DiffRate
-from ..merge import get_merge_func
+from ..merge import get_merge_func, sort_source, prune_source, merge_source
+from ...common import rank_indices
 
 class DiffRateBlock(Block):
     """
@@ -29,7 +30,9 @@ class DiffRateBlock(Block):
         # importance metric
         cls_attn = attn[:, :, 0, 1:]
         cls_attn = cls_attn.mean(dim=1)  # [B, N-1]
-        _, idx = torch.sort(cls_attn, descending=True)
+        # training needs the full ranking for the token masks, inference only the tokens surviving pruning
+        kept = cls_attn.shape[-1] if self.training else self.prune_ddp.kept_token_number - 1
+        idx = rank_indices(cls_attn, kept)
         cls_index = torch.zeros((B,1), device=idx.device).long()
         idx = torch.cat((cls_index, idx+1), dim=1)
         
@@ -38,7 +41,7 @@ class DiffRateBlock(Block):
         self._diffrate_info["size"] = torch.gather(self._diffrate_info["size"], dim=1, index=idx.unsqueeze(-1))
         mask = torch.gather( mask, dim=1, index=idx)
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = torch.gather(self._diffrate_info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._diffrate_info["source"].shape[-1]))
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
 
         if self.training:
             # pruning, pruning only needs to generate masks during training
@@ -58,7 +61,7 @@ class DiffRateBlock(Block):
             if merge_kept_num < mid_token_number:
                 merge_mask = self.merge_ddp.get_token_mask(mid_token_number)
                 x_compressed, size_compressed = x[:, mid_token_number:], self._diffrate_info["size"][:,mid_token_number:]
-                merge_func, node_max = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=int(merge_kept_num))
+                merge_func, node_max, _ = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=int(merge_kept_num))
                 x = merge_func(x[:,:mid_token_number],  mode="mean", training=True)
                 # optimize proportional attention in ToMe by considering similarity
                 size = torch.cat((self._diffrate_info["size"][:, :int(merge_kept_num)],self._diffrate_info["size"][:, int(merge_kept_num):mid_token_number]*node_max[..., None]),dim=1)
@@ -78,19 +81,19 @@ class DiffRateBlock(Block):
             x = x[:, :prune_kept_num]
             self._diffrate_info["size"] = self._diffrate_info["size"][:, :prune_kept_num]
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = self._diffrate_info["source"][:, :prune_kept_num]
+                self._diffrate_info["source"] = prune_source(self._diffrate_info["source"], prune_kept_num)
                 
             
             # merging
             merge_kept_num = self.merge_ddp.kept_token_number
             if merge_kept_num < prune_kept_num:
-                merge,node_max = get_merge_func(x.detach(), kept_number=merge_kept_num)
+                merge, node_max, node_idx = get_merge_func(x.detach(), kept_number=merge_kept_num)
                 x = merge(x,mode='mean')
                 # optimize proportional attention in ToMe by considering similarity, this is benefit to the accuracy of off-the-shelf model.
                 self._diffrate_info["size"] = torch.cat((self._diffrate_info["size"][:, :merge_kept_num],self._diffrate_info["size"][:, merge_kept_num:]*node_max[..., None] ),dim=1)
                 self._diffrate_info["size"] = merge(self._diffrate_info["size"], mode='sum')
                 if self._diffrate_info["trace_source"]:
-                    self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="amax")
+                    self._diffrate_info["source"] = merge_source(self._diffrate_info["source"], node_idx, merge_kept_num)
 
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
@@ -169,7 +172,7 @@ def make_diffrate_class(transformer_class):
             self._diffrate_info["prune_kept_num"] = []
             self._diffrate_info["merge_kept_num"] = []
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=x.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
+                self._diffrate_info["source"] = torch.arange(self.patch_embed.num_patches+1, device=x.device, dtype=torch.int32)[None, ...].expand(B, -1)
             self.total_flop = 0
             x = self.patch_embed(x)
 
@@ -197,7 +200,7 @@ def make_diffrate_class(transformer_class):
             self._diffrate_info["prune_kept_num"] = []
             self._diffrate_info["merge_kept_num"] = []
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=x.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
+                self._diffrate_info["source"] = torch.arange(self.patch_embed.num_patches+1, device=x.device, dtype=torch.int32)[None, ...].expand(B, -1)
             self.total_flop = 0
 
             x = self.patch_embed(x)
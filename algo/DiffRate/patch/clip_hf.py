@@ -3,7 +3,8 @@ from transformers.modeling_outputs import BaseModelOutput
 from typing import Optional, Tuple, Union
 import torch
 from ..ddp import DiffRate
-from ..merge import get_merge_func
+from ..merge import get_merge_func, sort_source, prune_source, merge_source
+from ...common import rank_indices
 
 
 class DiffRateCLIPEncoder(CLIPEncoder):
@@ -25,25 +26,26 @@ class DiffRateCLIPEncoder(CLIPEncoder):
         size = self._diffrate_info["size"]
         mask = self._diffrate_info["mask"]
         cls_attn = attn[:, :, 0, 1:].mean(1)
-        _, idx = torch.sort(cls_attn, descending=True)
+        # only the tokens surviving pruning have to be ranked
+        idx = rank_indices(cls_attn, self.prune_ddp[i].kept_token_number - 1)
         cls_index = torch.zeros((B,1), device=idx.device).long()
         idx = torch.cat((cls_index, idx+1), dim=1)
         x = torch.gather(x, dim=1, index=idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = torch.gather(self._diffrate_info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._diffrate_info["source"].shape[-1]))
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
 
              # pruning
         prune_kept_num = self.prune_ddp[i].kept_token_number
         x = x[:, :prune_kept_num]
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = self._diffrate_info["source"][:, :prune_kept_num]
+            self._diffrate_info["source"] = prune_source(self._diffrate_info["source"], prune_kept_num)
         # merging
         merge_kept_num = self.merge_ddp[i].kept_token_number
         if merge_kept_num < prune_kept_num:
-            merge, _ = get_merge_func(x.detach(), kept_number=merge_kept_num)
+            merge, _, node_idx = get_merge_func(x.detach(), kept_number=merge_kept_num)
             x = merge(x,mode='mean')
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="amax")
+                self._diffrate_info["source"] = merge_source(self._diffrate_info["source"], node_idx, merge_kept_num)
         return x
 
     def forward(
@@ -91,7 +93,7 @@ class DiffRateCLIPEncoder(CLIPEncoder):
         self._diffrate_info["prune_kept_num"] = []
         self._diffrate_info["merge_kept_num"] = []
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=inputs_embeds.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
+            self._diffrate_info["source"] = torch.arange(self.patch_embed.num_patches+1, device=inputs_embeds.device, dtype=torch.int32)[None, ...].expand(B, -1)
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -14,7 +14,7 @@ def make_diffrate_class(transformer_class):
             self._diffrate_info["prune_kept_num"] = []
             self._diffrate_info["merge_kept_num"] = []
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=x.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
+                self._diffrate_info["source"] = torch.arange(self.patch_embed.num_patches+1, device=x.device, dtype=torch.int32)[None, ...].expand(B, -1)
             x = super().forward(x)
             if return_flop:
                 if self.training:
@@ -96,7 +96,7 @@ def make_diffrate_class(transformer_class):
         def calculate_flop_inference(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            N = torch.tensor(patch_number+1, device=self.cls_token.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
@@ -144,7 +144,7 @@ def make_diffrate_class(transformer_class):
         def calculate_flop_inference(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            N = torch.tensor(patch_number+1, device=self.cls_token.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
@@ -16,7 +16,8 @@ from timm.models.vision_transformer import Attention, Block, VisionTransformer
 import torch.nn as nn
 # import DiffRate.ddp as ddp
 from ..ddp import DiffRate
-from ..merge import get_merge_func
+from ..merge import get_merge_func, sort_source, prune_source, merge_source
+from ...common import rank_indices
 
 
 class DiffRateBlock(Block):
@@ -47,7 +48,9 @@ class DiffRateBlock(Block):
         # importance metric
         cls_attn = attn[:, :, 0, 1:]
         cls_attn = cls_attn.mean(dim=1)  # [B, N-1]
-        _, idx = torch.sort(cls_attn, descending=True)
+        # training needs the full ranking for the token masks, inference only the tokens surviving pruning
+        kept = cls_attn.shape[-1] if self.training else self.prune_ddp.kept_token_number - 1
+        idx = rank_indices(cls_attn, kept)
         cls_index = torch.zeros((B,1), device=idx.device).long()
         idx = torch.cat((cls_index, idx+1), dim=1)
         
@@ -56,7 +59,7 @@ class DiffRateBlock(Block):
         self._diffrate_info["size"] = torch.gather(self._diffrate_info["size"], dim=1, index=idx.unsqueeze(-1))
         mask = torch.gather( mask, dim=1, index=idx)
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = torch.gather(self._diffrate_info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._diffrate_info["source"].shape[-1]))
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
 
         
         if self.training:
@@ -76,7 +79,7 @@ class DiffRateBlock(Block):
             if merge_kept_num < mid_token_number:
                 merge_mask = self.merge_ddp.get_token_mask(mid_token_number)
                 x_compressed, size_compressed = x[:, mid_token_number:], self._diffrate_info["size"][:,mid_token_number:]
-                merge_func, node_max = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=int(merge_kept_num))
+                merge_func, node_max, _ = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=int(merge_kept_num))
                 x = merge_func(x[:,:mid_token_number],  mode="mean", training=True)
                 # optimize proportional attention in ToMe by considering similarity
                 size = torch.cat((self._diffrate_info["size"][:, :int(merge_kept_num)],self._diffrate_info["size"][:, int(merge_kept_num):mid_token_number]*node_max[..., None]),dim=1)
@@ -95,19 +98,19 @@ class DiffRateBlock(Block):
             x = x[:, :prune_kept_num]
             self._diffrate_info["size"] = self._diffrate_info["size"][:, :prune_kept_num]
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = self._diffrate_info["source"][:, :prune_kept_num]
+                self._diffrate_info["source"] = prune_source(self._diffrate_info["source"], prune_kept_num)
                 
             
             # merging
             merge_kept_num = self.merge_ddp.kept_token_number
             if merge_kept_num < prune_kept_num:
-                merge,node_max = get_merge_func(x.detach(), kept_number=merge_kept_num)
+                merge, node_max, node_idx = get_merge_func(x.detach(), kept_number=merge_kept_num)
                 x = merge(x,mode='mean')
                 # optimize proportional attention in ToMe by considering similarity, this is benefit to the accuracy of off-the-shelf model.
                 self._diffrate_info["size"] = torch.cat((self._diffrate_info["size"][:, :merge_kept_num],self._diffrate_info["size"][:, merge_kept_num:]*node_max[..., None] ),dim=1)
                 self._diffrate_info["size"] = merge(self._diffrate_info["size"], mode='sum')
                 if self._diffrate_info["trace_source"]:
-                    self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="amax")
+                    self._diffrate_info["source"] = merge_source(self._diffrate_info["source"], node_idx, merge_kept_num)
 
             x = x + self._drop_path2(self.mlp(self.norm2(x)))
         return x
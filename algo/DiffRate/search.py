@@ -0,0 +1,158 @@
+'''
+One-shot multi-budget DiffRate search.
+
+A DiffRate search trains the prune / merge selectors (DiffRate modules) of every block
+against one FLOPs target while the backbone stays frozen. MultiBudgetSearch keeps one set
+of selectors per target on the same backbone and swaps them into the blocks in turn, so one
+pass over the data searches every budget. The leading blocks without candidates (block 0
+of every patch) compress nothing and do not depend on the selectors: they run once per
+step and their output is replayed for the other selectors. The deeper blocks see the
+tokens kept by the current selector and run once per target.
+'''
+
+import copy
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import torch
+import torch.nn as nn
+
+
+_SHARED_INFO = ("size", "mask", "source", "prune_kept_num", "merge_kept_num")
+
+
+class MultiBudgetSearch:
+    '''
+    Selectors of a DiffRate-patched timm model (deit, mae, aug) for several FLOPs targets.
+    The selectors start from the ones of the model, the backbone parameters are frozen.
+    Only the selector parameters (arch_parameters) are trained, on a single process.
+    '''
+    def __init__(self, model: nn.Module, target_flops: List[float]) -> None:
+        self.model = model
+        self.target_flops = [float(t) for t in target_flops]
+        self.selectors = nn.ModuleList(
+            nn.ModuleList(
+                nn.ModuleDict({"prune": copy.deepcopy(block.prune_ddp), "merge": copy.deepcopy(block.merge_ddp)})
+                for block in model.blocks
+            )
+            for _ in self.target_flops
+        )
+        for p in model.parameters():    # the patched parameters() skips the selectors
+            p.requires_grad_(False)
+
+        self.num_shared = 0
+        for block in model.blocks:
+            if block.prune_ddp.kept_token_candidate.numel() > 1 or block.merge_ddp.kept_token_candidate.numel() > 1:
+                break
+            self.num_shared += 1
+        self.select(0)
+
+    def to(self, device) -> "MultiBudgetSearch":
+        self.model.to(device)
+        self.selectors.to(device)
+        return self
+
+    def arch_parameters(self) -> Iterator[nn.Parameter]:
+        return self.selectors.parameters()
+
+    def select(self, k: int):
+        '''
+        Puts the selectors of the k-th target into the blocks of the model.
+        '''
+        for block, selector in zip(self.model.blocks, self.selectors[k]):
+            block.prune_ddp = selector["prune"]
+            block.merge_ddp = selector["merge"]
+
+    def get_kept_num(self, k: int):
+        self.select(k)
+        return self.model.get_kept_num()
+
+    @contextmanager
+    def shared_prefix(self):
+        '''
+        Within the context, the first forward of the model runs the shared blocks without
+        gradient and caches their output with the info state, the following forwards (one
+        per selector, same input) skip them. Enter it once per batch.
+        '''
+        if self.num_shared == 0:
+            yield
+            return
+        blocks = self.model.blocks[:self.num_shared]
+        info = self.model._diffrate_info
+        cache = {}
+
+        def skip(x):
+            return x
+
+        def run_or_replay(x):
+            if cache:
+                for key, value in cache["info"].items():
+                    info[key] = list(value) if isinstance(value, list) else value
+                return cache["x"]
+            with torch.no_grad():
+                for block in blocks:
+                    x = type(block).forward(block, x)
+            cache["x"] = x
+            cache["info"] = {key: copy.copy(info.get(key)) for key in _SHARED_INFO}
+            return x
+
+        for block in blocks[:-1]:
+            block.forward = skip
+        blocks[-1].forward = run_or_replay
+        try:
+            yield
+        finally:
+            for block in blocks:
+                del block.forward
+
+    def state_dict(self) -> Dict:
+        return {"target_flops": self.target_flops, "selectors": self.selectors.state_dict()}
+
+    def load_state_dict(self, state_dict: Dict):
+        self.selectors.load_state_dict(state_dict["selectors"])
+        for selectors in self.selectors:
+            for selector in selectors:
+                selector["prune"].update_kept_token_number()
+                selector["merge"].update_kept_token_number()
+
+
+def pareto_front(rows: List[Dict]) -> List[Dict]:
+    '''
+    Keeps the rows ({"flops": ..., "acc1": ...}) no other row beats in both FLOPs and
+    accuracy, sorted by FLOPs.
+    '''
+    front = []
+    for row in rows:
+        dominated = any(
+            other["flops"] <= row["flops"] and other["acc1"] >= row["acc1"]
+            and (other["flops"] < row["flops"] or other["acc1"] > row["acc1"])
+            for other in rows
+        )
+        if not dominated:
+            front.append(row)
+    return sorted(front, key=lambda row: row["flops"])
+
+
+def write_compression_rate(path: str, model_name: str, rows: List[Dict]) -> Dict:
+    '''
+    Writes the schedules of rows ({"target_flops", "flops", "acc1", "prune_kept_num",
+    "merge_kept_num"}) into the compression_rate.json at path under model_name, keyed by
+    target FLOPs like the hand-filled entries. Other models and targets are kept.
+    '''
+    compression_rate = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            compression_rate = json.load(f)
+    entries = compression_rate.setdefault(model_name, {})
+    for row in rows:
+        entries[str(float(row["target_flops"]))] = {
+            "prune_kept_num": [int(n) for n in row["prune_kept_num"]],
+            "merge_kept_num": [int(n) for n in row["merge_kept_num"]],
+            "flops": round(float(row["flops"]), 4),
+            "acc1": round(float(row["acc1"]), 3),
+        }
+    with open(path, "w") as f:
+        json.dump(compression_rate, f, indent=4)
+    return compression_rate
@@ -0,0 +1,14 @@
+# --------------------------------------------------------
+# Helpers shared by the token reduction algorithms.
+# --------------------------------------------------------
+
+from . import attention, context, select, source
+from .attention import cls_attention, size_bias
+from .context import ThreadLocalInfo, thread_local_info
+from .select import complement_indices, rank_indices, stable_ranking
+from .source import remap_source, source_to_dense
+
+__all__ = [
+    "attention", "context", "select", "source", "cls_attention", "size_bias", "ThreadLocalInfo", "thread_local_info",
+    "complement_indices", "rank_indices", "stable_ranking", "remap_source", "source_to_dense",
+]
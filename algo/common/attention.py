@@ -0,0 +1,95 @@
+# --------------------------------------------------------
+# Attention without the N x N probability tensor.
+#
+# The patched attention modules only need the attention output and the keys
+# (for the merge metric). The full softmax(q @ k.T) is needed only by the
+# attention-based selectors, and those only read the class token row. The
+# output therefore goes through torch's scaled_dot_product_attention (flash /
+# memory-efficient kernels where available) with the proportional-attention
+# log-size as an additive bias, and the class token row is recomputed on its
+# own when a selector asks for it.
+# --------------------------------------------------------
+
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def size_bias(size: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    """
+    Turns the token sizes [B, N, 1] of proportional attention into an additive key bias [B, 1, 1, N].
+    """
+    if size is None:
+        return None
+    return size.log()[:, None, None, :, 0]
+
+
+def add_bias(bias: Optional[torch.Tensor], other: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    if bias is None:
+        return other
+    if other is None:
+        return bias
+    return bias + other
+
+
+def attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    scale: Optional[float] = None,
+    dropout_p: float = 0.0,
+    need_weights: bool = False,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    softmax(q @ k.T * scale + bias) @ v for q, k, v of shape [B, H, N, D].
+
+    Args:
+     - bias: additive bias broadcastable to [B, H, N, N], e.g. size_bias(size)
+     - scale: defaults to D ** -0.5
+     - dropout_p: dropout on the attention probabilities, pass 0 in eval mode
+     - need_weights: also return the full [B, H, N, N] probabilities (after dropout, as applied
+       to v). This falls back to the explicit computation, so only use it when the whole matrix
+       is really needed.
+
+    Returns (out [B, H, N, D], weights or None).
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+
+    if need_weights:
+        attn = (q @ k.transpose(-2, -1)) * scale
+        if bias is not None:
+            attn = attn + bias
+        attn = attn.softmax(dim=-1)
+        attn = F.dropout(attn, p=dropout_p)
+        return attn @ v, attn
+
+    if bias is not None:
+        # sdpa wants a mask with the query dimension present and the dtype of q
+        bias = bias.to(q.dtype).expand(q.shape[0], -1, q.shape[2], -1)
+    # the scale argument of sdpa needs torch >= 2.1, fold it into q against the default D ** -0.5
+    q = q * (scale * q.shape[-1] ** 0.5)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p)
+    return out, None
+
+
+def cls_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    scale: Optional[float] = None,
+) -> torch.Tensor:
+    """
+    Attention probabilities of the class token (query 0) only, shape [B, H, 1, N].
+
+    Drop-in for the full matrix wherever only attn[:, :, 0] is read, at O(N) instead of O(N^2).
+    """
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    attn = (q[:, :, :1] @ k.transpose(-2, -1)) * scale
+    if bias is not None:
+        attn = attn + bias[..., :1, :]
+    return attn.softmax(dim=-1)
+
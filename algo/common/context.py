@@ -0,0 +1,92 @@
+# --------------------------------------------------------
+# Per-thread merge state.
+#
+# The patches keep the state of a forward pass (ratio schedule, token size,
+# sources, ...) in one info dict that the model and all its patched modules
+# share. The forward passes write to it, so two threads running the same
+# patched model (an inference server, nn.DataParallel replicas) would read
+# each other's state. ThreadLocalInfo keeps the dict interface and gives every
+# thread its own copy, the weights stay shared.
+#
+# torch.compile cannot trace the threading.local lookup, so while a forward
+# pass is being compiled every thread works on one shared dict instead.
+# --------------------------------------------------------
+
+import copy
+import threading
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator
+
+import torch
+import torch.nn as nn
+
+
+def is_compiling() -> bool:
+    """
+    True while torch.compile traces the current code, for torch 2.0 (torch._dynamo) and later.
+    """
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and hasattr(compiler, "is_compiling"):
+        return compiler.is_compiling()
+    dynamo = getattr(torch, "_dynamo", None)
+    return dynamo is not None and dynamo.is_compiling()
+
+
+class ThreadLocalInfo(MutableMapping):
+    """
+    Info dict with one copy per thread. Every thread starts from a copy of defaults, the
+    settings of apply_patch. Writes only reach the current thread, change a setting for
+    all threads with info.defaults[key] = value. Code compiled with torch.compile uses one
+    dict shared by all threads.
+    """
+
+    def __init__(self, defaults: Dict[str, Any]):
+        self.defaults = dict(defaults)
+        self._local = threading.local()
+        self._compiled = copy.deepcopy(self.defaults)
+
+    @property
+    def _info(self) -> Dict[str, Any]:
+        if is_compiling():
+            return self._compiled
+        info = getattr(self._local, "info", None)
+        if info is None:
+            info = self._local.info = copy.deepcopy(self.defaults)
+        return info
+
+    def __getitem__(self, key: str) -> Any:
+        return self._info[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self._info[key] = value
+
+    def __delitem__(self, key: str):
+        del self._info[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._info)
+
+    def __len__(self) -> int:
+        return len(self._info)
+
+    def __reduce__(self):
+        # copies and pickles (e.g. copy.deepcopy of a patched model) start from the settings
+        return self.__class__, (self.defaults,)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self._info!r})"
+
+
+def thread_local_info(model: nn.Module, name: str = "_tome_info") -> ThreadLocalInfo:
+    """
+    Replaces the info dict called name of model, and of every module sharing it, with a
+    ThreadLocalInfo. Called at the end of apply_patch, once the settings are in the dict.
+    """
+    info = getattr(model, name)
+    if isinstance(info, ThreadLocalInfo):
+        return info
+    local = ThreadLocalInfo(info)
+    for module in model.modules():
+        if module.__dict__.get(name) is info:
+            setattr(module, name, local)
+    return local
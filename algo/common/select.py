@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# Partial top-k selection.
+#
+# Every reduction step only needs to know which k tokens are merged / kept
+# first, the order of the remaining tokens is irrelevant as long as it is
+# deterministic. A full argsort over the token axis is therefore replaced by
+# torch.topk on the k entries plus an O(T) complement that keeps the remaining
+# tokens in their original position order (so a class token at index 0 stays
+# at the start without an extra sort).
+#
+# torch.topk does not order equal scores, so two backends may rank tied tokens
+# differently. Under stable_ranking (used for export) the ranking breaks ties
+# by the lower index and only uses elementwise comparisons, which TorchScript,
+# ONNX and eager evaluate the same way.
+# --------------------------------------------------------
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import torch
+
+
+_ranking = threading.local()
+
+
+@contextmanager
+def stable_ranking(enabled: bool = True) -> Iterator[None]:
+    """
+    Within the context rank_indices orders equal scores by their index (lower first). The
+    ranking then costs O(T^2) comparisons per row instead of a top-k.
+    """
+    previous = getattr(_ranking, "stable", False)
+    _ranking.stable = enabled
+    try:
+        yield
+    finally:
+        _ranking.stable = previous
+
+
+def stable_order(scores: torch.Tensor, descending: bool = True) -> torch.Tensor:
+    """
+    Same as scores.argsort(dim=-1, descending=descending, stable=True), computed by counting
+    for every entry the entries ranked before it.
+    """
+    t = scores.shape[-1]
+    s_i, s_j = scores[..., :, None], scores[..., None, :]
+    index = torch.arange(t, device=scores.device)
+    before = s_j > s_i if descending else s_j < s_i
+    before = before | ((s_j == s_i) & (index[None, :] < index[:, None]))
+    rank = before.long().sum(dim=-1)
+    return torch.empty_like(rank).scatter_(-1, rank, index.expand_as(rank))
+
+
+def complement_indices(idx: torch.Tensor, num_tokens: int) -> torch.Tensor:
+    """
+    Returns the indices in [0, num_tokens) that are not in idx, in increasing order.
+
+    idx is [..., k] with unique entries per row, the output is [..., num_tokens - k].
+    Works without a host sync (no nonzero / boolean indexing).
+    """
+    k = idx.shape[-1]
+    keep = torch.ones(*idx.shape[:-1], num_tokens, dtype=torch.bool, device=idx.device)
+    keep.scatter_(-1, idx, torch.zeros_like(idx, dtype=torch.bool))
+
+    # position of every kept token in the output, dropped ones go to a spare slot
+    pos = keep.to(idx.dtype).cumsum(dim=-1) - 1
+    pos = torch.where(keep, pos, torch.full_like(pos, num_tokens - k))
+
+    arange = torch.arange(num_tokens, device=idx.device, dtype=idx.dtype).expand_as(pos)
+    out = idx.new_empty(*idx.shape[:-1], num_tokens - k + 1)
+    out.scatter_(-1, pos, arange)
+    return out[..., :-1]
+
+
+def rank_indices(scores: torch.Tensor, k: int, descending: bool = True, sorted: bool = True) -> torch.Tensor:
+    """
+    Drop-in replacement for scores.argsort(dim=-1, descending=descending) when only
+    the first k entries need to be ranked.
+
+    The first k indices are the top-k of scores (ranked if sorted=True), the
+    remaining ones follow in increasing index order. Under stable_ranking equal scores are
+    ranked by their index.
+    """
+    t = scores.shape[-1]
+    k = max(0, min(k, t))
+    if getattr(_ranking, "stable", False):
+        order = stable_order(scores, descending)
+        if k == t:
+            return order
+        return torch.cat([order[..., :k], complement_indices(order[..., :k], t)], dim=-1)
+    if k == t:
+        return scores.argsort(dim=-1, descending=descending)
+
+    top = scores.topk(k, dim=-1, largest=descending, sorted=sorted).indices
+    return torch.cat([top, complement_indices(top, t)], dim=-1)
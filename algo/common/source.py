@@ -0,0 +1,65 @@
+# --------------------------------------------------------
+# Token source tracking as group ids.
+#
+# A source is an int32 [B, T0] tensor holding, for each of the initial tokens,
+# the index of the merged group it currently belongs to (-1 once pruned),
+# instead of the [B, T, T0] adjacency matrix between the current and the
+# initial tokens. A merge only has to say where each of its input tokens goes
+# (a token map), so tracing costs O(B*T0) memory. source_to_dense rebuilds the
+# adjacency matrix on demand, e.g. for visualization.
+# --------------------------------------------------------
+
+from typing import Callable
+
+import torch
+
+
+def initial_source(x: torch.Tensor) -> torch.Tensor:
+    """
+    Source of the tokens of x [B, T, C] before any merge: every token is its own group.
+    """
+    n, t, _ = x.shape
+    return torch.arange(t, device=x.device, dtype=torch.int32)[None, ...].expand(n, t)
+
+
+def unmerge_token_map(merge: Callable, unmerge: Callable, x: torch.Tensor) -> torch.Tensor:
+    """
+    Token map [B, T] of a merge with an unmerge function (ToMe style): the merged token ids
+    are broadcast back to the tokens they come from.
+    """
+    n = x.shape[0]
+    t_new = merge(x[..., :1], mode="amax").shape[1]
+    ids = torch.arange(t_new, device=x.device, dtype=torch.float32)[None, :, None].expand(n, t_new, 1)
+    return unmerge(ids)[..., 0].long()
+
+
+def one_hot_token_map(merge: Callable, x: torch.Tensor, mode: str = "amax") -> torch.Tensor:
+    """
+    Token map [B, T] of any merge function, by merging the one-hot assignment of the current
+    tokens. Costs O(B*T^2) for this layer only. Tokens that no output comes from map to -1.
+    """
+    n, t, _ = x.shape
+    assign = merge(torch.eye(t, device=x.device)[None, ...].expand(n, t, t), mode=mode)
+    kept, token_map = assign.max(dim=1)
+    token_map[kept == 0] = -1
+    return token_map
+
+
+def remap_source(source: torch.Tensor, token_map: torch.Tensor) -> torch.Tensor:
+    """
+    Composes a source [B, T0] with the token map [B, T] of the next merge, which gives the new
+    position (or -1) of each of the T current tokens. Pruned tokens stay at -1.
+    """
+    token_map = token_map.to(torch.int32)
+    return torch.where(source >= 0, token_map.gather(1, source.clamp(min=0).long()), source)
+
+
+def source_to_dense(source: torch.Tensor, num_groups: int = None) -> torch.Tensor:
+    """
+    Converts group-id source tracking of shape [B, T0] to the [B, num_groups, T0] adjacency
+    matrix between the final merged groups and the initial tokens.
+    """
+    if num_groups is None:
+        num_groups = int(source.max().item()) + 1
+    groups = torch.arange(num_groups, device=source.device, dtype=source.dtype)
+    return (source[:, None, :] == groups[None, :, None]).float()
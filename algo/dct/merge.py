@@ -73,26 +73,46 @@ def idct(X, norm=None):
 
 
 
+_BASES = {}
+
+
+def dct_basis(num_tokens: int, kept: int, dtype: torch.dtype = torch.float32, device=None) -> torch.Tensor:
+    """
+    The [kept, num_tokens] matrix of dc_transform: an orthonormal DCT-II over num_tokens
+    positions, truncated to the kept lowest frequencies, followed by the orthonormal
+    inverse DCT over kept positions. Built once in float64 per (num_tokens, kept, dtype, device).
+    """
+    key = (num_tokens, kept, dtype, str(device))
+    if key not in _BASES:
+        def ortho_dct(n, rows):
+            # D[k, i] = sqrt(2 / n) * cos(pi * (2i + 1) * k / (2n)), row 0 scaled by 1 / sqrt(2)
+            k = torch.arange(rows, dtype=torch.float64)[:, None]
+            i = torch.arange(n, dtype=torch.float64)[None, :]
+            basis = torch.cos(math.pi * (2 * i + 1) * k / (2 * n)) * math.sqrt(2 / n)
+            basis[0] /= math.sqrt(2)
+            return basis
+
+        basis = ortho_dct(kept, kept).t() @ ortho_dct(num_tokens, kept)
+        _BASES[key] = basis.to(dtype=dtype, device=device)
+    return _BASES[key]
+
+
 def dc_transform(x, ratio:float=None, k:int=None, class_token:bool=True ):
+    """
+    Compresses x [B, T, C] to its low frequencies along the token axis: the DCT-II of the
+    tokens is truncated to ceil(T * ratio) (or T - k) coefficients and transformed back over
+    that many positions. Both steps are linear, so this is one matmul with the cached
+    dct_basis, in the dtype of x.
+    """
     if class_token:
-        x_cls = x[:,0,:].unsqueeze_(1)
-        x = x[:,1:,:]
-    x = x.type(torch.float32).permute(1,0,2)
-    x_dct = dct(x.transpose(0,2), norm='ortho').transpose(0,2)
-    T, B, C = x_dct.size()
-
-    # feel free to play with any method here
-    if ratio is not None: 
-        x_dct = x_dct[:math.ceil(T * ratio), :, :]
-    else:
-        x_dct = x_dct[:T-k, :, :]
-
-    x = idct(x_dct.transpose(0,2), norm='ortho').transpose(0,2).type(torch.half).permute(1,0,2)
-    
+        x_cls = x[:, :1]
+        x = x[:, 1:]
+    T = x.shape[1]
+    kept = math.ceil(T * ratio) if ratio is not None else T - k
+
+    if kept < T:
+        x = torch.matmul(dct_basis(T, kept, x.dtype, x.device), x)
+
     if class_token:
         return torch.cat([x_cls, x], dim=1)
     return x
-    
-
-
-
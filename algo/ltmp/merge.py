@@ -10,6 +10,8 @@ from typing import Callable, Tuple
 import torch
 import torch.nn.functional as F
 
+from ..common import rank_indices
+
 
 def do_nothing(x, mode=None):
     return x
@@ -47,15 +49,12 @@ def bipartite_soft_matching(
             scores[..., 0, :] = -math.inf
 
         node_max, node_idx = scores.max(dim=-1)
-        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        edge_idx = rank_indices(node_max, r)[..., None]
 
-        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
+        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens, in position order so the class token stays first
         src_idx = edge_idx[..., :r, :]  # Merged Tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
 
-        if class_token:
-            unm_idx = unm_idx.sort(dim=1)[0]
-
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         src, dst = x[..., ::2, :], x[..., 1::2, :]
         n, t1, c = src.shape
@@ -4,7 +4,7 @@ import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 from copy import copy
 
-from .timm import ToMeBlock, ToMeBlockUsingRatio, ToMeAttention 
+from .timm import LTPMBlock, LTPMAttention 
 
 def make_tome_class(transformer_class):
     class ToMeVisionTransformer(transformer_class):
@@ -97,7 +97,7 @@ def apply_patch(
     for module in model.modules():
 
         if isinstance(module, Block):
-            module.__class__ = ToMeBlock if use_k  else ToMeBlockUsingRatio
+            module.__class__ = LTPMBlock
             module._tome_info = model._tome_info
         elif isinstance(module, Attention):
-            module.__class__ = ToMeAttention
+            module.__class__ = LTPMAttention
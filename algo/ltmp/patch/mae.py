@@ -14,7 +14,7 @@ import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 
 
-from .timm import ToMeAttention, ToMeBlockUsingRatio, ToMeBlock
+from .timm import LTPMAttention, LTPMBlock
 
 
 def make_tome_class(transformer_class):
@@ -129,8 +129,8 @@ def apply_patch(
 
     for module in model.modules():
         if isinstance(module, Block):
-            module.__class__ = ToMeBlockUsingRatio if not use_k else ToMeBlock
+            module.__class__ = LTPMBlock
             # module.__class__ = ToMeBlock if compress_method == 'tome' else PiToMeBlock 
             module._tome_info = model._tome_info
         elif isinstance(module, Attention):
-            module.__class__ = ToMeAttention
\ No newline at end of file
+            module.__class__ = LTPMAttention
\ No newline at end of file
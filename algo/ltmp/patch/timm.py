@@ -7,10 +7,24 @@ from timm.layers import DropPath, Mlp
 from timm.models.registry import register_model
 from timm.models.vision_transformer import Attention, LayerScale, VisionTransformer
 
-from .threshold_masking import ThresholdMasker, softmax_with_mask
+from ...common.attention import attention
+from .threshold_masking import InferenceThresholdMasker, ThresholdMasker, softmax_with_mask
 from .utils import create_vision_transformer
 
 
+def compact(x, size, mask):
+    """
+    Moves the kept tokens (mask [B, N] True) of every sample to the front, in their order, and
+    cuts x, size and mask to the longest sample. The shorter samples are padded with masked tokens.
+    """
+    order = torch.sort((~mask).int(), dim=1, stable=True).indices
+    order = order[:, : int(mask.sum(1).max())]
+    x = x.gather(1, order[..., None].expand(-1, -1, x.shape[-1]))
+    size = size.gather(1, order[..., None])
+    mask = mask.gather(1, order)
+    return x, size, mask
+
+
 class LTPMBlock(nn.Module):
     def __init__(
         self,
@@ -99,6 +113,45 @@ class LTPMBlock(nn.Module):
         x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x))))
         return x, size, mask, viz
 
+    def forward_compact(self, x, size, mask):
+        """
+        Inference version of forward that removes the pruned and merged tokens instead of
+        masking them. mask [B, N] is a bool tensor that is only False on the padding of the
+        samples that kept fewer tokens. The maskers have to be InferenceThresholdMasker
+        (see compact_inference).
+        """
+        c = x.shape[-1]
+        x_attn, metric, importance_scores = self.attn.forward_compact(self.norm1(x), size, mask)
+        mask = mask & self.prune_masker(importance_scores)
+
+        x = x + self.drop_path1(self.ls1((x_attn)))
+
+        x = x * size
+        src_x, dst_x = x[..., ::2, :], x[..., 1::2, :]
+        src_s, dst_s = size[..., ::2, :], size[..., 1::2, :]
+        src_m, dst_m = mask[..., ::2], mask[..., 1::2]
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+        scores = scores.masked_fill(~dst_m[:, None, :], -math.inf)
+
+        scores[..., 0, :] = -math.inf
+
+        node_max, node_idx = scores.max(dim=-1)
+        merge_mask = self.merge_masker(node_max) & src_m
+        merge_x = src_x * merge_mask[..., None]
+        merge_s = src_s * merge_mask[..., None]
+        dst_x = dst_x.scatter_reduce(1, node_idx.unsqueeze(-1).expand(node_idx.shape + (c,)), merge_x, reduce="sum")
+        dst_s = dst_s.scatter_reduce(1, node_idx.unsqueeze(-1), merge_s, reduce="sum")
+        x = torch.cat([src_x, dst_x], dim=1)
+        size = torch.cat([src_s, dst_s], dim=1)
+        mask = torch.cat([src_m & ~merge_mask, dst_m], dim=1)
+        x, size, mask = compact(x / size, size, mask)
+
+        x = x + self.drop_path2(self.ls2(self.mlp(self.norm2(x))))
+        return x, size, mask
+
 
 class LTPMAttention(Attention):
     def forward(self, x, size, mask) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -131,12 +184,34 @@ class LTPMAttention(Attention):
 
         return x, similarity_scores, importance_scores
 
+    def forward_compact(self, x, size, mask) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
+        q, k = self.q_norm(q), self.k_norm(k)
+
+        # Apply proportional attention, the padding is neither attended to nor a query of the scores
+        bias = size[:, None, None, :, 0].log().masked_fill(~mask[:, None, None, :], -math.inf)
+        x, attn = attention(q, k, v, bias=bias, scale=self.scale, need_weights=True)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+
+        # Calculate importance scores, mean attention over the heads and the real queries
+        queries = mask[:, None, :, None].to(attn.dtype)
+        importance_scores = (attn * queries).sum(dim=(1, 2)) / (queries.sum(dim=(1, 2)) * self.num_heads)
+        importance_scores[..., 0] = math.inf
+
+        return x, k.mean(1), importance_scores
+
 
 class LTPMVisionTransformer(VisionTransformer):
     def __init__(self, tau=0.1, **kwargs):
         super().__init__(**kwargs)
         self.masks = []
         self.vizs = []
+        self.compact = False
+        self.token_counts = []
         for block in self.blocks:
             block.merge_masker.tau = tau
 
@@ -145,6 +220,15 @@ class LTPMVisionTransformer(VisionTransformer):
         x = self._pos_embed(x)
         x = self.norm_pre(x)
         b, t, _ = x.shape
+        if self.compact and not self.training:
+            s = torch.ones_like(x[..., 0, None])
+            m = torch.ones_like(x[..., 0], dtype=torch.bool)
+            self.token_counts = []
+            for block in self.blocks:
+                x, s, m = block.forward_compact(x, s, m)
+                self.token_counts.append(m.sum(1))
+            x = self.norm(x)
+            return x
         self.masks = []
         self.vizs = []
         s = torch.ones_like(x[..., 0, None])
@@ -158,6 +242,19 @@ class LTPMVisionTransformer(VisionTransformer):
         return x
 
 
+def compact_inference(model: LTPMVisionTransformer, enabled: bool = True):
+    """
+    Switches an LTPM model to (or back from) the compacting inference path: the learned
+    thresholds become hard InferenceThresholdMasker decisions and, in eval mode, the pruned
+    and merged tokens are gathered out after every block, so the later blocks run on fewer
+    tokens. model.token_counts then holds the [B] number of tokens kept after every block.
+    """
+    for block in model.blocks:
+        for masker in (block.merge_masker, block.prune_masker):
+            masker.__class__ = InferenceThresholdMasker if enabled else ThresholdMasker
+    model.compact = enabled
+
+
 # VIT
 @register_model
 def ltpm_vit_base_patch16_224(pretrained=False, **kwargs):
@@ -12,7 +12,10 @@ from timm.data.transforms_factory import create_transform
 from timm.models.helpers import build_model_with_cfg, resolve_pretrained_cfg
 from timm.models.vision_transformer import checkpoint_filter_fn
 
-import wandb
+try:
+    import wandb
+except ImportError:
+    pass  # Don't fail if wandb is not installed. It's only necessary for update_summary(log_wandb=True).
 
 
 def create_vision_transformer(transformer_class, variant, pretrained=False, **kwargs):
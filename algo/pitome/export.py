@@ -0,0 +1,135 @@
+# --------------------------------------------------------
+# TorchScript / ONNX export of PiToMe-patched models.
+#
+# At a fixed merge schedule and input shape every merge removes a known number
+# of tokens, so a patched forward is a fixed graph: topk for the ranking and
+# gather / scatter for the merge (MergePlan), with the token count of every
+# layer turned into a constant by the tracer. The export therefore traces the
+# patched model as it is, only in the settings that keep the shapes static,
+# with ties in the token ranking broken by index so that the exported graph
+# merges the same tokens as the eager model.
+# --------------------------------------------------------
+
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+from ..common.select import stable_ranking
+
+
+def _infos(model: nn.Module) -> List:
+    infos = []
+    for module in model.modules():
+        for name in ("_tome_info", "_pitome_info"):
+            info = module.__dict__.get(name)
+            if info is not None and all(info is not other for other in infos):
+                infos.append(info)
+    return infos
+
+
+@contextmanager
+def export_mode(model: nn.Module) -> Iterator[nn.Module]:
+    """
+    Puts a patched model in eval mode with static token counts, and restores it afterwards:
+    - BERT merges with pitome_text at a fixed ratio instead of the padded varlen merge,
+      whose output length depends on the attention mask.
+    - No token sources are traced.
+    - Equal energy / similarity scores are ranked by token index (stable_ranking), so the
+      eager model in this context and the exported graph pick the same tokens.
+    """
+    training = model.training
+    saved = []
+    for info in _infos(model):
+        for key, value in (("varlen", False), ("trace_source", False)):
+            if key in info:
+                saved.append((info, key, info[key]))
+                info[key] = value
+    model.eval()
+    try:
+        with stable_ranking():
+            yield model
+    finally:
+        for info, key, value in saved:
+            info[key] = value
+        model.train(training)
+
+
+class ExportWrapper(nn.Module):
+    """
+    Calls a patched model with fixed keyword arguments (e.g. return_flop=False for the timm
+    patches) and returns its main output tensor: the logits, the last hidden state or the
+    first element of a tuple.
+    """
+
+    def __init__(self, model: nn.Module, **kwargs):
+        super().__init__()
+        self.model = model
+        self.kwargs = kwargs
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        out = self.model(*inputs, **self.kwargs)
+        if hasattr(out, "logits"):
+            return out.logits
+        if hasattr(out, "last_hidden_state"):
+            return out.last_hidden_state
+        if isinstance(out, (tuple, list)):
+            return out[0]
+        return out
+
+
+def _as_tuple(inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]]) -> Tuple[torch.Tensor, ...]:
+    return inputs if isinstance(inputs, tuple) else (inputs,)
+
+
+def trace(
+    model: nn.Module, example_inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]], **kwargs
+) -> torch.jit.ScriptModule:
+    """
+    TorchScript trace of a patched model at its current ratio / schedule. The traced module
+    only accepts inputs of the shape of example_inputs.
+
+    kwargs are passed to the model on every call, e.g. trace(deit, x, return_flop=False).
+    """
+    with export_mode(model):
+        with torch.no_grad():
+            return torch.jit.trace(ExportWrapper(model, **kwargs), _as_tuple(example_inputs))
+
+
+def export_onnx(
+    model: nn.Module,
+    example_inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    path: str,
+    input_names: List[str] = None,
+    opset_version: int = 18,
+    dynamic_batch: bool = False,
+    **kwargs,
+) -> str:
+    """
+    Exports a patched model at its current ratio / schedule to ONNX. Opset 18 is needed
+    for the max reduction of ScatterElements (merged attention masks), the mean merges are
+    written as a sum over a count. The token axis is always static, dynamic_batch only frees
+    the batch axis.
+
+    kwargs are passed to the model on every call, e.g. export_onnx(deit, x, "deit.onnx", return_flop=False).
+    """
+    example_inputs = _as_tuple(example_inputs)
+    if input_names is None:
+        input_names = [f"input_{i}" for i in range(len(example_inputs))]
+    dynamic_axes = None
+    if dynamic_batch:
+        dynamic_axes = {name: {0: "batch"} for name in input_names + ["output"]}
+
+    with export_mode(model):
+        with torch.no_grad():
+            torch.onnx.export(
+                ExportWrapper(model, **kwargs),
+                example_inputs,
+                path,
+                input_names=input_names,
+                output_names=["output"],
+                opset_version=opset_version,
+                dynamic_axes=dynamic_axes,
+            )
+    return path
@@ -12,10 +12,266 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
+from ..common import rank_indices
+from ..common.source import initial_source, one_hot_token_map, remap_source
+
 
 def do_nothing(x, mode=None):
     return x
 
+
+class Workspace:
+    """
+    Reusable index tensors and scratch buffers for merging batches of a fixed shape.
+    Index tensors are created once per arguments and buffers only grow, so repeated
+    inference at the same (B, T) does not allocate them again.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._buffers = {}
+
+    def arange(self, start: int, end: int, step: int = 1, device=None) -> torch.Tensor:
+        key = (start, end, step, str(device))
+        if key not in self._index:
+            self._index[key] = torch.arange(start, end, step, device=device)
+        return self._index[key]
+
+    def buffer(self, name: str, shape: Tuple[int, ...], dtype: torch.dtype, device=None) -> torch.Tensor:
+        numel = math.prod(shape)
+        buf = self._buffers.get(name)
+        if buf is None or buf.numel() < numel or buf.dtype != dtype or buf.device != torch.device(device):
+            buf = torch.empty(numel, dtype=dtype, device=device)
+            self._buffers[name] = buf
+        return buf[:numel].view(shape)
+
+
+def energy_score(
+    metric: torch.Tensor,
+    margin: float = 0.5,
+    kernel: str = "vision",
+    chunk_size: int = None,
+    workspace: Workspace = None,
+    mask: torch.Tensor = None,
+) -> torch.Tensor:
+    """
+    Computes the PiToMe energy (isolation) score of every token, i.e. the row mean of a
+    Gaussian kernel over the cosine distance between normalized tokens.
+
+    The similarity matrix is built chunk_size rows at a time, so the peak memory is
+    O(B*T*chunk_size) instead of O(B*T*T). Each row is still reduced over all T tokens,
+    so the result is the same as the dense computation.
+
+    Args:
+     - metric: L2-normalized tokens of shape [B, T, C]
+     - margin: the kernel width is sigma = 1 - margin
+     - kernel: "vision" for the shifted kernel (2*k - 1) used by pitome_vision,
+       "text" for the plain kernel with a 0.5 factor used by pitome_text
+     - chunk_size: number of rows per chunk. None computes all rows at once.
+     - workspace: if given, the similarity chunks are written to its "sim" buffer
+     - mask: optional [B, T] tensor, 1 for real tokens and 0 for padding. Each row is then
+       averaged over the real tokens only.
+    """
+    B, T, _ = metric.shape
+    sigma = 1 - margin
+    norm = 1 / (sigma * math.sqrt(2 * math.pi))
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = T
+
+    weight = None
+    if mask is not None:
+        weight = mask.to(metric.dtype)
+        weight = (weight / weight.sum(-1, keepdim=True).clamp(min=1))[..., None]
+
+    score = metric.new_empty(B, T)
+    for start in range(0, T, chunk_size):
+        rows = metric[:, start:start + chunk_size]
+        out = None
+        if workspace is not None:
+            out = workspace.buffer("sim", (B, rows.shape[1], T), metric.dtype, metric.device)
+        sim = torch.matmul(rows, metric.transpose(-1, -2), out=out)
+        if sim.requires_grad:
+            if kernel == "vision":
+                k = 2 * torch.exp(-(((1 - sim) / sigma) ** 2)) - 1
+            else:
+                k = torch.exp(-(((1 - sim) / sigma) ** 2 * 0.5))
+        else:
+            # Same kernel, evaluated in place on the similarity chunk.
+            k = sim.neg_().add_(1).div_(sigma).pow_(2)
+            if kernel == "vision":
+                k = k.neg_().exp_().mul_(2).sub_(1)
+            else:
+                k = k.mul_(0.5).neg_().exp_()
+        if weight is None:
+            score[:, start:start + chunk_size] = k.mean(-1) * norm
+        else:
+            score[:, start:start + chunk_size] = (k @ weight)[..., 0] * norm
+    return score
+
+
+def approx_energy_score(
+    metric: torch.Tensor,
+    margin: float = 0.5,
+    kernel: str = "vision",
+    approx: str = "nystrom",
+    rank: int = 64,
+) -> torch.Tensor:
+    """
+    Approximates energy_score in O(T*rank*C) instead of O(T^2*C) for long sequences.
+
+    Both kernels are exp(-c*((1 - sim)/sigma)^2) up to the affine shift of the vision kernel,
+    so only the row mean of that base kernel is approximated, with the Nystrom method: rank
+    evenly spaced landmark tokens, mean_j k(x_i, x_j) is estimated as
+    k(x_i, L) @ pinv(k(L, L)) @ mean_j k(L, x_j). The eigenvalues of k(L, L) below 1e-3 of the
+    largest are dropped, they only add noise to the estimate.
+
+    The merge only uses the ranking of the scores. On 577 clustered tokens, rank 64 keeps a
+    Spearman correlation of about 0.85 with the exact ranking, a stable ranking (above 0.99)
+    takes rank >= T/4. There is no random feature variant: on normalized tokens the base kernel
+    is exp(-c*|x - y|^4/(4*sigma^2)), which is not positive definite (exp(-|d|^a) with a > 2),
+    so it has no Fourier feature map.
+    """
+    B, T, C = metric.shape
+    sigma = 1 - margin
+    norm = 1 / (sigma * math.sqrt(2 * math.pi))
+    c = 1.0 if kernel == "vision" else 0.5
+
+    if approx != "nystrom":
+        raise ValueError(f"unknown approximation {approx}, expected nystrom")
+    landmarks = metric[:, torch.linspace(0, T - 1, min(rank, T), device=metric.device).long()]
+    k_xl = torch.exp(-c * ((1 - metric @ landmarks.transpose(-1, -2)) / sigma) ** 2)
+    k_ll = torch.exp(-c * ((1 - landmarks @ landmarks.transpose(-1, -2)) / sigma) ** 2)
+    k_ll_inv = torch.linalg.pinv(k_ll.float(), rtol=1e-3, hermitian=True).to(metric.dtype)
+    mean_k = (k_xl @ (k_ll_inv @ k_xl.mean(dim=1)[..., None]))[..., 0]
+
+    if kernel == "vision":
+        return (2 * mean_k - 1) * norm
+    return mean_k * norm
+
+
+def merge_tokens(
+    x: torch.Tensor, gather_idx: torch.Tensor, dst_idx: torch.Tensor, mode="mean", num_out: int = None
+) -> torch.Tensor:
+    """
+    Functional form of a merge: gathers the kept tokens followed by the merged ones with
+    gather_idx [B, T'+R] and reduces the last R of them into the kept token given by dst_idx [B, R].
+    The number of kept tokens only depends on the index shapes, so this traces into a single graph.
+    If num_out is given, only the first num_out kept slots are returned, the others are scratch
+    slots for sources that must not reach any output token.
+    """
+    B, _, C = x.shape
+    num_kept = gather_idx.shape[1] - dst_idx.shape[1]
+    x = x.gather(dim=-2, index=gather_idx[..., None].expand(B, -1, C))
+    dst, src = x[:, :num_kept], x[:, num_kept:]
+    if src.shape[1] > 0:
+        if mode == "mean" and torch.onnx.is_in_onnx_export():
+            # ScatterElements has no mean reduction
+            count = torch.ones_like(x[..., :1])
+            count = count[:, :num_kept].scatter_add(-2, dst_idx[..., None], count[:, num_kept:])
+            dst = dst.scatter_add(-2, dst_idx[..., None].expand(B, -1, C), src) / count
+        else:
+            dst = dst.scatter_reduce(-2, dst_idx[..., None].expand(B, -1, C), src, reduce=mode)
+            if torch.onnx.is_in_onnx_export():
+                # the exported scatter_reduce puts its output behind an If (for 0-d inputs),
+                # which hides its rank from the shape inference of onnxruntime
+                dst = dst.reshape(B, num_kept, C)
+    if num_out is not None:
+        dst = dst[:, :num_out]
+    return dst
+
+
+class MergePlan:
+    """
+    One merge decision stored as flat token indices, so that it can be applied to any
+    number of tensors with a single gather and a single scatter_reduce.
+
+    gather_idx [B, K + R] holds the indices of the K kept tokens (in output order) followed
+    by the indices of the R merged (source) tokens. dst_idx [B, R] holds the output position
+    each source token is reduced into.
+
+    A plan is callable like the merge closures it replaces: plan(x, mode="mean"), and
+    plan.unmerge(y, T) scatters the merged tokens back to the T input positions.
+
+    num_out (default K) is the number of output tokens, the kept slots after it are scratch
+    slots that are dropped after the reduction.
+    """
+
+    def __init__(self, gather_idx: torch.Tensor, dst_idx: torch.Tensor, num_kept: int, num_out: int = None):
+        self.gather_idx = gather_idx
+        self.dst_idx = dst_idx
+        self.num_kept = num_kept
+        self.num_out = num_kept if num_out is None else num_out
+
+    @classmethod
+    def from_indices(
+        cls,
+        kept_idx: torch.Tensor,
+        src_idx: torch.Tensor,
+        dst_idx: torch.Tensor,
+        class_token: bool = False,
+    ) -> "MergePlan":
+        """
+        Builds a plan from the indices of the kept tokens, the merged tokens and the position
+        in kept_idx every merged token goes to. If class_token is set, the indices are relative
+        to the tokens after the class token, which is kept in front.
+        """
+        if class_token:
+            cls_idx = kept_idx.new_zeros(kept_idx.shape[0], 1)
+            kept_idx = torch.cat([cls_idx, kept_idx + 1], dim=1)
+            src_idx = src_idx + 1
+            dst_idx = dst_idx + 1
+        gather_idx = torch.cat([kept_idx, src_idx], dim=1)
+        return cls(gather_idx, dst_idx, kept_idx.shape[1])
+
+    def __call__(self, x: torch.Tensor, mode="mean") -> torch.Tensor:
+        num_out = self.num_out if self.num_out < self.num_kept else None
+        return merge_tokens(x, self.gather_idx, self.dst_idx, mode=mode, num_out=num_out)
+
+    def apply(self, tensors: Tuple[torch.Tensor, ...], mode="mean") -> Tuple[torch.Tensor, ...]:
+        """
+        Merges several [B, T, *] tensors at once by concatenating them along the channel axis.
+        """
+        channels = [t.shape[-1] for t in tensors]
+        out = self(torch.cat(tensors, dim=-1), mode=mode)
+        return tuple(o.to(t.dtype) for o, t in zip(out.split(channels, dim=-1), tensors))
+
+    def token_map(self, num_tokens: int) -> torch.Tensor:
+        """
+        Position after merging of each of the num_tokens input tokens, of shape [B, num_tokens].
+        Tokens that are dropped by the plan (pruning) map to -1.
+        """
+        B = self.gather_idx.shape[0]
+        new_pos = torch.cat([
+            torch.arange(self.num_kept, device=self.gather_idx.device).expand(B, -1),
+            self.dst_idx,
+        ], dim=1)
+        new_pos = torch.where(new_pos < self.num_out, new_pos, -1)
+        out = new_pos.new_full((B, num_tokens), -1)
+        return out.scatter_(1, self.gather_idx, new_pos)
+
+    def unmerge(self, x: torch.Tensor, num_tokens: int) -> torch.Tensor:
+        """
+        Inverse of the plan for dense prediction: copies every merged token of x [B, K, C] to
+        all the num_tokens input positions it came from. Kept tokens are passed through and
+        dropped ones are zero.
+        """
+        return unmerge_source(x, self.token_map(num_tokens))
+
+
+def match_scores(
+    metric: torch.Tensor, a_idx: torch.Tensor, b_idx: torch.Tensor, workspace: Workspace = None
+) -> torch.Tensor:
+    """
+    Cosine similarity between the tokens in a_idx and b_idx only, of shape [B, |a|, |b|].
+    metric is expected to be L2-normalized.
+    """
+    B = metric.shape[0]
+    if workspace is not None:
+        batch_idx = workspace.arange(0, B, device=metric.device)[:, None]
+    else:
+        batch_idx = torch.arange(B, device=metric.device)[:, None]
+    return metric[batch_idx, a_idx, :] @ metric[batch_idx, b_idx, :].transpose(-1, -2)
+
 def bipartite_soft_matching(
     metric: torch.Tensor,
     r: int=0,
@@ -25,6 +281,7 @@ def bipartite_soft_matching(
     a_idx=None, 
     b_idx=None,
     scores=None,
+    workspace: Workspace = None,
 ) -> Tuple[Callable, Callable]:
     
 
@@ -36,7 +293,7 @@ def bipartite_soft_matching(
         a, b = metric[batch_idx, a_idx, :], metric[batch_idx, b_idx, :]
         node_max, node_idx = scores.max(dim=-1)
 
-        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        edge_idx = rank_indices(node_max, r)[..., None]
         unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
         src_idx = edge_idx[..., :r, :]  # Merged Tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
@@ -65,41 +322,40 @@ def bipartite_soft_matching(
                 scores[..., 0, :] = -math.inf
 
             node_max, node_idx = scores.max(dim=-1)
-            edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+            edge_idx = rank_indices(node_max, r)[..., None]
 
-            unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
+            unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens, in position order so the class token stays first
             src_idx = edge_idx[..., :r, :]  # Merged Tokens
             dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
 
-            if class_token:
-                unm_idx = unm_idx.sort(dim=1)[0]
-
-    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-        if a_idx is not None and b_idx is not None and scores is not None:
-            src, dst = x[batch_idx, a_idx, :], x[batch_idx, b_idx, :]
-        else:
-            src, dst = x[..., ::2, :], x[..., 1::2, :]
-        n, t1, c = src.shape
-        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
-        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
-        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
-
-        return torch.cat([unm, dst], dim=1)
-
+    with torch.no_grad():
+        if a_idx is None or b_idx is None:
+            arange = workspace.arange if workspace is not None else torch.arange
+            a_idx = arange(0, T, 2, device=metric.device).expand(B, -1)
+            b_idx = arange(1, T, 2, device=metric.device).expand(B, -1)
+        kept_idx = torch.cat([a_idx.gather(dim=-1, index=unm_idx[..., 0]), b_idx], dim=1)
+        merge = MergePlan.from_indices(
+            kept_idx,
+            a_idx.gather(dim=-1, index=src_idx[..., 0]),
+            unm_idx.shape[1] + dst_idx[..., 0],
+        )
 
     return merge, None
 
 
-def get_merge_func(metric: torch.Tensor, attn_idx:torch.Tensor, ratio: float=1.0, r:int=0,  class_token: bool = True):
+def get_merge_func(metric: torch.Tensor, cls_attn:torch.Tensor, ratio: float=1.0, r:int=0,  class_token: bool = True):
     B,T,C = metric.shape
     if r > 0:
-        r = min(r, T // 2)
+        kept_number = T - min(r, T // 2)
     elif ratio < 1.0:
         kept_number = math.ceil(T*ratio)
     else:
-        return do_nothing, do_nothing
+        return do_nothing
 
     with torch.no_grad():
+        # only the kept_number - 1 most attended tokens are needed, their order does not matter
+        idx = rank_indices(cls_attn, kept_number - 1, sorted=False)
+        attn_idx = torch.cat((torch.zeros_like(idx[:, :1]), idx + 1), dim=1)
         metric = torch.gather(metric, dim=1, index=attn_idx.unsqueeze(-1).expand(-1, -1, metric.shape[-1]))
         metric = metric/metric.norm(dim=-1, keepdim=True)
         unimportant_tokens_metric = metric[:, kept_number:]
@@ -109,17 +365,7 @@ def get_merge_func(metric: torch.Tensor, attn_idx:torch.Tensor, ratio: float=1.0
         if class_token:
             similarity[..., :, 0] = -math.inf
         _, node_idx = similarity.max(dim=-1)
-        dst_idx = node_idx[..., None]
-    def merge(x: torch.Tensor, mode="mean", training=False) -> torch.Tensor:
-        x= torch.gather(x, dim=1, index=attn_idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
-        src = x[:,kept_number:]
-        dst = x[:,:kept_number]
-        n, t1, c = src.shape
-        dst = dst.scatter_reduce(-2, dst_idx.expand(n, compress_number, c), src, reduce=mode) 
-        if training:
-            return torch.cat([dst, src], dim=1)
-        else:
-            return dst
+        merge = MergePlan(attn_idx, node_idx, kept_number)
     return merge
 
 
@@ -130,7 +376,11 @@ def pitome_vision(
     ratio:float=1.0,
     margin:torch.Tensor=0.5,
     class_token: bool = False,
-    prune:bool=False
+    prune:bool=False,
+    chunk_size:int=128,
+    workspace: Workspace = None,
+    approx: str = None,
+    rank: int = 64,
 ):
     if attn is not None and class_token:
         B,T,C = metric.shape
@@ -139,10 +389,7 @@ def pitome_vision(
         else:
             cls_attn = attn[:, :, 0, 1:]
             cls_attn = cls_attn.mean(dim=1)
-        _, idx = torch.sort(cls_attn, descending=True)
-        cls_index = torch.zeros((B,1), device=idx.device).long()
-        idx = torch.cat((cls_index, idx+1), dim=1)
-        merge = get_merge_func(metric, ratio=ratio, class_token=class_token, attn_idx=idx)
+        merge = get_merge_func(metric, ratio=ratio, class_token=class_token, cls_attn=cls_attn)
         return merge, None
     elif margin >=0.45:
         # with torch.no_grad():
@@ -158,7 +405,7 @@ def pitome_vision(
         #     scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, b_idx.shape[-1])) 
         #     scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, a_idx.shape[-1], b_idx.shape[-1] ))
 
-        return bipartite_soft_matching(metric, ratio=ratio, class_token=class_token, a_idx=None, b_idx=None, scores=None)
+        return bipartite_soft_matching(metric, r=r, ratio=ratio, class_token=class_token, a_idx=None, b_idx=None, scores=None, workspace=workspace)
     else:
         # print(metric.shape)
         with torch.no_grad():
@@ -171,47 +418,94 @@ def pitome_vision(
                 r = math.floor(T- T*ratio)
             else:
                 return do_nothing, do_nothing
-            metric = F.normalize(metric, p=2, dim=-1) 
+            metric = F.normalize(metric, p=2, dim=-1)
             # sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01)
             # isolation_score = sim.mean(dim=-1) + sim.sum(-1)
             # indices =  torch.argsort(isolation_score, descending=True)
-            sigma =  1 - margin 
-            sim = metric@metric.transpose(-1,-2) 
-            isolation_score = (2*(torch.exp(-(((1 - sim)/sigma)**2))) - 1).mean(-1) *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi)))
+            if approx is not None:
+                isolation_score = approx_energy_score(metric, margin, kernel="vision", approx=approx, rank=rank)
+            else:
+                isolation_score = energy_score(metric, margin, kernel="vision", chunk_size=chunk_size, workspace=workspace)
 
-            indices =  torch.argsort(isolation_score , descending=True)
+            indices =  rank_indices(isolation_score, 2*r)
             merge_idx = indices[..., :2*r]
             protected_idx = indices[..., 2*r:]
-        
-        def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-            if class_token:
-                x_cls=x[:,0,:].unsqueeze(1)
-                x=x[:,1:,:]
-            else:
-                x_cls = None
-            B, T, C = x.shape
-            batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
-            protected = x[batch_idx, protected_idx, :]
-
+            a_idx, b_idx = merge_idx[..., ::2], merge_idx[..., 1::2]
             if not prune:
-                a_idx, b_idx = merge_idx[..., ::2], merge_idx[..., 1::2] 
-                scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
-                scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
-                _, dst_idx = scores.max(dim=-1) 
-                src, dst = x[batch_idx, a_idx, :], x[batch_idx,  b_idx, :]
-                dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
+                _, dst_idx = match_scores(metric, a_idx, b_idx, workspace).max(dim=-1)
+                merge = MergePlan.from_indices(
+                    torch.cat([protected_idx, b_idx], dim=1), a_idx, protected_idx.shape[1] + dst_idx, class_token
+                )
             else:
-                dst_idx = merge_idx[...,  r:]
-                dst = x[batch_idx,  dst_idx, :]
+                merge = MergePlan.from_indices(
+                    torch.cat([protected_idx, merge_idx[..., r:]], dim=1), a_idx[..., :0], a_idx[..., :0], class_token
+                )
+
+        return merge, None
+
+
+def window_partition(grid_size: Tuple[int, int], window_size: int, device=None) -> torch.Tensor:
+    """
+    Order of the patch tokens of a row-major [H, W] grid grouped into non-overlapping
+    window_size x window_size windows, window after window. Returns a [H * W] index.
+    """
+    H, W = grid_size
+    if H % window_size or W % window_size:
+        raise ValueError(f"window size {window_size} does not divide the {H}x{W} patch grid")
+    idx = torch.arange(H * W, device=device).view(H // window_size, window_size, W // window_size, window_size)
+    return idx.permute(0, 2, 1, 3).flatten()
 
-            if x_cls is not None:
-                return torch.cat([x_cls, protected, dst], dim=1)
-            else:
-                return torch.cat([protected, dst], dim=1)
 
+def pitome_vision_windowed(
+    metric: torch.Tensor,
+    num_windows: int,
+    window_idx: torch.Tensor = None,
+    r: int = 0,
+    ratio: float = 1.0,
+    margin: torch.Tensor = 0.5,
+    class_token: bool = False,
+    prune: bool = False,
+    chunk_size: int = 128,
+    approx: str = None,
+    rank: int = 64,
+):
+    """
+    pitome_vision inside num_windows spatial windows: the energy score and the bipartite matching
+    only see the tokens of one window, so the cost grows with T * T / num_windows instead of T * T.
+    The windows are batched as [B * num_windows, T / num_windows, C].
+
+    window_idx (from window_partition) orders the tokens window after window. Every window keeps
+    the same number of tokens and the merged tokens come out grouped by window, so the following
+    merges are called with window_idx=None.
+
+    r and ratio apply to every window. Returns a plan over the input tokens like pitome_vision.
+    """
+    with torch.no_grad():
         if class_token:
-            return merge, None 
-        return merge, None 
+            metric = metric[:, 1:, :]
+        B, T, C = metric.shape
+        if window_idx is not None:
+            metric = metric[:, window_idx]
+        T_w = T // num_windows
+        merge, _ = pitome_vision(
+            metric.reshape(B * num_windows, T_w, C), r=r // num_windows if r > 0 else 0, ratio=ratio, margin=margin,
+            class_token=False, prune=prune, chunk_size=chunk_size, approx=approx, rank=rank,
+        )
+        if merge is do_nothing:
+            return do_nothing, None
+
+        K_w = merge.num_kept
+        # local indices of every window -> token indices of the whole sequence
+        offset = torch.arange(num_windows, device=metric.device)[None, :, None]
+        gather_idx = (merge.gather_idx.view(B, num_windows, -1) + offset * T_w)
+        if window_idx is not None:
+            gather_idx = window_idx[gather_idx]
+        dst_idx = (merge.dst_idx.view(B, num_windows, -1) + offset * K_w).flatten(1)
+        merge = MergePlan.from_indices(
+            gather_idx[..., :K_w].flatten(1), gather_idx[..., K_w:].flatten(1), dst_idx, class_token
+        )
+
+    return merge, None
 
 
 def unprotected_pitome_vision(
@@ -220,7 +514,8 @@ def unprotected_pitome_vision(
     ratio:float=1.0,
     margin:torch.Tensor=0.5,
     class_token: bool = False,
-    prune:bool=False
+    prune:bool=False,
+    chunk_size:int=128,
 ):
     # if margin >=0.45 and not prune:
 
@@ -237,39 +532,20 @@ def unprotected_pitome_vision(
                 r = math.floor(T- T*ratio)
             else:
                 return do_nothing, do_nothing
-            metric = F.normalize(metric, p=2, dim=-1) 
+            metric = F.normalize(metric, p=2, dim=-1)
             # sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01)
             # isolation_score = sim.mean(dim=-1) + sim.sum(-1)
             # indices =  torch.argsort(isolation_score, descending=True)
-            sigma =  1 - margin 
-            sim = metric@metric.transpose(-1,-2) 
-            isolation_score = (2*(torch.exp(-(((1 - sim)/sigma)**2))) - 1).mean(-1) *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi)))
-            # isolation_score = (2*torch.exp(-(((1 - sim)/sigma)**2))-1).mean(-1) 
+            isolation_score = energy_score(metric, margin, kernel="vision", chunk_size=chunk_size)
 
             # print(isolation_score.shape)
-            indices =  torch.argsort(isolation_score , descending=True)
-        
-        def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-            if class_token:
-                x_cls=x[:,0,:].unsqueeze(1)
-                x=x[:,1:,:]
-            else:
-                x_cls = None
-            B, T, C = x.shape
-            batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
-
+            indices =  rank_indices(isolation_score, r, sorted=False)
+            a_idx, b_idx = indices[..., :r], indices[..., r:]
             if not prune:
-                a_idx, b_idx = indices[..., :r], indices[..., r:] 
-                scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, b_idx.shape[-1])) 
-                scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, a_idx.shape[-1], b_idx.shape[-1]))
-                _, dst_idx = scores.max(dim=-1) 
-                src, dst = x[batch_idx, a_idx, :], x[batch_idx,  b_idx, :]
-                dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
-   
-            if x_cls is not None:
-                return torch.cat([x_cls, dst], dim=1)
+                _, dst_idx = match_scores(metric, a_idx, b_idx).max(dim=-1)
+                merge = MergePlan.from_indices(b_idx, a_idx, dst_idx, class_token)
             else:
-                return torch.cat([dst], dim=1)
+                merge = MergePlan.from_indices(b_idx, a_idx[..., :0], a_idx[..., :0], class_token)
 
         if class_token:
             return merge, None 
@@ -301,49 +577,27 @@ def pitome_vision_using_attn(
                 r = math.floor(T- T*ratio)
             else:
                 return do_nothing, do_nothing
-            metric = F.normalize(metric, p=2, dim=-1) 
+            metric = F.normalize(metric, p=2, dim=-1)
             # sim = F.elu((metric@metric.transpose(-1,-2) - margin)/0.01)
             # isolation_score = sim.mean(dim=-1) + sim.sum(-1)
             # indices =  torch.argsort(isolation_score, descending=True)
-            sigma =  1 - margin 
-            sim = metric@metric.transpose(-1,-2) 
-            # isolation_score = (2*(torch.exp(-(((1 - sim)/sigma)**2))) - 1).mean(-1) *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi)))
-            # isolation_score = (2*torch.exp(-(((1 - sim)/sigma)**2))-1).mean(-1) 
 
             score = attn[:, :, 1:, 1:].mean(1).mean(-1)
-            indices =  torch.argsort(score, descending=True)
+            indices =  rank_indices(score, 2*r)
             merge_idx = indices[..., :2*r]
             protected_idx = indices[..., 2*r:]
-        
-        def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-            if class_token:
-                x_cls=x[:,0,:].unsqueeze(1)
-                x=x[:,1:,:]
-            else:
-                x_cls = None
-            B, T, C = x.shape
-            batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
-            protected = x[batch_idx, protected_idx, :]
-
+            a_idx, b_idx = merge_idx[..., :r], merge_idx[..., r:]
             if not prune:
-                a_idx, b_idx = merge_idx[..., :r], merge_idx[..., r:] 
-                scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
-                scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
-                _, dst_idx = scores.max(dim=-1) 
-                src, dst = x[batch_idx, a_idx, :], x[batch_idx,  b_idx, :]
-                dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
+                _, dst_idx = match_scores(metric, a_idx, b_idx).max(dim=-1)
+                merge = MergePlan.from_indices(
+                    torch.cat([protected_idx, b_idx], dim=1), a_idx, protected_idx.shape[1] + dst_idx, class_token
+                )
             else:
-                dst_idx = merge_idx[...,  r:]
-                dst = x[batch_idx,  dst_idx, :]
+                merge = MergePlan.from_indices(
+                    torch.cat([protected_idx, merge_idx[..., r:]], dim=1), a_idx[..., :0], a_idx[..., :0], class_token
+                )
 
-            if x_cls is not None:
-                return torch.cat([x_cls, protected, dst], dim=1)
-            else:
-                return torch.cat([protected, dst], dim=1)
-
-        if class_token:
-            return merge, None 
-        return merge, None 
+        return merge, None
 
 
 def pitome_text(
@@ -352,7 +606,11 @@ def pitome_text(
     attn:torch.Tensor = None,
     margin:torch.Tensor=0.5,
     class_token: bool = False,
-    training:bool=False
+    training:bool=False,
+    chunk_size:int=128,
+    workspace: Workspace = None,
+    approx: str = None,
+    rank: int = 64,
 ):
     if attn is not None and class_token:
         B,T,C = metric.shape
@@ -361,10 +619,7 @@ def pitome_text(
         else:
             cls_attn = attn[:, :, 0, 1:]
             cls_attn = cls_attn.mean(dim=1)
-        _, idx = torch.sort(cls_attn, descending=True)
-        cls_index = torch.zeros((B,1), device=idx.device).long()
-        idx = torch.cat((cls_index, idx+1), dim=1)
-        return get_merge_func(metric, ratio=ratio, class_token=class_token, attn_idx=idx), None
+        return get_merge_func(metric, ratio=ratio, class_token=class_token, cls_attn=cls_attn), None
 
     with torch.no_grad():
 
@@ -377,38 +632,24 @@ def pitome_text(
         r = math.floor(T- T*ratio)
         metric = F.normalize(metric, p=2, dim=-1) 
 
-        batch_idx = torch.arange(B).unsqueeze_(1).to(metric.device)
-        sim = metric@metric.transpose(-1,-2)
-        sigma = 1 - margin 
-        isolation_score = (torch.exp(-(((1 - sim)/sigma)**2 * 0.5))).mean(-1) *  1/(sigma*torch.sqrt(torch.tensor(2*torch.pi))) 
-        indices =  torch.argsort(isolation_score, descending=True)
+        if approx is not None:
+            isolation_score = approx_energy_score(metric, margin, kernel="text", approx=approx, rank=rank)
+        else:
+            isolation_score = energy_score(metric, margin, kernel="text", chunk_size=chunk_size, workspace=workspace)
+        indices =  rank_indices(isolation_score, 2*r)
 
     with torch.no_grad():
         merge_idx = indices[..., :2*r]
         protected_idx = indices[..., 2*r:]
         a_idx, b_idx = merge_idx[..., :r], merge_idx[..., r:]
-        scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r)) 
-        scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r ))
-        _, dst_idx = scores.max(dim=-1) 
+        # short sequences can have r == 0, there is nothing to match then
+        dst_idx = a_idx
+        if r > 0:
+            _, dst_idx = match_scores(metric, a_idx, b_idx, workspace).max(dim=-1)
         # b_idx = merge_idx[..., r:]
-
-    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-        if class_token:
-            x_cls=x[:,0,:].unsqueeze(1)
-            x=x[:,1:,:]
-        else:
-            x_cls = None
-
-        B, T, C = x.shape
-        protected = x[batch_idx, protected_idx, :]
-        src, dst = x[batch_idx, a_idx, :], x[batch_idx,  b_idx, :]
-        dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
-        # dst = x[batch_idx,  b_idx, :]
-
-        if x_cls is not None:
-            return torch.cat([x_cls, protected, dst], dim=1)
-        else:
-            return torch.cat([protected, dst], dim=1)
+        merge = MergePlan.from_indices(
+            torch.cat([protected_idx, b_idx], dim=1), a_idx, protected_idx.shape[1] + dst_idx, class_token
+        )
 
     isolation_score = 1 - F.softmax(isolation_score, dim=-1) 
 
@@ -417,6 +658,118 @@ def pitome_text(
     return merge, isolation_score[..., None] 
 
 
+def pitome_text_varlen(
+    metric: torch.Tensor,
+    attention_mask: torch.Tensor,
+    ratio:float=1.0,
+    margin:torch.Tensor=0.5,
+    class_token: bool = False,
+    chunk_size:int=128,
+    merge_mask: torch.Tensor = None,
+):
+    """
+    Length aware version of pitome_text for padded batches. attention_mask [B, T] is 1 for
+    real tokens and 0 for padding.
+
+    Padding takes no part in the energy score or the matching and is dropped: every sequence
+    merges floor(n - n*ratio) of its own n tokens and the kept tokens are repacked, in their
+    original order, to the front of a tensor as long as the longest surviving sequence.
+
+    merge_mask [B, T] optionally restricts the merge to a subset of the real tokens (e.g. the
+    image tokens of a multimodal prompt), the other ones are always kept. n is then the size
+    of that subset.
+
+    Returns the merge plan, the merge weights and the new [B, T'] attention mask.
+    """
+    with torch.no_grad():
+        B, T, _ = metric.shape
+        valid = attention_mask.bool()
+        candidate = valid.clone()
+        if class_token:
+            candidate[:, 0] = False
+        if merge_mask is not None:
+            candidate &= merge_mask.bool()
+
+        lengths = candidate.sum(-1)
+        r = torch.minimum((lengths - lengths * ratio).floor().long(), lengths // 2)
+        max_r = int(r.max())
+
+        metric = F.normalize(metric, p=2, dim=-1)
+        isolation_score = energy_score(metric, margin, kernel="text", chunk_size=chunk_size, mask=candidate)
+        isolation_score = isolation_score.masked_fill(~candidate, -math.inf)
+
+        # per sequence the first r ranks are merged into the next r ranks, a row with a smaller r
+        # fills its remaining source slots with dummies that go to a padding slot
+        indices = rank_indices(isolation_score, 2 * max_r)
+        rank = torch.arange(2 * max_r, device=metric.device).expand(B, -1)
+        is_src = rank[:, :max_r] < r[:, None]
+        is_dst = (rank >= r[:, None]) & (rank < 2 * r[:, None])
+        a_idx, b_idx = indices[..., :max_r], indices[..., :2 * max_r]
+        node_idx = a_idx
+        if max_r > 0:
+            scores = match_scores(metric, a_idx, b_idx).masked_fill_(~is_dst[:, None, :], -math.inf)
+            _, node_idx = scores.max(dim=-1)
+
+        # output position of every token: kept tokens in order, then everything else
+        kept = valid.scatter(1, a_idx, ~is_src & valid.gather(1, a_idx))
+        kept_len = kept.sum(-1)
+        pos = torch.where(
+            kept, kept.cumsum(-1) - 1, kept_len[:, None] + (~kept).cumsum(-1) - 1
+        )
+        order = torch.empty_like(pos).scatter_(1, pos, torch.arange(T, device=metric.device).expand(B, -1))
+
+        # the output is as long as the longest surviving row, at most T. The dummy sources of a
+        # row go to its slot kept_len, for a row that keeps num_out tokens this is one extra
+        # scratch slot (any input token) that is dropped after the reduction
+        num_out = int(kept_len.max())
+        num_kept = num_out
+        if bool(((r < max_r) & (kept_len == num_out)).any()):
+            num_kept += 1
+            if num_kept > T:
+                order = torch.cat([order, order[:, :1]], dim=1)
+        dst_idx = torch.where(is_src, pos.gather(1, b_idx.gather(1, node_idx)), kept_len[:, None])
+        merge = MergePlan(torch.cat([order[:, :num_kept], a_idx], dim=1), dst_idx, num_kept, num_out=num_out)
+
+        mask = (torch.arange(num_out, device=metric.device)[None] < kept_len[:, None]).long()
+
+    weight = torch.where(candidate, 1 - F.softmax(isolation_score, dim=-1), 1.0)
+    return merge, weight[..., None], mask
+
+
+def merge_to_budget(
+    x: torch.Tensor,
+    budget: int,
+    margin: float = 0.3,
+    size: torch.Tensor = None,
+    class_token: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Merges x [B, T, C] down to exactly budget tokens with PiToMe energy and size-weighted
+    averaging. One bipartite step removes at most half of the tokens, so e.g. 576 -> 144 takes
+    two steps. The merged tokens are put back in the order of their mean input position.
+    With class_token set, the first token is never merged and stays in front.
+
+    Returns the merged tokens and their sizes.
+    """
+    if budget < 1 + class_token:
+        raise ValueError(f"budget has to keep at least {1 + class_token} token(s), got {budget}")
+    if margin >= 0.45:
+        raise ValueError(f"merge_to_budget merges by r, which needs margin < 0.45, got {margin}")
+    B, T, C = x.shape
+    if budget >= T:
+        return x, size
+    # the mean position of every group is merged along as an extra channel
+    pos = torch.arange(T, device=x.device, dtype=torch.float32)[None, :, None].expand(B, T, 1)
+    tokens = torch.cat([x.float(), pos], dim=-1)
+    while tokens.shape[1] > budget:
+        T = tokens.shape[1]
+        merge, _ = pitome_vision(tokens[..., :C], r=min(T - budget, T // 2), margin=margin, class_token=class_token)
+        tokens, size = merge_wavg(merge, tokens, size)
+    order = tokens[..., -1].argsort(dim=-1)
+    tokens = tokens.gather(1, order[..., None].expand(-1, -1, C + 1))
+    return tokens[..., :C].to(x.dtype), size.gather(1, order[..., None])
+
+
 def merge_mean(
     merge: Callable, x: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -448,8 +801,11 @@ def merge_wavg(
     if size is None:
         size = torch.ones_like(x[..., 0, None])
 
-    x = merge(x*size, mode="sum")
-    size = merge(size, mode="sum")
+    if isinstance(merge, MergePlan):
+        x, size = merge.apply((x*size, size), mode="sum")
+    else:
+        x = merge(x*size, mode="sum")
+        size = merge(size, mode="sum")
     x = x / size
 
     return x, size 
@@ -459,15 +815,35 @@ def merge_source(
     merge: Callable, x: torch.Tensor, source: torch.Tensor = None
 ) -> torch.Tensor:
     """
-    For source tracking. Source is an adjacency matrix between the initial tokens and final merged groups.
-    x is used to find out how many tokens there are in case the source is None.
+    For source tracking, updates the group ids of common.source with this merge. A MergePlan
+    gives its token map directly. x is used to find out how many tokens there are in case
+    the source is None.
+    """
+    if source is None:
+        source = initial_source(x)
+
+    if merge is do_nothing:
+        return source
+
+    if isinstance(merge, MergePlan):
+        token_map = merge.token_map(x.shape[1])
+    else:
+        token_map = one_hot_token_map(merge, x)
+    return remap_source(source, token_map)
+
+
+def unmerge_source(x: torch.Tensor, source: torch.Tensor = None) -> torch.Tensor:
+    """
+    Scatters merged tokens x [B, T, C] back to the initial tokens with the group ids of
+    merge_source, which compose the merges of all layers. Returns [B, T0, C], every initial
+    token gets the (averaged) token of its group and pruned tokens are zero.
     """
     if source is None:
-        n, t, _ = x.shape
-        source = torch.eye(t, device=x.device)[None, ...].expand(n, t, t)
+        return x
+    B, _, C = x.shape
+    out = x.gather(1, source.clamp(min=0).long()[..., None].expand(B, -1, C))
+    return out.masked_fill((source < 0)[..., None], 0)
 
-    source = merge(source, mode="amax")
-    return source
 
 def merge_attention_mask(
     merge, attention_mask: torch.Tensor
@@ -4,11 +4,12 @@ from .aug import apply_patch as aug
 from .mae  import apply_patch as mae
 from .bert import apply_patch as bert
 from .distilbert import apply_patch as distilbert
-# from .bart import apply_patch as bart 
+from .bart import apply_patch as bart
 from .blip import apply_patch as blip
 from .blip2 import apply_patch as blip2
 from .clip import apply_patch as clip 
 from .clip_hf import apply_patch as clip_hf 
 from .llama import apply_patch as llama 
+from .llava_projector import apply_patch as llava_projector
 
-__all__ = ["deit", "swag", "mae", "aug", "bert", "distilbert",  "blip", "blip2", "clip", "clip_hf", 'llama']
+__all__ = ["deit", "swag", "mae", "aug", "bert", "distilbert", "bart", "blip", "blip2", "clip", "clip_hf", 'llama', 'llava_projector']
@@ -1,541 +1,462 @@
-# import torch
-# import torch.nn as nn
-# from transformers.models.bart.modeling_bart import BartModel, BartEncoder, BartEncoderLayer, BartAttention,  shift_tokens_right
-# from transformers.modeling_outputs import BaseModelOutput, Seq2SeqModelOutput, dataclass, ModelOutput 
-# from typing import Optional, Tuple, Union, List
-# from ..merge import merge_source, pitome_text, merge_wavg, merge_attention_mask
-
-
-# @dataclass
-# class BaseModelOutputWithMask(ModelOutput):
-#     last_hidden_state: torch.FloatTensor = None
-#     hidden_states: Optional[Tuple[torch.FloatTensor]] = None
-#     attentions: Optional[Tuple[torch.FloatTensor]] = None
-#     attention_mask: Optional[Tuple[torch.FloatTensor]] = None
-
-# class PiToMeBartEncoderLayer(BartEncoderLayer):
-#     def init_margin(self, margin):
-#         self.margin = margin
-
-#     def compress_x(self, metric, x, attention_mask):
-#         ratio = self._tome_info["ratio"].pop(0)
-#         if ratio < 1.0:
-#             merge, isolated_score = pitome_text(
-#                 ratio=ratio,
-#                 metric=metric,
-#                 margin=self.margin,
-#                 class_token=self._tome_info["class_token"]
-#             )
-
-#             if self._tome_info["trace_source"]:
-#                 self._tome_info["source"] = merge_source(
-#                     merge, x, self._tome_info["source"]
-#                 )
-#             if isolated_score is not None and self._tome_info["size"] is not None:
-#                 weight = self._tome_info["size"] + isolated_score
-#                 x, self._tome_info["size"] = merge_wavg(merge, x, weight)
-#             else:
-#                 weight = self._tome_info["size"] 
-#                 x, self._tome_info["size"] = merge_wavg(merge, x, weight)
-#             attention_mask = merge_attention_mask(merge, attention_mask=attention_mask[..., None]).squeeze_(-1)
-
-#         return x, attention_mask
-
-
-#     def forward(
-#         self,
-#         hidden_states: torch.FloatTensor,
-#         attention_mask: torch.FloatTensor,
-#         layer_head_mask: torch.FloatTensor,
-#         output_attentions: Optional[bool] = False,
-#     ) -> Tuple[torch.FloatTensor, Optional[torch.FloatTensor]]:
-#         """
-#         Args:
-#             hidden_states (`torch.FloatTensor`): input to the layer of shape `(batch, seq_len, embed_dim)`
-#             attention_mask (`torch.FloatTensor`): attention mask of size
-#                 `(batch, 1, tgt_len, src_len)` where padding elements are indicated by very large negative values.
-#             layer_head_mask (`torch.FloatTensor`): mask for attention heads in a given layer of size
-#                 `(encoder_attention_heads,)`.
-#             output_attentions (`bool`, *optional*):
-#                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
-#                 returned tensors for more detail.
-#         """
-#         residual = hidden_states
-#         extended_attention_mask = _expand_mask(attention_mask, hidden_states.dtype)
-#         hidden_states, attn_weights, metric ,_ = self.self_attn(
-#             hidden_states=hidden_states,
-#             attention_mask=extended_attention_mask,
-#             layer_head_mask=layer_head_mask,
-#             output_attentions=output_attentions,
-#         )
-#         hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
-#         hidden_states = residual + hidden_states
-#         hidden_states = self.self_attn_layer_norm(hidden_states)
-
-#         hidden_states, attention_mask = self.compress_x(metric=metric, x=hidden_states, attention_mask=attention_mask)
-#         residual = hidden_states
-#         hidden_states = self.activation_fn(self.fc1(hidden_states))
-#         hidden_states = nn.functional.dropout(hidden_states, p=self.activation_dropout, training=self.training)
-#         hidden_states = self.fc2(hidden_states)
-#         hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
-#         hidden_states = residual + hidden_states
-#         hidden_states = self.final_layer_norm(hidden_states)
-
-#         if hidden_states.dtype == torch.float16 and (
-#             torch.isinf(hidden_states).any() or torch.isnan(hidden_states).any()
-#         ):
-#             clamp_value = torch.finfo(hidden_states.dtype).max - 1000
-#             hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
-
-#         outputs = (hidden_states, attention_mask,)
-
-#         if output_attentions:
-#             outputs += (attn_weights,)
-
-#         return outputs
-
-# class PiToMeBartAttention(BartAttention):
-#     """Multi-headed attention from 'Attention Is All You Need' paper"""
-#     def forward(
-#         self,
-#         hidden_states: torch.Tensor,
-#         key_value_states: Optional[torch.Tensor] = None,
-#         past_key_value: Optional[Tuple[torch.Tensor]] = None,
-#         attention_mask: Optional[torch.Tensor] = None,
-#         layer_head_mask: Optional[torch.Tensor] = None,
-#         output_attentions: bool = False,
-#     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-#         """Input shape: Batch x Time x Channel"""
-
-#         # if key_value_states are provided this layer is used as a cross-attention layer
-#         # for the decoder
-#         is_cross_attention = key_value_states is not None
-
-#         bsz, tgt_len, _ = hidden_states.size()
-
-#         # get query proj
-#         query_states = self.q_proj(hidden_states) * self.scaling
-#         # get key, value proj
-#         # `past_key_value[0].shape[2] == key_value_states.shape[1]`
-#         # is checking that the `sequence_length` of the `past_key_value` is the same as
-#         # the provided `key_value_states` to support prefix tuning
-#         if (
-#             is_cross_attention
-#             and past_key_value is not None
-#             and past_key_value[0].shape[2] == key_value_states.shape[1]
-#         ):
-#             # reuse k,v, cross_attentions
-#             key_states = past_key_value[0]
-#             value_states = past_key_value[1]
-#         elif is_cross_attention:
-#             # cross_attentions
-#             key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
-#             value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
-#         elif past_key_value is not None:
-#             # reuse k, v, self_attention
-#             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
-#             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-#             key_states = torch.cat([past_key_value[0], key_states], dim=2)
-#             value_states = torch.cat([past_key_value[1], value_states], dim=2)
-#         else:
-#             # self_attention
-#             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
-#             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-
-#         if self.is_decoder:
-#             # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
-#             # Further calls to cross_attention layer can then reuse all cross-attention
-#             # key/value_states (first "if" case)
-#             # if uni-directional self-attention (decoder) save Tuple(torch.Tensor, torch.Tensor) of
-#             # all previous decoder key/value_states. Further calls to uni-directional self-attention
-#             # can concat previous decoder key/value_states to current projected key/value_states (third "elif" case)
-#             # if encoder bi-directional self-attention `past_key_value` is always `None`
-#             past_key_value = (key_states, value_states)
-
-#         proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-#         query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
-#         key_states = key_states.reshape(*proj_shape)
-#         value_states = value_states.reshape(*proj_shape)
-
-#         src_len = key_states.size(1)
-#         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
-
-#         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
-#             raise ValueError(
-#                 f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is"
-#                 f" {attn_weights.size()}"
-#             )
-
-#         if attention_mask is not None:
-#             if attention_mask.size() != (bsz, 1, tgt_len, src_len):
-#                 raise ValueError(
-#                     f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
-#                 )
-#             attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
-#             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-#         attn_weights = nn.functional.softmax(attn_weights, dim=-1)
-
-#         if layer_head_mask is not None:
-#             if layer_head_mask.size() != (self.num_heads,):
-#                 raise ValueError(
-#                     f"Head mask for a single layer should be of size {(self.num_heads,)}, but is"
-#                     f" {layer_head_mask.size()}"
-#                 )
-#             attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-#             attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-#         if output_attentions:
-#             # this operation is a bit awkward, but it's required to
-#             # make sure that attn_weights keeps its gradient.
-#             # In order to do so, attn_weights have to be reshaped
-#             # twice and have to be reused in the following
-#             attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-#             attn_weights = attn_weights_reshaped.view(bsz * self.num_heads, tgt_len, src_len)
-#         else:
-#             attn_weights_reshaped = None
-
-#         attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
-
-#         attn_output = torch.bmm(attn_probs, value_states)
-
-#         if attn_output.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
-#             raise ValueError(
-#                 f"`attn_output` should be of size {(bsz * self.num_heads, tgt_len, self.head_dim)}, but is"
-#                 f" {attn_output.size()}"
-#             )
-
-#         attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
-#         attn_output = attn_output.transpose(1, 2)
-
-#         # Use the `embed_dim` from the config (stored in the class) rather than `hidden_state` because `attn_output` can be
-#         # partitioned across GPUs when using tensor-parallelism.
-#         attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
-
-#         attn_output = self.out_proj(attn_output)
-
-#         if len(key_states.shape) == 3:
-#             H,T,C = key_states.shape
-#             # key_states = key_states.view(T, -1)
-#             key_states = key_states.sum(0)
-#         else:
-#             B,H,T,C = key_states.shape
-#             # key_states = key_states.view(B, T, -1)
-#             key_states = key_states.sum(1)
-
-#         return attn_output, attn_weights_reshaped, key_states, past_key_value
-
-# class PiToMeBartEncoder(BartEncoder):
-#     """
-#     Modifications:
-#     - Initialize r, token size, and token sources.
-#     """
-
-#     def forward(
-#         self,
-#         input_ids: torch.LongTensor = None,
-#         attention_mask: Optional[torch.Tensor] = None,
-#         head_mask: Optional[torch.Tensor] = None,
-#         inputs_embeds: Optional[torch.FloatTensor] = None,
-#         output_attentions: Optional[bool] = None,
-#         output_hidden_states: Optional[bool] = None,
-#         return_dict: Optional[bool] = None,
-#     ):
-#         r"""
-#         Args:
-#             input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
-#                 Indices of input sequence tokens in the vocabulary. Padding will be ignored by default should you
-#                 provide it.
-
-#                 Indices can be obtained using [`AutoTokenizer`]. See [`PreTrainedTokenizer.encode`] and
-#                 [`PreTrainedTokenizer.__call__`] for details.
-
-#                 [What are input IDs?](../glossary#input-ids)
-#             attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
-#                 Mask to avoid performing attention on padding token indices. Mask values selected in `[0, 1]`:
-
-#                 - 1 for tokens that are **not masked**,
-#                 - 0 for tokens that are **masked**.
-
-#                 [What are attention masks?](../glossary#attention-mask)
-#             head_mask (`torch.Tensor` of shape `(encoder_layers, encoder_attention_heads)`, *optional*):
-#                 Mask to nullify selected heads of the attention modules. Mask values selected in `[0, 1]`:
-
-#                 - 1 indicates the head is **not masked**,
-#                 - 0 indicates the head is **masked**.
-
-#             inputs_embeds (`torch.FloatTensor` of shape `(batch_size, sequence_length, hidden_size)`, *optional*):
-#                 Optionally, instead of passing `input_ids` you can choose to directly pass an embedded representation.
-#                 This is useful if you want more control over how to convert `input_ids` indices into associated vectors
-#                 than the model's internal embedding lookup matrix.
-#             output_attentions (`bool`, *optional*):
-#                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
-#                 returned tensors for more detail.
-#             output_hidden_states (`bool`, *optional*):
-#                 Whether or not to return the hidden states of all layers. See `hidden_states` under returned tensors
-#                 for more detail.
-#             return_dict (`bool`, *optional*):
-#                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
-#         """
-
-#         self.total_flop = 0
-
-#         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
-#         output_hidden_states = (
-#             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
-#         )
-#         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
-#         # retrieve input_ids and inputs_embeds
-#         if input_ids is not None and inputs_embeds is not None:
-#             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
-#         elif input_ids is not None:
-#             input = input_ids
-#             input_ids = input_ids.view(-1, input_ids.shape[-1])
-#         elif inputs_embeds is not None:
-#             input = inputs_embeds[:, :, -1]
-#         else:
-#             raise ValueError("You have to specify either input_ids or inputs_embeds")
-
-#         if inputs_embeds is None:
-#             inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
-
-#         embed_pos = self.embed_positions(input)
-#         embed_pos = embed_pos.to(inputs_embeds.device)
-
-#         hidden_states = inputs_embeds + embed_pos
-#         hidden_states = self.layernorm_embedding(hidden_states)
-#         hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
-
-
-#         encoder_states = () if output_hidden_states else None
-#         all_attentions = () if output_attentions else None
-
-#         # check if head_mask has a correct number of layers specified if desired
-#         if head_mask is not None:
-#             if head_mask.size()[0] != (len(self.layers)):
-#                 raise ValueError(
-#                     f"The head_mask should be specified for {len(self.layers)} layers, but it is for"
-#                     f" {head_mask.size()[0]}."
-#                 )
-
-#         for idx, encoder_layer in enumerate(self.layers):
-#             self.total_flop += self.calculate_block_flop(hidden_states.shape)
-#             if output_hidden_states:
-#                 encoder_states = encoder_states + (hidden_states,)
-#             # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
-#             to_drop = False
-#             if self.training:
-#                 dropout_probability = torch.rand([])
-#                 if dropout_probability < self.layerdrop:  # skip the layer
-#                     to_drop = True
-
-#             if to_drop:
-#                 layer_outputs = (None, None)
-#             else:
-#                 if self.gradient_checkpointing and self.training:
-
-#                     def create_custom_forward(module):
-#                         def custom_forward(*inputs):
-#                             return module(*inputs, output_attentions)
-
-#                         return custom_forward
-
-#                     layer_outputs = torch.utils.checkpoint.checkpoint(
-#                         create_custom_forward(encoder_layer),
-#                         hidden_states,
-#                         attention_mask,
-#                         (head_mask[idx] if head_mask is not None else None),
-#                     )
-#                 else:
-#                     layer_outputs = encoder_layer(
-#                         hidden_states,
-#                         attention_mask,
-#                         layer_head_mask=(head_mask[idx] if head_mask is not None else None),
-#                         output_attentions=output_attentions,
-#                     )
-
-#                 hidden_states = layer_outputs[0]
-#                 attention_mask = layer_outputs[1]
-
-#             if output_attentions:
-#                 all_attentions = all_attentions + (layer_outputs[1],)
-
-#         if output_hidden_states:
-#             encoder_states = encoder_states + (hidden_states,)
-
-#         if not return_dict:
-#             return tuple(v for v in [hidden_states, encoder_states, all_attentions, attention_mask] if v is not None)
-#         return BaseModelOutputWithMask(
-#             last_hidden_state=hidden_states, hidden_states=encoder_states, attentions=all_attentions, attention_mask=attention_mask
-#         )
-
-
-
-#     def calculate_block_flop(self, shape):
-#         flops = 0
-#         _, N, C = shape
-#         mhsa_flops = 4*N*C*C + 2*N*N*C
-#         flops += mhsa_flops
-#         ffn_flops = 8*N*C*C
-#         flops += ffn_flops
-#         return flops
-
-# def make_pitome_class(transformer_class:BartModel):
-#     class PiToMeBartModel(transformer_class):
-#         def init_r(self):
-#             len_layers = len(self.encoder.layers)
-#             self._tome_info["ratio"] = [self.ratio if i in [
-#                 0,1,2
-#                 # len_layers - 1, 
-#                 # len_layers - 2,
-#                 # len_layers - 3,
-#                 # len_layers - 9,
-#             ] else 1.0 for i in range(len_layers) ]
-#             print(self._tome_info['ratio'])
-#             self._tome_info["size"] = None
-#             self._tome_info["source"] = None
-            
-
-#         def forward(
-#             self,
-#             input_ids: torch.LongTensor = None,
-#             attention_mask: Optional[torch.Tensor] = None,
-#             decoder_input_ids: Optional[torch.LongTensor] = None,
-#             decoder_attention_mask: Optional[torch.LongTensor] = None,
-#             head_mask: Optional[torch.Tensor] = None,
-#             decoder_head_mask: Optional[torch.Tensor] = None,
-#             cross_attn_head_mask: Optional[torch.Tensor] = None,
-#             encoder_outputs: Optional[List[torch.FloatTensor]] = None,
-#             past_key_values: Optional[List[torch.FloatTensor]] = None,
-#             inputs_embeds: Optional[torch.FloatTensor] = None,
-#             decoder_inputs_embeds: Optional[torch.FloatTensor] = None,
-#             use_cache: Optional[bool] = None,
-#             output_attentions: Optional[bool] = None,
-#             output_hidden_states: Optional[bool] = None,
-#             return_dict: Optional[bool] = None,
-#         ) -> Union[Tuple, Seq2SeqModelOutput]:
-
-#             # different to other models, Bart automatically creates decoder_input_ids from
-#             # input_ids if no decoder_input_ids are provided
- 
-#             if decoder_input_ids is None and decoder_inputs_embeds is None:
-#                 if input_ids is None:
-#                     raise ValueError(
-#                         "If no `decoder_input_ids` or `decoder_inputs_embeds` are "
-#                         "passed, `input_ids` cannot be `None`. Please pass either "
-#                         "`input_ids` or `decoder_input_ids` or `decoder_inputs_embeds`."
-#                     )
-
-#                 decoder_input_ids = shift_tokens_right(
-#                     input_ids, self.config.pad_token_id, self.config.decoder_start_token_id
-#                 )
-
-#             output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
-#             output_hidden_states = (
-#                 output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
-#             )
-#             use_cache = use_cache if use_cache is not None else self.config.use_cache
-#             return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
-#             if encoder_outputs is None:
-#                 # print(attention_mask.shape)
-#                 encoder_outputs = self.encoder(
-#                     input_ids=input_ids,
-#                     attention_mask=attention_mask,
-#                     head_mask=head_mask,
-#                     inputs_embeds=inputs_embeds,
-#                     output_attentions=output_attentions,
-#                     output_hidden_states=output_hidden_states,
-#                     return_dict=return_dict,
-#                 )
-#             # If the user passed a tuple for encoder_outputs, we wrap it in a BaseModelOutput when return_dict=True
-#             elif return_dict and not isinstance(encoder_outputs, BaseModelOutput):
-#                 encoder_outputs = BaseModelOutput(
-#                     last_hidden_state=encoder_outputs[0],
-#                     hidden_states=encoder_outputs[1] if len(encoder_outputs) > 1 else None,
-#                     attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
-#                 )
-
-#             # decoder outputs consists of (dec_features, past_key_value, dec_hidden, dec_attn)
-#             decoder_outputs = self.decoder(
-#                 input_ids=decoder_input_ids,
-#                 attention_mask=decoder_attention_mask,
-#                 encoder_hidden_states=encoder_outputs[0],
-#                 encoder_attention_mask=encoder_outputs[-1].expand(attention_mask.shape[0], encoder_outputs[-1].shape[-1]),
-#                 head_mask=decoder_head_mask,
-#                 cross_attn_head_mask=cross_attn_head_mask,
-#                 past_key_values=past_key_values,
-#                 inputs_embeds=decoder_inputs_embeds,
-#                 use_cache=use_cache,
-#                 output_attentions=output_attentions,
-#                 output_hidden_states=output_hidden_states,
-#                 return_dict=return_dict,
-#             )
-
-#             if not return_dict:
-#                 return decoder_outputs + encoder_outputs
-
-#             return Seq2SeqModelOutput(
-#                 last_hidden_state=decoder_outputs.last_hidden_state,
-#                 past_key_values=decoder_outputs.past_key_values,
-#                 decoder_hidden_states=decoder_outputs.hidden_states,
-#                 decoder_attentions=decoder_outputs.attentions,
-#                 cross_attentions=decoder_outputs.cross_attentions,
-#                 encoder_last_hidden_state=encoder_outputs.last_hidden_state,
-#                 encoder_hidden_states=encoder_outputs.hidden_states,
-#                 encoder_attentions=encoder_outputs.attentions,
-#             )
-
-#     return PiToMeBartModel
-
-
-# def apply_patch(
-#    model: BartEncoder, trace_source: bool = False, prop_attn: bool = True, margin=0.9, ratio=1.0):
-#     """
-#     Applies ToMe to this transformer. Afterward, set r using model.r.
-
-#     If you want to know the source of each token (e.g., for visualization), set trace_source = true.
-#     The sources will be available at model._tome_info["source"] afterward.
-
-#     For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
-#     the shelf. For trianing and for evaluating MAE models off the self set this to be False.
-#     """
-#     PiToMeBartModel = make_pitome_class(model.__class__)
-#     print('using', 'pitome')
-
-#     model.__class__ = PiToMeBartModel
-#     model.encoder.__class__ = BartEncoder
-#     model.ratio = ratio 
-#     model._tome_info = {
-#         "ratio": model.ratio,
-#         "margin":  [],
-#         "size": None,
-#         "source": None,
-#         "trace_source": trace_source,
-#         "prop_attn": prop_attn,
-#         "class_token": False, 
-#         "distill_token": False,
-#     }
-#     model.init_r()
-
-#     current_layer = 0
-#     margin = margin 
-#     num_layers = len(model.encoder.layers)
-#     # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
-#     margins = [.75 - 0.25*(i/num_layers) for i in range(num_layers)]
-
-#     if hasattr(model, "dist_token") and model.dist_token is not None:
-#         model._tome_info["distill_token"] = True
-
-#     for module in model.encoder.modules():
-#         if isinstance(module, BartEncoder):
-#             module.__class__ = PiToMeBartEncoder
-#         if isinstance(module, BartEncoderLayer):
-#             # module.__class__ = ToMeBlock if compress_method == 'tome' else PiToMeBlock 
-#             module.__class__ = PiToMeBartEncoderLayer 
-#             module.init_margin(margins[current_layer])
-#             module._tome_info = model._tome_info
-#             current_layer +=1
-#         elif isinstance(module, BartAttention):
-#             module.__class__ = PiToMeBartAttention
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from transformers.models.bart.modeling_bart import BartModel, BartEncoder, BartEncoderLayer, BartAttention, shift_tokens_right
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqModelOutput
+from ...common.attention import add_bias, attention, size_bias
+from ...common.context import thread_local_info
+from ..merge import merge_source, pitome_text_varlen, merge_wavg
+
+
+@dataclass
+class BaseModelOutputWithMask(BaseModelOutput):
+    """
+    Encoder output with the [B, T'] padding mask and the [B, T', 1] sizes of the merged tokens,
+    so that the decoder can cross-attend to the merged sequence.
+    """
+    attention_mask: Optional[torch.LongTensor] = None
+    size: Optional[torch.FloatTensor] = None
+
+
+def padding_bias(attention_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    # [B, T] 0/1 mask -> [B, 1, 1, T] additive mask
+    return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+
+class PiToMeBartEncoderLayer(BartEncoderLayer):
+    def init_margin(self, margin):
+        self.margin = margin
+
+    def compress_x(self, metric, x, attention_mask):
+        ratio = self._tome_info["ratio"][self.layer_idx]
+        if ratio < 1.0:
+            merge, weight, attention_mask = pitome_text_varlen(
+                metric=metric,
+                attention_mask=attention_mask,
+                ratio=ratio,
+                margin=self.margin,
+                class_token=self._tome_info["class_token"],
+            )
+
+            if self._tome_info["trace_source"]:
+                self._tome_info["source"] = merge_source(
+                    merge, x, self._tome_info["source"]
+                )
+            size = self._tome_info["size"]
+            if size is None:
+                size = torch.ones_like(x[..., 0, None])
+            x, _ = merge_wavg(merge, x, weight * size)
+            # number of input tokens behind every merged token, for proportional attention
+            self._tome_info["size"] = merge(size, mode="sum")
+
+        return x, attention_mask
+
+
+    def forward(
+        self,
+        hidden_states: torch.FloatTensor,
+        attention_mask: torch.LongTensor,
+        layer_head_mask: torch.FloatTensor,
+        output_attentions: Optional[bool] = False,
+    ) -> Tuple[torch.FloatTensor, torch.LongTensor, Optional[torch.FloatTensor]]:
+        """
+        Args:
+            hidden_states (`torch.FloatTensor`): input to the layer of shape `(batch, seq_len, embed_dim)`
+            attention_mask (`torch.LongTensor`): padding mask of shape `(batch, seq_len)`, it shrinks
+                together with the merged tokens and is returned as the second output.
+            layer_head_mask (`torch.FloatTensor`): mask for attention heads in a given layer of size
+                `(encoder_attention_heads,)`.
+            output_attentions (`bool`, *optional*):
+                Whether or not to return the attentions tensors of all attention layers.
+        """
+        residual = hidden_states
+        hidden_states, attn_weights, _, metric = self.self_attn(
+            hidden_states=hidden_states,
+            attention_mask=padding_bias(attention_mask, hidden_states.dtype),
+            layer_head_mask=layer_head_mask,
+            output_attentions=output_attentions,
+            size=self._tome_info["size"] if self._tome_info["prop_attn"] else None,
+        )
+        hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
+        hidden_states = residual + hidden_states
+        hidden_states = self.self_attn_layer_norm(hidden_states)
+
+        hidden_states, attention_mask = self.compress_x(metric=metric, x=hidden_states, attention_mask=attention_mask)
+        residual = hidden_states
+        hidden_states = self.activation_fn(self.fc1(hidden_states))
+        hidden_states = nn.functional.dropout(hidden_states, p=self.activation_dropout, training=self.training)
+        hidden_states = self.fc2(hidden_states)
+        hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
+        hidden_states = residual + hidden_states
+        hidden_states = self.final_layer_norm(hidden_states)
+
+        if hidden_states.dtype == torch.float16 and (
+            torch.isinf(hidden_states).any() or torch.isnan(hidden_states).any()
+        ):
+            clamp_value = torch.finfo(hidden_states.dtype).max - 1000
+            hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+
+        outputs = (hidden_states, attention_mask,)
+
+        if output_attentions:
+            outputs += (attn_weights,)
+
+        return outputs
+
+
+class PiToMeBartAttention(BartAttention):
+    """
+    Modifications:
+    - Apply proportional attention over the keys with the given sizes
+    - Run on scaled_dot_product_attention, the weights are only built when they are returned
+    - Return the mean of the keys over heads as the merge metric
+    """
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+        size: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]], torch.Tensor]:
+        """Input shape: Batch x Time x Channel"""
+
+        # if key_value_states are provided this layer is used as a cross-attention layer
+        # for the decoder
+        is_cross_attention = key_value_states is not None
+
+        bsz, tgt_len, _ = hidden_states.size()
+
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        if (
+            is_cross_attention
+            and past_key_value is not None
+            and past_key_value[0].shape[2] == key_value_states.shape[1]
+        ):
+            # reuse k,v, cross_attentions
+            key_states = past_key_value[0]
+            value_states = past_key_value[1]
+        elif is_cross_attention:
+            # cross_attentions
+            key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
+            value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
+        elif past_key_value is not None:
+            # reuse k, v, self_attention
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        else:
+            # self_attention
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+
+        if self.is_decoder:
+            past_key_value = (key_states, value_states)
+
+        attn_output, attn_weights = attention(
+            query_states, key_states, value_states,
+            bias=add_bias(attention_mask, size_bias(size)),
+            scale=self.scaling,
+            dropout_p=self.dropout if self.training else 0.0,
+            need_weights=output_attentions or layer_head_mask is not None,
+        )
+        if layer_head_mask is not None:
+            # scaling the weights of a head scales its output by the same factor
+            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights
+            attn_output = layer_head_mask.view(1, -1, 1, 1) * attn_output
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, attn_weights if output_attentions else None, past_key_value, key_states.mean(1)
+
+
+class PiToMeBartCrossAttention(PiToMeBartAttention):
+    """
+    Decoder cross-attention over the merged encoder tokens, with proportional attention from
+    the sizes of the encoder output.
+    """
+    def forward(self, hidden_states, key_value_states=None, past_key_value=None, attention_mask=None,
+                layer_head_mask=None, output_attentions=False):
+        size = self._tome_info["cross_size"] if self._tome_info["prop_attn"] else None
+        return super().forward(
+            hidden_states, key_value_states, past_key_value, attention_mask, layer_head_mask, output_attentions, size=size
+        )[:3]
+
+
+class PiToMeBartEncoder(BartEncoder):
+    """
+    Modifications:
+    - Initialize the ratios, token size, and token sources.
+    - Keep the padding mask as [B, T] and shrink it with the merged tokens.
+    - Return the merged mask and the token sizes with the encoder output.
+    """
+
+    def forward(
+        self,
+        input_ids: torch.LongTensor = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ) -> Union[Tuple, BaseModelOutputWithMask]:
+        len_layers = len(self.layers)
+        if self.schedule is not None:
+            self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len_layers)
+        else:
+            self._tome_info["ratio"] = tuple(self.ratio if i in [0, 1, 2] else 1.0 for i in range(len_layers))
+        self._tome_info["size"] = None
+        self._tome_info["source"] = None
+        self.total_flop = 0
+
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+        # retrieve input_ids and inputs_embeds
+        if input_ids is not None and inputs_embeds is not None:
+            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
+        elif input_ids is not None:
+            input = input_ids
+            input_ids = input_ids.view(-1, input_ids.shape[-1])
+        elif inputs_embeds is not None:
+            input = inputs_embeds[:, :, -1]
+        else:
+            raise ValueError("You have to specify either input_ids or inputs_embeds")
+
+        if inputs_embeds is None:
+            inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
+
+        embed_pos = self.embed_positions(input)
+        embed_pos = embed_pos.to(inputs_embeds.device)
+
+        hidden_states = inputs_embeds + embed_pos
+        hidden_states = self.layernorm_embedding(hidden_states)
+        hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
+
+        if attention_mask is None:
+            attention_mask = torch.ones(hidden_states.shape[:2], dtype=torch.long, device=hidden_states.device)
+
+        encoder_states = () if output_hidden_states else None
+        all_attentions = () if output_attentions else None
+
+        # check if head_mask has a correct number of layers specified if desired
+        if head_mask is not None:
+            if head_mask.size()[0] != (len(self.layers)):
+                raise ValueError(
+                    f"The head_mask should be specified for {len(self.layers)} layers, but it is for"
+                    f" {head_mask.size()[0]}."
+                )
+
+        for idx, encoder_layer in enumerate(self.layers):
+            self.total_flop += self.calculate_block_flop(hidden_states.shape)
+            if output_hidden_states:
+                encoder_states = encoder_states + (hidden_states,)
+            # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description), a dropped
+            # layer does not merge either
+            if self.training and torch.rand([]) < self.layerdrop:
+                continue
+
+            layer_outputs = encoder_layer(
+                hidden_states,
+                attention_mask,
+                layer_head_mask=(head_mask[idx] if head_mask is not None else None),
+                output_attentions=output_attentions,
+            )
+            hidden_states = layer_outputs[0]
+            attention_mask = layer_outputs[1]
+
+            if output_attentions:
+                all_attentions = all_attentions + (layer_outputs[2],)
+
+        if output_hidden_states:
+            encoder_states = encoder_states + (hidden_states,)
+
+        size = self._tome_info["size"]
+        if size is None:
+            size = torch.ones_like(hidden_states[..., 0, None])
+        if not return_dict:
+            return tuple(v for v in [hidden_states, encoder_states, all_attentions, attention_mask, size] if v is not None)
+        return BaseModelOutputWithMask(
+            last_hidden_state=hidden_states, hidden_states=encoder_states, attentions=all_attentions,
+            attention_mask=attention_mask, size=size,
+        )
+
+    def calculate_block_flop(self, shape):
+        flops = 0
+        _, N, C = shape
+        mhsa_flops = 4*N*C*C + 2*N*N*C
+        flops += mhsa_flops
+        ffn_flops = 8*N*C*C
+        flops += ffn_flops
+        return flops
+
+
+def make_pitome_class(transformer_class):
+    class PiToMeBartModel(transformer_class):
+        """
+        Modifications:
+        - The decoder cross-attends to the merged encoder tokens with the merged padding mask,
+          so every decode step attends to T' instead of T keys.
+        """
+
+        def forward(
+            self,
+            input_ids: torch.LongTensor = None,
+            attention_mask: Optional[torch.Tensor] = None,
+            decoder_input_ids: Optional[torch.LongTensor] = None,
+            decoder_attention_mask: Optional[torch.LongTensor] = None,
+            head_mask: Optional[torch.Tensor] = None,
+            decoder_head_mask: Optional[torch.Tensor] = None,
+            cross_attn_head_mask: Optional[torch.Tensor] = None,
+            encoder_outputs: Optional[List[torch.FloatTensor]] = None,
+            past_key_values: Optional[List[torch.FloatTensor]] = None,
+            inputs_embeds: Optional[torch.FloatTensor] = None,
+            decoder_inputs_embeds: Optional[torch.FloatTensor] = None,
+            use_cache: Optional[bool] = None,
+            output_attentions: Optional[bool] = None,
+            output_hidden_states: Optional[bool] = None,
+            return_dict: Optional[bool] = None,
+        ) -> Union[Tuple, Seq2SeqModelOutput]:
+
+            # different to other models, Bart automatically creates decoder_input_ids from
+            # input_ids if no decoder_input_ids are provided
+            if decoder_input_ids is None and decoder_inputs_embeds is None:
+                if input_ids is None:
+                    raise ValueError(
+                        "If no `decoder_input_ids` or `decoder_inputs_embeds` are "
+                        "passed, `input_ids` cannot be `None`. Please pass either "
+                        "`input_ids` or `decoder_input_ids` or `decoder_inputs_embeds`."
+                    )
+
+                decoder_input_ids = shift_tokens_right(
+                    input_ids, self.config.pad_token_id, self.config.decoder_start_token_id
+                )
+
+            output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+            output_hidden_states = (
+                output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+            )
+            use_cache = use_cache if use_cache is not None else self.config.use_cache
+            return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+            if encoder_outputs is None:
+                encoder_outputs = self.encoder(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    head_mask=head_mask,
+                    inputs_embeds=inputs_embeds,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=True,
+                )
+            elif not isinstance(encoder_outputs, BaseModelOutput):
+                # a tuple from the encoder ends with the merged mask and the sizes
+                encoder_outputs = BaseModelOutputWithMask(
+                    last_hidden_state=encoder_outputs[0],
+                    attention_mask=encoder_outputs[-2] if len(encoder_outputs) > 2 else None,
+                    size=encoder_outputs[-1] if len(encoder_outputs) > 2 else None,
+                )
+
+            # generate passes the mask of the input tokens, the merged one comes with the encoder output
+            encoder_attention_mask = attention_mask
+            self._tome_info["cross_size"] = None
+            if isinstance(encoder_outputs, BaseModelOutputWithMask) and encoder_outputs.attention_mask is not None:
+                encoder_attention_mask = encoder_outputs.attention_mask
+                self._tome_info["cross_size"] = encoder_outputs.size
+
+            # decoder outputs consists of (dec_features, past_key_value, dec_hidden, dec_attn)
+            decoder_outputs = self.decoder(
+                input_ids=decoder_input_ids,
+                attention_mask=decoder_attention_mask,
+                encoder_hidden_states=encoder_outputs[0],
+                encoder_attention_mask=encoder_attention_mask,
+                head_mask=decoder_head_mask,
+                cross_attn_head_mask=cross_attn_head_mask,
+                past_key_values=past_key_values,
+                inputs_embeds=decoder_inputs_embeds,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
+
+            if not return_dict:
+                return decoder_outputs + encoder_outputs.to_tuple()
+
+            return Seq2SeqModelOutput(
+                last_hidden_state=decoder_outputs.last_hidden_state,
+                past_key_values=decoder_outputs.past_key_values,
+                decoder_hidden_states=decoder_outputs.hidden_states,
+                decoder_attentions=decoder_outputs.attentions,
+                cross_attentions=decoder_outputs.cross_attentions,
+                encoder_last_hidden_state=encoder_outputs.last_hidden_state,
+                encoder_hidden_states=encoder_outputs.hidden_states,
+                encoder_attentions=encoder_outputs.attentions,
+            )
+
+    return PiToMeBartModel
+
+
+def apply_patch(
+   model: BartModel, trace_source: bool = False, prop_attn: bool = True, margin=0.9, ratio=1.0):
+    """
+    Applies PiToMe to the encoder of this BartModel (model.model of BartForConditionalGeneration).
+    Afterward, set the ratio using model.encoder.ratio (or model.encoder.schedule).
+
+    The encoder output carries the merged padding mask and the token sizes, the decoder
+    cross-attends to the merged tokens with proportional attention, also inside generate().
+
+    If you want to know the source of each token (e.g., for visualization), set trace_source = true.
+    The sources will be available at model._tome_info["source"] afterward.
+
+    For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
+    the shelf. For trianing and for evaluating MAE models off the self set this to be False.
+    """
+    PiToMeBartModel = make_pitome_class(model.__class__)
+    print('using', 'pitome')
+
+    model.__class__ = PiToMeBartModel
+    model.encoder.__class__ = PiToMeBartEncoder
+    model.encoder.ratio = ratio
+    model.encoder.schedule = None
+    model._tome_info = {
+        "ratio": ratio,
+        "margin":  [],
+        "size": None,
+        "cross_size": None,
+        "source": None,
+        "trace_source": trace_source,
+        "prop_attn": prop_attn,
+        "class_token": False,
+        "distill_token": False,
+    }
+    model.encoder._tome_info = model._tome_info
+
+    current_layer = 0
+    num_layers = len(model.encoder.layers)
+    # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
+    margins = [.75 - 0.25*(i/num_layers) for i in range(num_layers)]
+
+    for module in model.encoder.modules():
+        if isinstance(module, BartEncoderLayer):
+            module.__class__ = PiToMeBartEncoderLayer
+            module.init_margin(margins[current_layer])
+            module._tome_info = model._tome_info
+            module.layer_idx = current_layer
+            current_layer +=1
+        elif isinstance(module, BartAttention):
+            module.__class__ = PiToMeBartAttention
+    for layer in model.decoder.layers:
+        layer.encoder_attn.__class__ = PiToMeBartCrossAttention
+        layer.encoder_attn._tome_info = model._tome_info
+    thread_local_info(model, "_tome_info")
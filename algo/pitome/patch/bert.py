@@ -13,7 +13,10 @@ import torch
 import torch.nn as nn
 from typing import Tuple
 from transformers.models.bert.modeling_bert import BertLayer, BertEncoder, BertSelfAttention, BertAttention, apply_chunking_to_forward
-from ..merge import merge_source, pitome_text, merge_mean, merge_wavg, merge_attention_mask
+from ...common.attention import attention
+from ...common.context import thread_local_info
+from ..utils import quantize_linear
+from ..merge import merge_source, pitome_text, pitome_text_varlen, merge_mean, merge_wavg, merge_attention_mask
 from transformers.modeling_utils import ModuleUtilsMixin 
 from typing import Optional, Union 
 import math
@@ -31,20 +34,34 @@ class PiToMeBertLayer(BertLayer):
         output_attentions: Optional[bool] = False,
     ) -> Tuple[torch.Tensor]:
         # attn_size = self._tome_info["size"] if self._tome_info["prop_attn"] else None
+        ratio = self._tome_info["ratio"][self.layer_idx]
+        # only the attention-based selector reads the probabilities
+        need_attn = self._tome_info["use_attn"] and ratio < 1.0 and not self._tome_info["varlen"]
 
         self_attention_outputs = self.attention(
             hidden_states,
             attention_mask,
             head_mask,
             output_attentions=output_attentions,
+            need_attn=need_attn,
         )
-        ratio = self._tome_info["ratio"].pop()
         x = self_attention_outputs[0]
         key = self_attention_outputs[1]
         attn = self_attention_outputs[2]
 
     
-        if ratio < 1.0:
+        if ratio < 1.0 and self._tome_info["varlen"]:
+            # merge inside every sequence only and repack to the longest one
+            attention_mask = torch.where(attention_mask.squeeze_(-2).squeeze_(-2) >= 0, 1, 0)
+            merge, weight, attention_mask = pitome_text_varlen(
+                metric=key,
+                attention_mask=attention_mask,
+                ratio=ratio,
+                margin=self.margin,
+                class_token=self._tome_info["class_token"],
+            )
+            x, self._tome_info["size"] = merge_wavg(merge, x, weight)
+        elif ratio < 1.0:
             merge, isolated_score = pitome_text(
                 ratio=ratio,
                 metric=key,
@@ -87,6 +104,7 @@ class PiToMeBertAttention(BertAttention):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
+        need_attn: bool = False,
     ) -> Tuple[torch.Tensor]:
         self_outputs, key, attn = self.self(
             hidden_states,
@@ -96,6 +114,7 @@ class PiToMeBertAttention(BertAttention):
             encoder_attention_mask,
             past_key_value,
             output_attentions,
+            need_attn=need_attn,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + (key,attn, ) + self_outputs[1:]  # add attentions if we output them
@@ -112,6 +131,7 @@ class PiToMeBertSelfAttention(BertSelfAttention):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
+        need_attn: bool = False,
     ) -> Tuple[torch.Tensor]:
         mixed_query_layer = self.query(hidden_states)
 
@@ -120,6 +140,17 @@ class PiToMeBertSelfAttention(BertSelfAttention):
         value_layer = self.transpose_for_scores(self.value(hidden_states))
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
+        if not (need_attn or output_attentions) and self.position_embedding_type == "absolute":
+            # the extended attention mask is already additive, so sdpa never builds the probabilities
+            context_layer, _ = attention(
+                query_layer, key_layer, value_layer,
+                bias=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            context_layer = context_layer.view(context_layer.size()[:-2] + (self.all_head_size,))
+            return (context_layer,), key_layer.sum(1), None
+
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
@@ -190,12 +221,16 @@ def make_pitome_class(transformer_class):
             len_layers = len(self.layer)
             # self._tome_info["ratio"] = [self.ratio if i in [len_layers-1,len_layers-6] else 1.0 for i in range(len_layers) ]
             # self._tome_info["ratio"] = [self.ratio for _ in range(len_layers) ]
-            self._tome_info["ratio"] = [self.ratio if i in [
+            ratios = [self.ratio if i in [
                 len_layers - 1, 
                 len_layers - 2,
                 len_layers - 3,
                 # len_layers - 9,
             ] else 1.0 for i in range(len_layers) ]
+            # indexed by layer, the last entries go to the first layers
+            self._tome_info["ratio"] = tuple(reversed(ratios))
+            if self.schedule is not None:
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len_layers)
             all_hidden_states = () if output_hidden_states else None
             all_self_attentions = () if output_attentions else None
             flops = 0
@@ -223,7 +258,7 @@ def make_pitome_class(transformer_class):
                 flops += self.calculate_block_flop(hidden_states.shape)
 
                 if output_attentions:
-                    all_self_attentions = all_self_attentions + (layer_outputs[2],)
+                    all_self_attentions = all_self_attentions + (layer_outputs[3],)
 
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
@@ -250,7 +285,7 @@ def make_pitome_class(transformer_class):
 
 
 def apply_patch(
-   model: BertEncoder, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False):
+   model: BertEncoder, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False, varlen=False, quantize=False):
     """
     Applies ToMe to this transformer. Afterward, set r using model.r.
 
@@ -259,6 +294,12 @@ def apply_patch(
 
     For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
     the shelf. For trianing and for evaluating MAE models off the self set this to be False.
+
+    For padded batches set varlen to True: padding is then never merged or kept, and the
+    hidden states shrink to the longest remaining sequence after every merge.
+
+    For CPU inference set quantize to True: the Linear layers are dynamically quantized to
+    int8 and the merge scores are still computed from their fp32 outputs.
     """
     PiToMeBertEncoder = make_pitome_class(model.__class__)
     print('using', 'pitome')
@@ -266,6 +307,7 @@ def apply_patch(
     model.__class__ = PiToMeBertEncoder
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'tome' 
     model._tome_info = {
@@ -274,6 +316,7 @@ def apply_patch(
         "size": None,
         "source": None,
         "use_attn": use_attn,
+        "varlen": varlen,
         "trace_source": trace_source,
         "prop_attn": prop_attn,
         "class_token": True,
@@ -290,9 +333,12 @@ def apply_patch(
             module.__class__ = PiToMeBertLayer
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         if isinstance(module, BertAttention):
             module.__class__ = PiToMeBertAttention 
         if isinstance(module, BertSelfAttention):
-            module.__class__ = PiToMeBertSelfAttention 
-
+            module.__class__ = PiToMeBertSelfAttention
+    thread_local_info(model, "_tome_info")
+    if quantize:
+        quantize_linear(model)
@@ -1,5 +1,6 @@
 import torch
 from lavis.models.vit import VisionTransformer, Attention, Block
+from ...common.context import thread_local_info
 from ..merge import merge_source, pitome_vision, merge_wavg, pitome_vision_using_attn, unprotected_pitome_vision
 
 class PiToMeBlock(Block):
@@ -13,7 +14,7 @@ class PiToMeBlock(Block):
         self.margin = margin
     
     def compress_x(self, metric, x, attn=None):
-        ratio = self._pitome_info["ratio"].pop()
+        ratio = self._pitome_info["ratio"][self.layer_idx]
         if ratio < 1.0:
             merge, isolated_score = unprotected_pitome_vision(
                 ratio=ratio,
@@ -86,7 +87,10 @@ def make_pitome_class(transformer_class):
 
         def forward(self,x, register_blk=-1):
             self._pitome_info["r"] = [self.r]* len(self.blocks) 
-            self._pitome_info["ratio"] =[1.0] + [self.ratio] * (len(self.blocks)-1)
+            if self.schedule is not None:
+                self._pitome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.blocks))
+            else:
+                self._pitome_info["ratio"] = (self.ratio,) * (len(self.blocks)-1) + (1.0,)
             self._pitome_info["size"] = None
             self._pitome_info["source"] = None
             self._pitome_info["attn"] = []
@@ -114,7 +118,10 @@ def make_pitome_class(transformer_class):
         def forward_features(self, x, register_blk=-1) -> torch.Tensor:
       
             self._pitome_info["r"] = [self.r]* len(self.blocks) 
-            self._pitome_info["ratio"] = [self.ratio] * len(self.blocks) 
+            if self.schedule is not None:
+                self._pitome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.blocks))
+            else:
+                self._pitome_info["ratio"] = (self.ratio,) * len(self.blocks)
             self._pitome_info["size"] = None
             self._pitome_info["source"] = None
             self.total_flop = 0
@@ -169,6 +176,7 @@ def apply_patch(
     model.__class__ = PiToMeVisionTransformer
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'tome' 
     model._pitome_info = {
@@ -197,6 +205,8 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._pitome_info = model._pitome_info
+            module.layer_idx = current_layer
             current_layer +=1
         # elif isinstance(module, Attention):
         #     module.__class__ = PiToMeAttention
+    thread_local_info(model, "_pitome_info")
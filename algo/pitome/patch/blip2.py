@@ -2,6 +2,8 @@ import torch
 import torch.nn.functional as F 
 import torch.utils.checkpoint as checkpoint
 from lavis.models.eva_vit import VisionTransformer, Block, Attention
+from ...common.attention import add_bias, attention, cls_attention, size_bias
+from ...common.context import thread_local_info
 from ..merge import merge_source, pitome_vision, merge_wavg
 
 class PiToMeBlock(Block):
@@ -15,7 +17,7 @@ class PiToMeBlock(Block):
         self.margin = margin
     
     def compress_x(self, metric, x, attn):
-        ratio = self._tome_info["ratio"]
+        ratio = self._tome_info["ratio"][self.layer_idx]
         if ratio < 1.0:
             merge, isolated_score = pitome_vision(
                 ratio=ratio,
@@ -42,14 +44,15 @@ class PiToMeBlock(Block):
 
     def forward(self, x, rel_pos_bias=None):
         attn_size = self._tome_info["size"] if self._tome_info["prop_attn"] else None
+        need_attn = self._tome_info["class_token"] and self._tome_info["ratio"][self.layer_idx] < 1.0
         if self.gamma_1 is None:
-            x_attn, metric, attn = self.attn(self.norm1(x), attn_size, rel_pos_bias=rel_pos_bias)
+            x_attn, metric, attn = self.attn(self.norm1(x), attn_size, rel_pos_bias=rel_pos_bias, need_attn=need_attn)
             x = x + self.drop_path(x_attn)
             # x, attn_size = self.compress_x(x,x, attn)
             x, _ = self.compress_x(x=x,metric=x, attn=attn)
             x = x + self.drop_path(self.mlp(self.norm2(x)))
         else:
-            x_attn, metric, attn = self.attn(self.norm1(x), attn_size, rel_pos_bias=rel_pos_bias)
+            x_attn, metric, attn = self.attn(self.norm1(x), attn_size, rel_pos_bias=rel_pos_bias, need_attn=need_attn)
             x = x + self.drop_path(x_attn)
             x, _ = self.compress_x(x=x,metric=x, attn=attn)
             x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
@@ -63,7 +66,7 @@ class PiToMeAttention(Attention):
      - Return the mean of k over heads from attention
     """
 
-    def forward(self, x:torch.Tensor, isolation_score: torch.Tensor = None, rel_pos_bias=None):
+    def forward(self, x:torch.Tensor, isolation_score: torch.Tensor = None, rel_pos_bias=None, need_attn=False):
         B, N, C = x.shape
         qkv_bias = None
         if self.q_bias is not None:
@@ -73,26 +76,21 @@ class PiToMeAttention(Attention):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-        if isolation_score is not None:
-            attn = attn +  isolation_score.log()[:, None, None, :, 0]
-
+        bias = size_bias(isolation_score)
         if self.relative_position_bias_table is not None:
             relative_position_bias = \
                 self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
                     self.window_size[0] * self.window_size[1] + 1,
                     self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
             relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            bias = add_bias(bias, relative_position_bias.unsqueeze(0))
+        bias = add_bias(bias, rel_pos_bias)
 
-        if rel_pos_bias is not None:
-            attn = attn + rel_pos_bias
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        x, _ = attention(q, k, v, bias=bias, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0)
+        # the attention-based selector only reads the class token row
+        attn = cls_attention(q, k, bias=bias, scale=self.scale) if need_attn else None
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, k.mean(1), attn
@@ -108,7 +106,10 @@ def make_pitome_class(transformer_class):
         def forward(self, x) -> torch.Tensor:
       
             self._tome_info["r"] = [self.r]* len(self.blocks) 
-            self._tome_info["ratio"] = self.ratio
+            if self.schedule is not None:
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.blocks))
+            else:
+                self._tome_info["ratio"] = (self.ratio,) * len(self.blocks)
             self._tome_info["size"] = None
             self._tome_info["source"] = None
             self.total_flop = 0
@@ -167,6 +168,7 @@ def apply_patch(
     model.__class__ = PiToMeVisionTransformer
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'tome' 
     model._tome_info = {
@@ -193,6 +195,8 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
             module.__class__ = PiToMeAttention
+    thread_local_info(model, "_tome_info")
@@ -2,6 +2,7 @@ from lavis.models.clip_models.model import Transformer, ResidualAttentionBlock
 from typing import Optional, Callable
 import torch.nn as nn
 import torch
+from ...common.context import thread_local_info
 from ..merge import merge_source, pitome_vision, merge_wavg
 
 
@@ -11,7 +12,7 @@ class PiToMeBlock(ResidualAttentionBlock):
         self.margin = margin
 
     def compress_x(self, metric, x, attn):
-        ratio = self._pitome_info["ratio"].pop()
+        ratio = self._pitome_info["ratio"][self.layer_idx]
         if ratio < 1.0:
             merge, isolated_score = pitome_vision(
                 ratio=ratio,
@@ -54,7 +55,10 @@ class PiToMeTransformer(Transformer):
 
     def forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
         self._pitome_info["r"] = [self.r]* len(self.resblocks) 
-        self._pitome_info["ratio"] = [self.ratio] * len(self.resblocks) 
+        if self.schedule is not None:
+            self._pitome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.resblocks))
+        else:
+            self._pitome_info["ratio"] = (self.ratio,) * len(self.resblocks)
         self._pitome_info["size"] = None
         self._pitome_info["source"] = None
         self.total_flop = 0
@@ -90,6 +94,7 @@ def apply_patch(
     model.__class__ = PiToMeTransformer 
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'pitome' 
     model._pitome_info = {
@@ -117,6 +122,8 @@ def apply_patch(
             module.__class__ = PiToMeBlock
             module.init_margin(margins[current_layer])
             module._pitome_info = model._pitome_info
+            module.layer_idx = current_layer
             current_layer +=1
         # elif isinstance(module, Attention):
         #     module.__class__ = PiToMeAttention
+    thread_local_info(model, "_pitome_info")
@@ -1,4 +1,5 @@
 from transformers.models.clip.modeling_clip import CLIPEncoder, CLIPEncoderLayer 
+from ...common.context import thread_local_info
 from ..merge import merge_source, pitome_vision, merge_mean 
 from transformers.modeling_outputs import BaseModelOutput
 from typing import Optional, Tuple, Union
@@ -20,7 +21,7 @@ class PiToMeCLIPEncoder(CLIPEncoder):
         self.margins = margins 
 
     def compress_x(self, metric, x, attn, idx):
-        ratio = self._pitome_info["ratio"].pop()
+        ratio = self._pitome_info["ratio"][idx]
         if ratio < 1.0:
             merge, isolated_score = pitome_vision(
                 ratio=ratio,
@@ -79,7 +80,10 @@ class PiToMeCLIPEncoder(CLIPEncoder):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
         """
         len_layers = len(self.layers)
-        self._pitome_info["ratio"] = [self.ratio if i%2==0 else 1.0 for i in range(len_layers)]
+        if self.schedule is not None:
+            self._pitome_info["ratio"] = self.schedule.ratios(self.ratio, len_layers)
+        else:
+            self._pitome_info["ratio"] = tuple(self.ratio if (len_layers - 1 - i)%2==0 else 1.0 for i in range(len_layers))
         # self._pitome_info["ratio"] = [self.ratio] * len(self.layers) 
         self._pitome_info["size"] = None
         self._pitome_info["source"] = None
@@ -103,19 +107,20 @@ class PiToMeCLIPEncoder(CLIPEncoder):
                     hidden_states,
                     attention_mask,
                     causal_attention_mask,
-                    output_attentions=True,
+                    output_attentions=output_attentions,
                 )
             else:
                 layer_outputs = encoder_layer(
                     hidden_states,
                     attention_mask,
                     causal_attention_mask,
-                    output_attentions=True,
+                    output_attentions=output_attentions,
                 )
 
             hidden_states = layer_outputs[0]
             self.total_flops += self.calculate_block_flop(hidden_states.shape)
-            hidden_states= self.compress_x(hidden_states, hidden_states, layer_outputs[1],idx)
+            # merging stays outside of the checkpointed layer, so it runs once per forward pass
+            hidden_states= self.compress_x(hidden_states, hidden_states, layer_outputs[1] if output_attentions else None, idx)
 
             if output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
@@ -156,6 +161,7 @@ def apply_patch(
     model.__class__ =  PiToMeCLIPEncoder 
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'pitome' 
     model._pitome_info = {
@@ -176,3 +182,4 @@ def apply_patch(
     # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
     margins = [.9 - .9*(i/num_layers) for i in range(num_layers)]
     model.init_margin(margins)
+    thread_local_info(model, "_pitome_info")
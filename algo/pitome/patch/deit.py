@@ -14,8 +14,10 @@ from typing import Tuple
 import torch
 import torch.nn as nn
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
-# from timm.models.helpers import checkpoint_seq 
-from .timm import PiToMeAttention, PiToMeBlock, PiToMeBlockUsingRatio
+from ...common.context import is_compiling, thread_local_info
+from ..merge import unmerge_source
+from ..utils import TokenPlanner, block_flop, quantize_linear
+from .timm import PiToMeAttention, PiToMeBlock, PiToMeBlockUsingRatio, checkpoint_blocks, init_windows
 
 
 
@@ -24,19 +26,28 @@ def make_pitome_class(transformer_class):
         """
         Modifications:
         - Initialize r, token size, and token sources.
+        - unmerge_tokens restores the full token grid for dense prediction heads.
         """
 
         def forward(self, x, return_flop=True) -> torch.Tensor:
       
-            self._tome_info["r"] = [self.r]* len(self.blocks) 
-            self._tome_info["ratio"] = [self.ratio] * len(self.blocks) 
+            if self.schedule is not None:
+                self._tome_info["r"] = self.schedule.rs(self.r, len(self.blocks))
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.blocks))
+            else:
+                self._tome_info["r"] = (self.r,) * len(self.blocks)
+                self._tome_info["ratio"] = (self.ratio,) * len(self.blocks)
             self._tome_info["size"] = None
             self._tome_info["source"] = None
-            self.total_flop = 0
+            self._tome_info["plans"] = None
+            self._tome_info["approx"] = self.approx
+            self._tome_info["rank"] = self.rank
+            init_windows(self)
 
             x = super().forward(x)
+            total_flop = self.total_flop = self._tome_info["flops"]
             if return_flop:
-                return x, self.total_flop
+                return x, total_flop
             else:
                 return x
                 
@@ -46,24 +57,26 @@ def make_pitome_class(transformer_class):
             x = self.patch_embed(x)
             x = self._pos_embed(x)
             x = self.norm_pre(x)
-            # if self.grad_checkpointing and not torch.jit.is_scripting():
-                # x = checkpoint_seq(self.blocks, x)
-            # else:
-            for block in self.blocks:
-                self.total_flop += self.calculate_block_flop(x.shape) 
-                x = block(x)
+            # the token count, and with it the FLOPs, depends on the input resolution
+            self._tome_info["flops"] = self.planner.flops(self._tome_info["ratio"], self._tome_info["r"], x.shape[1])
+            # a traced or compiled graph keeps no references to the scratch buffers
+            self._tome_info["workspace"] = None if torch.jit.is_tracing() or is_compiling() else self.planner.workspace(self._tome_info, x.shape[0], x.device, x.shape[1])
+            if self.grad_checkpointing and self.training and not torch.jit.is_scripting():
+                x = checkpoint_blocks(self.blocks, x, self._tome_info)
+            else:
+                for block in self.blocks:
+                    x = block(x)
 
             x = self.norm(x)
             return x
  
+        def unmerge_tokens(self, x: torch.Tensor) -> torch.Tensor:
+            # needs trace_source=True, maps [B, T, C] merged tokens back to the input tokens
+            return unmerge_source(x, self._tome_info["source"])
+
         def calculate_block_flop(self, shape):
-            flops = 0
             _, N, C = shape
-            mhsa_flops = 4*N*C*C + 2*N*N*C
-            flops += mhsa_flops
-            ffn_flops = 8*N*C*C
-            flops += ffn_flops
-            return flops
+            return block_flop(N, C)
 
 
     return PiToMeVisionTransformer
@@ -71,15 +84,24 @@ def make_pitome_class(transformer_class):
 
 
 def apply_patch(
-   model: VisionTransformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_k=False):
+   model: VisionTransformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_k=False, quantize=False):
     """
     Applies ToMe to this transformer. Afterward, set r using model.r.
 
+    For high resolution inputs, set model.window_size (in patches) to merge inside non-overlapping
+    windows of the patch grid, and model.global_pass = True to match globally at the last merge.
+
+    For long sequences, set model.approx to "nystrom" to approximate the energy score with
+    model.rank landmark tokens.
+
     If you want to know the source of each token (e.g., for visualization), set trace_source = true.
     The sources will be available at model._tome_info["source"] afterward.
 
     For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
     the shelf. For trianing and for evaluating MAE models off the self set this to be False.
+
+    For CPU inference set quantize to True: the Linear layers are dynamically quantized to
+    int8 and the merge scores are still computed from their fp32 outputs.
     """
     PiToMeVisionTransformer = make_pitome_class(model.__class__)
     print('using', 'pitome')
@@ -87,6 +109,11 @@ def apply_patch(
     model.__class__ = PiToMeVisionTransformer
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
+    model.window_size = None
+    model.global_pass = False
+    model.approx = None
+    model.rank = 64
     
     # model.compress_method = 'tome' 
     model._tome_info = {
@@ -95,6 +122,12 @@ def apply_patch(
         "size": None,
         "source": None,
         "trace_source": trace_source,
+        "workspace": None,
+        "approx": None,
+        "rank": 64,
+        "windows": None,
+        "global_layer": -1,
+        "plans": None,
         "prop_attn": prop_attn,
         "class_token": model.cls_token is not None,
         "distill_token": False,
@@ -114,6 +147,12 @@ def apply_patch(
             module.__class__ = PiToMeBlock if use_k else PiToMeBlockUsingRatio 
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
             module.__class__ = PiToMeAttention
+
+    model.planner = TokenPlanner(model)
+    thread_local_info(model, "_tome_info")
+    if quantize:
+        quantize_linear(model)
@@ -14,6 +14,9 @@ from typing import Tuple
 import torch
 import torch.nn as nn
 from transformers.models.distilbert.modeling_distilbert import Transformer, TransformerBlock, MultiHeadSelfAttention
+from ...common.attention import attention
+from ...common.context import thread_local_info
+from ..utils import quantize_linear
 from ..merge import merge_source, pitome_text,merge_wavg, merge_attention_mask
 from typing import Optional, Union 
 import math
@@ -40,6 +43,10 @@ class PiToMeDistilBertBlock(TransformerBlock):
             sa_weights: torch.tensor(bs, n_heads, seq_length, seq_length) The attention weights ffn_output:
             torch.tensor(bs, seq_length, dim) The output of the transformer block contextualization.
         """
+        ratio = self._tome_info["ratio"][self.layer_idx]
+        # only the attention-based selector and output_attentions read the weights
+        need_attn = output_attentions or (self._tome_info["use_attn"] and ratio < 1.0)
+
         # Self-Attention
         sa_output = self.attention(
             query=x,
@@ -47,10 +54,9 @@ class PiToMeDistilBertBlock(TransformerBlock):
             value=x,
             mask=attn_mask,
             head_mask=head_mask,
-            output_attentions=True,
+            output_attentions=need_attn,
         )
-        ratio = self._tome_info["ratio"].pop()
-        sa_output, metric ,sa_weights = sa_output  # (bs, seq_length, dim), (bs, n_heads, seq_length, seq_length)
+        sa_output, metric ,sa_weights = sa_output if need_attn else sa_output + (None,)  # (bs, seq_length, dim), (bs, n_heads, seq_length, seq_length)
     
         sa_output = self.sa_layer_norm(sa_output + x)  # (bs, seq_length, dim)
 
@@ -126,6 +132,13 @@ class PiToMeDistilBertAttention(MultiHeadSelfAttention):
         k = shape(self.k_lin(key))  # (bs, n_heads, k_length, dim_per_head)
         v = shape(self.v_lin(value))  # (bs, n_heads, k_length, dim_per_head)
 
+        if not output_attentions and head_mask is None:
+            # padding becomes an additive -inf-like bias, sdpa never builds the weights
+            bias = torch.zeros(mask_reshp, dtype=q.dtype, device=q.device)
+            bias = bias.masked_fill((mask == 0).view(mask_reshp), torch.finfo(q.dtype).min)
+            context, _ = attention(q, k, v, bias=bias, dropout_p=self.dropout.p if self.training else 0.0)
+            return (self.out_lin(unshape(context)), k.mean(1))
+
         q = q / math.sqrt(dim_per_head)  # (bs, n_heads, q_length, dim_per_head)
         scores = torch.matmul(q, k.transpose(2, 3))  # (bs, n_heads, q_length, k_length)
         mask = (mask == 0).view(mask_reshp).expand_as(scores)  # (bs, n_heads, q_length, k_length)
@@ -167,13 +180,17 @@ def make_tome_class(transformer_class):
         ): 
 
             len_layers = len(self.layer)
-            self._tome_info["ratio"] = [self.ratio if i in [
+            ratios = [self.ratio if i in [
                 len_layers - 1, 
                 len_layers - 2,
                 len_layers - 3,
                 # len_layers - 6,
                 # len_layers - 9,
             ] else 1.0 for i in range(len_layers) ]
+            # indexed by layer, the last entries go to the first layers
+            self._tome_info["ratio"] = tuple(reversed(ratios))
+            if self.schedule is not None:
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len_layers)
             # self._tome_info["ratio"] = [self.ratio for i in range(len(self.layer))]
             all_hidden_states = () if output_hidden_states else None
             all_attentions = () if output_attentions else None
@@ -218,7 +235,7 @@ def make_tome_class(transformer_class):
 
 
 def apply_patch(
-   model: Transformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False):
+   model: Transformer, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_attn=False, quantize=False):
     """
     Applies PiToMe to this transformer. Afterward, set r using model.r.
 
@@ -227,6 +244,9 @@ def apply_patch(
 
     For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
     the shelf. For trianing and for evaluating MAE models off the self set this to be False.
+
+    For CPU inference set quantize to True: the Linear layers are dynamically quantized to
+    int8 and the merge scores are still computed from their fp32 outputs.
     """
     PiToMeTransformers = make_tome_class(model.__class__)
     print('using', 'pitome')
@@ -234,6 +254,7 @@ def apply_patch(
     model.__class__ = PiToMeTransformers
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'tome' 
     model._tome_info = {
@@ -258,7 +279,10 @@ def apply_patch(
             module.__class__ = PiToMeDistilBertBlock 
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         if isinstance(module, MultiHeadSelfAttention):
-            module.__class__ = PiToMeDistilBertAttention 
-
+            module.__class__ = PiToMeDistilBertAttention
+    thread_local_info(model, "_tome_info")
+    if quantize:
+        quantize_linear(model)
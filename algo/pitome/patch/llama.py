@@ -1,10 +1,12 @@
-from transformers.models.llama.modeling_llama import LlamaModel 
+from transformers.models.llama.modeling_llama import LlamaModel
 from typing import Optional, Tuple, Union
+import inspect
 import torch.nn as nn
 import torch
 from typing import List
-from ..merge import merge_source, merge_attention_mask, merge_mean, pitome_text 
-from transformers.modeling_outputs import CausalLMOutputWithPast
+from ...common.context import thread_local_info
+from ..merge import merge_source, merge_wavg, pitome_text_varlen
+from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 from transformers.utils import (
     logging,
 )
@@ -16,42 +18,263 @@ from transformers.modeling_attn_mask_utils import (
     _prepare_4d_causal_attention_mask_for_sdpa,
 )
 logger = logging.get_logger(__name__)
+from LLaVA.llava.constants import IGNORE_INDEX
 from LLaVA.llava.model.language_model.llava_llama import LlavaLlamaForCausalLM
 
 
+def make_pitome_class(model_class):
+    class PiToMeLlamaModel(model_class):
+        """
+        Modifications:
+        - During prefill, merge the image tokens after each decoder layer with a ratio < 1.
+          Kept tokens stay in their original order and keep their original position ids, so the
+          causal mask and the rotary embedding of every token are unchanged.
+        - Every layer caches the keys / values of the tokens it saw, so the layers after a merge
+          hold a shorter KV cache. The 2D mask of these prefill tokens is stored per layer and
+          extended with the mask of the generated tokens at every decode step.
+
+        Written against the Cache API of transformers 4.36 / 4.37 (the LLaVA pin).
+        """
+
+        def init_margin(self, margins):
+            # self.margin = nn.Parameter(torch.tensor(margin))
+            self.margins = margins
+
+        def compress_x(self, x, attention_mask, position_ids, image_mask, idx):
+            # batched generate pads on the left and reads the last position of every row
+            left_padded = bool((attention_mask[:, 0] == 0).any())
+            merge, weight, attention_mask = pitome_text_varlen(
+                metric=x,
+                attention_mask=attention_mask,
+                ratio=self._pitome_info["ratio"][idx],
+                margin=self.margins[idx],
+                merge_mask=image_mask,
+            )
+            if self._pitome_info["trace_source"]:
+                self._pitome_info["source"] = merge_source(
+                    merge, x, self._pitome_info["source"]
+                )
+            dtype = x.dtype
+            x, self._pitome_info["size"] = merge_wavg(merge, x, weight)
+
+            # kept tokens in order, followed by padding up to the longest sequence
+            order = merge.gather_idx[:, :merge.num_out]
+            position_ids = position_ids.gather(1, order)
+            image_mask = image_mask.gather(1, order)
+            if left_padded:
+                # move the padding back in front of the kept tokens
+                num_out = order.shape[1]
+                shift = num_out - attention_mask.sum(dim=1, keepdim=True)
+                roll = (torch.arange(num_out, device=order.device)[None] - shift) % num_out
+                order, position_ids, image_mask = order.gather(1, roll), position_ids.gather(1, roll), image_mask.gather(1, roll)
+                attention_mask = attention_mask.gather(1, roll)
+                x = x.gather(1, roll[..., None].expand(-1, -1, x.shape[-1]))
+                self._pitome_info["size"] = self._pitome_info["size"].gather(1, roll[..., None])
+                if self._pitome_info["trace_source"]:
+                    # group ids of the initial tokens follow their group
+                    source = self._pitome_info["source"]
+                    self._pitome_info["source"] = torch.where(source >= 0, (source + shift.to(source.dtype)) % num_out, source)
+            self._pitome_info["order"] = self._pitome_info["order"].gather(1, order)
+            image_mask = image_mask & attention_mask.bool()
+            return x.to(dtype), attention_mask, position_ids, image_mask
+
+        def causal_mask(self, attention_mask, batch_size, seq_length, inputs_embeds, past_length, output_attentions):
+            # same dispatch as LlamaModel.forward
+            if getattr(self, "_use_flash_attention_2", False):
+                return attention_mask if (attention_mask is not None and 0 in attention_mask) else None
+            if getattr(self, "_use_sdpa", False) and not output_attentions:
+                return _prepare_4d_causal_attention_mask_for_sdpa(
+                    attention_mask, (batch_size, seq_length), inputs_embeds, past_length
+                )
+            return _prepare_4d_causal_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_length
+            )
+
+        def forward(
+            self,
+            input_ids: torch.LongTensor = None,
+            attention_mask: Optional[torch.Tensor] = None,
+            position_ids: Optional[torch.LongTensor] = None,
+            past_key_values: Optional[List[torch.FloatTensor]] = None,
+            inputs_embeds: Optional[torch.FloatTensor] = None,
+            use_cache: Optional[bool] = None,
+            output_attentions: Optional[bool] = None,
+            output_hidden_states: Optional[bool] = None,
+            return_dict: Optional[bool] = None,
+        ) -> Union[Tuple, BaseModelOutputWithPast]:
+            output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+            output_hidden_states = (
+                output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+            )
+            use_cache = use_cache if use_cache is not None else self.config.use_cache
+            return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+            if inputs_embeds is None:
+                inputs_embeds = self.embed_tokens(input_ids)
+            batch_size, seq_length = inputs_embeds.shape[:2]
+            device = inputs_embeds.device
+
+            # the first layer never merges, its cache length is the number of tokens seen so far
+            past_length = 0
+            use_legacy_cache = False
+            if use_cache:
+                use_legacy_cache = not isinstance(past_key_values, Cache)
+                if use_legacy_cache:
+                    past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+                past_length = past_key_values.get_seq_length()
+
+            if attention_mask is None:
+                attention_mask = torch.ones(batch_size, past_length + seq_length, dtype=torch.long, device=device)
+            if position_ids is None:
+                position_ids = torch.arange(past_length, past_length + seq_length, device=device)[None]
+            position_ids = position_ids.expand(batch_size, -1)
+
+            info = self._pitome_info
+            image_mask = info["image_mask"]
+            prefill = past_length == 0
+            if prefill:
+                num_layers = len(self.layers)
+                if self.schedule is not None:
+                    info["ratio"] = self.schedule.ratios(self.ratio, num_layers)
+                else:
+                    info["ratio"] = tuple(self.ratio if i < self.merge_layers else 1.0 for i in range(num_layers))
+                info["image_mask"] = None
+                info["prefill_length"] = seq_length
+                info["kv_mask"] = []
+                info["size"] = None
+                info["source"] = None
+                info["order"] = torch.arange(seq_length, device=device).expand(batch_size, -1)
+                if image_mask is not None and seq_length > 1 and min(info["ratio"]) < 1.0:
+                    image_mask = image_mask.to(device).bool() & attention_mask.bool()
+                else:
+                    image_mask = None
+
+            mask_2d = attention_mask
+            causal_mask = self.causal_mask(mask_2d, batch_size, seq_length, inputs_embeds, past_length, output_attentions)
+            layer_masks = {}
+
+            hidden_states = inputs_embeds
+            all_hidden_states = () if output_hidden_states else None
+            all_self_attns = () if output_attentions else None
+            next_decoder_cache = None
+
+            for idx, decoder_layer in enumerate(self.layers):
+                if output_hidden_states:
+                    all_hidden_states += (hidden_states,)
+
+                layer_mask = causal_mask
+                if prefill:
+                    info["kv_mask"].append(None if mask_2d is attention_mask else mask_2d)
+                elif idx < len(info["kv_mask"]) and info["kv_mask"][idx] is not None:
+                    # this layer cached fewer prefill tokens than the mask of generate covers
+                    kv_mask = info["kv_mask"][idx]
+                    if id(kv_mask) not in layer_masks:
+                        mask = torch.cat([kv_mask.to(attention_mask.dtype), attention_mask[:, info["prefill_length"]:]], dim=1)
+                        layer_masks[id(kv_mask)] = self.causal_mask(
+                            mask, batch_size, seq_length, hidden_states, past_key_values.get_seq_length(idx), output_attentions
+                        )
+                    layer_mask = layer_masks[id(kv_mask)]
+
+                layer_outputs = decoder_layer(
+                    hidden_states,
+                    attention_mask=layer_mask,
+                    position_ids=position_ids,
+                    past_key_value=past_key_values,
+                    output_attentions=output_attentions,
+                    use_cache=use_cache,
+                )
+                hidden_states = layer_outputs[0]
+                if use_cache:
+                    next_decoder_cache = layer_outputs[2 if output_attentions else 1]
+                if output_attentions:
+                    all_self_attns += (layer_outputs[1],)
+
+                if image_mask is not None and info["ratio"][idx] < 1.0:
+                    hidden_states, mask_2d, position_ids, image_mask = self.compress_x(
+                        hidden_states, mask_2d, position_ids, image_mask, idx
+                    )
+                    causal_mask = self.causal_mask(
+                        mask_2d, batch_size, hidden_states.shape[1], hidden_states, 0, output_attentions
+                    )
+
+            if prefill:
+                info["mask"] = mask_2d
+
+            hidden_states = self.norm(hidden_states)
+            if output_hidden_states:
+                all_hidden_states += (hidden_states,)
+
+            next_cache = None
+            if use_cache:
+                next_cache = next_decoder_cache.to_legacy_cache() if use_legacy_cache else next_decoder_cache
+            if not return_dict:
+                return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
+            return BaseModelOutputWithPast(
+                last_hidden_state=hidden_states,
+                past_key_values=next_cache,
+                hidden_states=all_hidden_states,
+                attentions=all_self_attns,
+            )
+
+        def calculate_block_flop(self, shape):
+            flops = 0
+            _,N, C = shape
+            mhsa_flops = 4*N*C*C + 2*N*N*C
+            flops += mhsa_flops
+            ffn_flops = 8*N*C*C
+            flops += ffn_flops
+            return flops
+
+    return PiToMeLlamaModel
+
+
 class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
     """
-    Transformer encoder consisting of `config.num_hidden_layers` self attention layers. Each layer is a
-    [`CLIPEncoderLayer`].
-
-    Args:
-        config: CLIPConfig
+    Modifications:
+    - Record which input embeddings are image tokens, so that the patched language model
+      only merges those.
+    - Realign the labels with the merged sequence before computing the loss.
     """
-    def init_margin(self, margins):
-        # self.margin = nn.Parameter(torch.tensor(margin)) 
-        self.margins = margins 
-
-
-
-    def compress_x(self, metric, x, attn, idx):
-        ratio = self._pitome_info["ratio"].pop()
-        if ratio < 1.0:
-            merge, isolated_score = pitome_text(
-                ratio=ratio,
-                metric=metric,
-                attn=attn if self._pitome_info["use_attn"] else None,
-                margin=self.margin,
-                class_token=self._pitome_info["class_token"],
-                training=self.training
-            )
 
-            x, self._pitome_info["size"] = merge_mean(merge, x)
-            attention_mask = torch.where(attention_mask.squeeze_() >= 0, 1, 0)
-            attention_mask = merge_attention_mask(merge, attention_mask=attention_mask[..., None]).squeeze_()
+    def prepare_inputs_and_image_mask(
+        self, input_ids, position_ids, attention_mask, past_key_values, labels, images, image_sizes=None
+    ):
+        """
+        prepare_inputs_labels_for_multimodal that also stores the image token mask of the new
+        embeddings in the language model. LLaVA labels the image features (and nothing else but
+        padding) with IGNORE_INDEX, so the labels are used as a marker.
+        """
+        if images is None or input_ids is None or input_ids.shape[1] == 1:
+            return self.prepare_inputs_labels_for_multimodal(
+                input_ids, position_ids, attention_mask, past_key_values, labels, images, image_sizes
+            )
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
+        if labels is None:
+            marker = torch.zeros_like(input_ids)
         else:
-            attention_mask = torch.where(attention_mask.squeeze_() >= 0, 1, 0)
-        return x
+            marker = labels.masked_fill(labels == IGNORE_INDEX, IGNORE_INDEX - 1)
 
+        (
+            input_ids,
+            position_ids,
+            attention_mask,
+            past_key_values,
+            inputs_embeds,
+            marker
+        ) = self.prepare_inputs_labels_for_multimodal(
+            input_ids,
+            position_ids,
+            attention_mask,
+            past_key_values,
+            marker,
+            images,
+            image_sizes
+        )
+        self.get_model()._pitome_info["image_mask"] = (marker == IGNORE_INDEX) & attention_mask.bool()
+        if labels is not None:
+            labels = marker.masked_fill(marker == IGNORE_INDEX - 1, IGNORE_INDEX)
+        return input_ids, position_ids, attention_mask, past_key_values, inputs_embeds, labels
 
     def forward(
         self,
@@ -77,7 +300,7 @@ class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
                 past_key_values,
                 inputs_embeds,
                 labels
-            ) = self.prepare_inputs_labels_for_multimodal(
+            ) = self.prepare_inputs_and_image_mask(
                 input_ids,
                 position_ids,
                 attention_mask,
@@ -87,19 +310,38 @@ class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
                 image_sizes
             )
 
-        return super().forward(
+        outputs = super().forward(
             input_ids=input_ids,
             attention_mask=attention_mask,
             position_ids=position_ids,
             past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
-            labels=labels,
+            labels=None,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
-            return_dict=return_dict
+            return_dict=True
         )
 
+        loss = None
+        if labels is not None:
+            # the merged sequence is shorter, take the labels of the tokens that are left
+            info = self.get_model()._pitome_info
+            labels = labels.gather(1, info["order"]).masked_fill(info["mask"] == 0, IGNORE_INDEX)
+            logits = outputs.logits[..., :-1, :].contiguous()
+            loss = nn.functional.cross_entropy(
+                logits.view(-1, logits.shape[-1]), labels[..., 1:].reshape(-1).to(logits.device)
+            )
+        outputs = CausalLMOutputWithPast(
+            loss=loss,
+            logits=outputs.logits,
+            past_key_values=outputs.past_key_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        return outputs if return_dict else outputs.to_tuple()
+
     @torch.no_grad()
     def generate(
         self,
@@ -124,7 +366,7 @@ class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
                 _,
                 inputs_embeds,
                 _
-            ) = self.prepare_inputs_labels_for_multimodal(
+            ) = self.prepare_inputs_and_image_mask(
                 inputs,
                 position_ids,
                 attention_mask,
@@ -136,7 +378,7 @@ class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
         else:
             inputs_embeds = self.get_model().embed_tokens(inputs)
 
-        return super().generate(
+        return super(LlavaLlamaForCausalLM, self).generate(
             position_ids=position_ids,
             attention_mask=attention_mask,
             inputs_embeds=inputs_embeds,
@@ -144,45 +386,67 @@ class PiToMeLlavaLlamaForCausalLM(LlavaLlamaForCausalLM):
         )
 
 
-    def calculate_block_flop(self, shape):
-            flops = 0
-            _,N, C = shape
-            mhsa_flops = 4*N*C*C + 2*N*N*C
-            flops += mhsa_flops
-            ffn_flops = 8*N*C*C
-            flops += ffn_flops
-            return flops
+def patch_rotary(attention: nn.Module):
+    """
+    Before transformers 4.38 the rotary embedding returns its cache sliced to the KV length and
+    indexes it with the position ids. A merged layer has fewer keys than the largest position
+    id, so the whole cache is returned instead.
+    """
+    rotary = attention.rotary_emb
+    if "position_ids" in inspect.signature(rotary.forward).parameters:
+        return
+
+    class PiToMeRotaryEmbedding(rotary.__class__):
+        def forward(self, x, seq_len=None):
+            return super().forward(x, seq_len=max(seq_len or 0, self.max_seq_len_cached))
+
+    rotary.__class__ = PiToMeRotaryEmbedding
 
 
 def apply_patch(
-   model: LlamaModel, trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_k=False):
+   model: Union[LlavaLlamaForCausalLM, LlamaModel], trace_source: bool = False, prop_attn: bool = True, margin=0.9, use_k=False, merge_layers=2):
     """
-    Applies ToMe to this transformer. Afterward, set r using model.r.
+    Applies PiToMe to the language model of LLaVA (or to a LlamaModel). Afterward, set the
+    ratio using model.get_model().ratio (model.ratio for a LlamaModel).
+
+    The image tokens are merged during prefill after each of the first merge_layers decoder
+    layers (or after the layers of model.schedule), every later decode step then attends to a
+    shorter KV cache in the following layers. For a plain LlamaModel set the image token mask
+    in model._pitome_info["image_mask"] before the prefill.
 
     If you want to know the source of each token (e.g., for visualization), set trace_source = true.
     The sources will be available at model._pitome_info["source"] afterward.
-
-    For proportional attention, set prop_attn to True. This is only necessary when evaluating models off
-    the shelf. For trianing and for evaluating MAE models off the self set this to be False.
     """
     print('using', 'pitome')
 
-    model.__class__ =  PiToMeLLamaModel 
-    model.ratio = 1.0 
+    if isinstance(model, LlavaLlamaForCausalLM):
+        model.__class__ = PiToMeLlavaLlamaForCausalLM
+        model = model.get_model()
+
+    model.__class__ = make_pitome_class(model.__class__)
+    model.ratio = 1.0
     model.r=0.0
-    
-    # model.compress_method = 'pitome' 
+    model.schedule = None
+    model.merge_layers = merge_layers
+
+    # model.compress_method = 'pitome'
     model._pitome_info = {
         "ratio": model.ratio,
         "margin":  [],
         "size": None,
         "source": None,
+        "image_mask": None,
+        "kv_mask": [],
         "trace_source": trace_source,
         "prop_attn": prop_attn,
-        "class_token": True,
+        "class_token": False,
         "distill_token": False,
     }
     num_layers = len(model.layers)
     # margins = [margin - margin*(i/num_layers) for i in range(num_layers)]
     margins = [.9 - .9*(i/num_layers) for i in range(num_layers)]
     model.init_margin(margins)
+    for layer in model.layers:
+        patch_rotary(layer.self_attn)
+    thread_local_info(model, "_pitome_info")
+
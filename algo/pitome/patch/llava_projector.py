@@ -0,0 +1,46 @@
+import torch
+import torch.nn as nn
+from ...common.context import thread_local_info
+from ..merge import merge_to_budget
+
+
+def make_pitome_class(projector_class):
+    class PiToMeProjector(projector_class):
+        """
+        Modifications:
+        - Merge the vision tower features to exactly self.budget tokens per image before
+          projecting them, so every image costs the same number of LLM tokens.
+        """
+
+        def forward(self, x: torch.Tensor) -> torch.Tensor:
+            if self.budget is not None and x.dim() == 3 and x.shape[1] > self.budget:
+                x, self._pitome_info["size"] = merge_to_budget(x, self.budget, margin=self.margin)
+            return super().forward(x)
+
+    return PiToMeProjector
+
+
+def apply_patch(model: nn.Module, budget: int = 144, margin: float = 0.3):
+    """
+    Applies PiToMe between the vision tower and the mm_projector of a LLaVA model
+    (LlavaLlamaForCausalLM). Afterward, change the number of visual tokens per image
+    using model.get_model().mm_projector.budget, None disables the merge.
+
+    The anyres spatial layouts of LLaVA-1.6 reshape the projected features of every crop back
+    to its patch grid, so only the flat layout is supported.
+    """
+    print('using', 'pitome')
+
+    merge_type = getattr(model.config, "mm_patch_merge_type", "flat")
+    aspect_ratio = getattr(model.config, "image_aspect_ratio", "pad")
+    if aspect_ratio == "anyres" and not merge_type.startswith("flat"):
+        raise ValueError(f"a visual token budget needs mm_patch_merge_type flat, got {merge_type}")
+
+    projector = model.get_model().mm_projector
+    projector.__class__ = make_pitome_class(projector.__class__)
+    projector.budget = budget
+    projector.margin = margin
+    projector._pitome_info = {
+        "size": None,
+    }
+    thread_local_info(projector, "_pitome_info")
@@ -13,7 +13,10 @@
 import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 from copy import copy
-from .timm import PiToMeBlock, PiToMeAttention, PiToMeBlockUsingRatio
+from ...common.context import is_compiling, thread_local_info
+from ..merge import unmerge_source
+from ..utils import TokenPlanner, block_flop, quantize_linear
+from .timm import PiToMeBlock, PiToMeAttention, PiToMeBlockUsingRatio, checkpoint_blocks, init_windows
 import torch.nn as nn
 
 
@@ -22,18 +25,27 @@ def make_pitome_class(transformer_class):
         """
         Modifications:
         - Initialize r, token size, and token sources.
+        - unmerge_tokens restores the full token grid for dense prediction heads.
         - For MAE: make global average pooling proportional to token size
         """
 
         def forward(self, x, return_flop=True) -> torch.Tensor:
-            self._tome_info["r"] = [self.r]* len(self.blocks) 
-            self._tome_info["ratio"] = [self.ratio] * len(self.blocks) 
+            if self.schedule is not None:
+                self._tome_info["r"] = self.schedule.rs(self.r, len(self.blocks))
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len(self.blocks))
+            else:
+                self._tome_info["r"] = (self.r,) * len(self.blocks)
+                self._tome_info["ratio"] = (self.ratio,) * len(self.blocks)
             self._tome_info["size"] = None
             self._tome_info["source"] = None
+            self._tome_info["plans"] = None
             self._tome_info["isolate_score"] = None
-            self.total_flop = 0
+            self._tome_info["approx"] = self.approx
+            self._tome_info["rank"] = self.rank
+            init_windows(self)
 
             x = super().forward(x)
+            self.total_flop = self._tome_info["flops"]
             if return_flop:
                 return x, self.calculate_flop()
             else:
@@ -50,10 +62,16 @@ def make_pitome_class(transformer_class):
             x = torch.cat((cls_tokens, x), dim=1)
             x = x + self.pos_embed
             x = self.pos_drop(x)
+            # the token count, and with it the FLOPs, depends on the input resolution
+            self._tome_info["flops"] = self.planner.flops(self._tome_info["ratio"], self._tome_info["r"], x.shape[1])
+            # a traced or compiled graph keeps no references to the scratch buffers
+            self._tome_info["workspace"] = None if torch.jit.is_tracing() or is_compiling() else self.planner.workspace(self._tome_info, x.shape[0], x.device, x.shape[1])
 
-            for blk in self.blocks:
-                self.total_flop += self.calculate_block_flop(x.shape) 
-                x = blk(x)
+            if self.grad_checkpointing and self.training and not torch.jit.is_scripting():
+                x = checkpoint_blocks(self.blocks, x, self._tome_info)
+            else:
+                for block in self.blocks:
+                    x = block(x)
 
             if self.global_pool:
                 # ---- ToMe changes this ----
@@ -72,38 +90,41 @@ def make_pitome_class(transformer_class):
             return outcome
 
         
+        def unmerge_tokens(self, x: torch.Tensor) -> torch.Tensor:
+            # needs trace_source=True, maps [B, T, C] merged tokens back to the input tokens
+            return unmerge_source(x, self._tome_info["source"])
+
         def calculate_block_flop(self, shape):
-            flops = 0
             _, N, C = shape
-            mhsa_flops = 4*N*C*C + 2*N*N*C
-            flops += mhsa_flops
-            ffn_flops = 8*N*C*C
-            flops += ffn_flops
-            return flops
+            return block_flop(N, C)
 
 
         def calculate_flop(self):
-            C = self.embed_dim
-            patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1).to('cuda')
-            flops = 0
-            flops += self.total_flop 
-            return flops
+            return self.total_flop
         
 
     return PiToMeVisionTransformer
 
 
 def apply_patch(
-    model: VisionTransformer, trace_source: bool = False, prop_attn: bool = False, margin=0.9, use_k=False
+    model: VisionTransformer, trace_source: bool = False, prop_attn: bool = False, margin=0.9, use_k=False, quantize=False
 ):
     """
     Applies ToMe to this MAE transformer. Afterward, set r using model.r.
 
+    For high resolution inputs, set model.window_size (in patches) to merge inside non-overlapping
+    windows of the patch grid, and model.global_pass = True to match globally at the last merge.
+
+    For long sequences, set model.approx to "nystrom" to approximate the energy score with
+    model.rank landmark tokens.
+
     If you want to know the source of each token (e.g., for visualization), set trace_source = true.
     The sources will be available at model._tome_info["source"] afterward.
 
     For MAE models, prop_attn should be set to false.
+
+    For CPU inference set quantize to True: the Linear layers are dynamically quantized to
+    int8 and the merge scores are still computed from their fp32 outputs.
     """
 
     PiToMeVisionTransformer = make_pitome_class(model.__class__)
@@ -113,11 +134,22 @@ def apply_patch(
     model.__class__ = PiToMeVisionTransformer
     model.ratio = 1.0
     model.r = 0 
+    model.schedule = None
+    model.window_size = None
+    model.global_pass = False
+    model.approx = None
+    model.rank = 64
     model._tome_info = {
         "ratio": model.ratio,
         "size": None,
         "source": None,
         "trace_source": trace_source,
+        "workspace": None,
+        "approx": None,
+        "rank": 64,
+        "windows": None,
+        "global_layer": -1,
+        "plans": None,
         "prop_attn": False,
         "class_token": model.cls_token is not None,
         "distill_token": False,
@@ -136,6 +168,12 @@ def apply_patch(
             module.__class__ = PiToMeBlockUsingRatio if not use_k else PiToMeBlock
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         elif isinstance(module, Attention):
-            module.__class__ = PiToMeAttention
\ No newline at end of file
+            module.__class__ = PiToMeAttention
+
+    model.planner = TokenPlanner(model)
+    thread_local_info(model, "_tome_info")
+    if quantize:
+        quantize_linear(model)
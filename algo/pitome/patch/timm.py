@@ -9,14 +9,81 @@
 # --------------------------------------------------------
 
 
+from functools import partial
 from typing import Tuple
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from timm.models.vision_transformer import Attention, Block
-from ..merge import merge_source, pitome_vision, merge_wavg, merge_mean
+from ...common.attention import attention, size_bias
+from ..merge import merge_source, pitome_vision, pitome_vision_windowed, window_partition, merge_wavg, merge_mean
 
 
+def init_windows(model):
+    """
+    Sets up window-local merging for one forward pass of a patched timm ViT with
+    model.window_size (in patches, None merges globally). With model.global_pass the last
+    merging layer matches all the tokens at once.
+    """
+    info = model._tome_info
+    info["windows"] = None
+    info["global_layer"] = -1
+    if model.window_size is None:
+        return
+    if info["distill_token"]:
+        raise ValueError("window-local merging does not support a distillation token")
+    grid_size = model.patch_embed.grid_size
+    window_idx = window_partition(grid_size, model.window_size, device=model.pos_embed.device)
+    info["windows"] = (window_idx.shape[0] // model.window_size**2, window_idx)
+    if model.global_pass:
+        merging = [i for i in range(len(model.blocks)) if info["ratio"][i] < 1.0 or info["r"][i] > 0]
+        info["global_layer"] = merging[-1] if merging else -1
+
+
+def pitome_vision_block(info, layer_idx, metric, **kwargs):
+    """
+    pitome_vision for the block at layer_idx, inside the windows of info["windows"] if set.
+    Under checkpoint_blocks the plan of every layer is kept, so that the recomputation in the
+    backward pass merges exactly the same tokens.
+    """
+    plans = info.get("plans")
+    if plans is not None and layer_idx in plans:
+        return plans[layer_idx]
+    windows = info.get("windows")
+    if windows is None or layer_idx == info.get("global_layer"):
+        info["windows"] = None
+        out = pitome_vision(metric=metric, workspace=info["workspace"], **kwargs)
+    else:
+        # the merged tokens come out grouped by window
+        info["windows"] = (windows[0], None)
+        out = pitome_vision_windowed(metric=metric, num_windows=windows[0], window_idx=windows[1], **kwargs)
+    if plans is not None:
+        plans[layer_idx] = out
+    return out
+
+
+def _run_block(block, info, state, x):
+    # the recomputation in the backward pass starts from the state the forward pass saw
+    info.update(state)
+    x = block(x)
+    return x, info["size"], info["source"], info["windows"]
+
+
+def checkpoint_blocks(blocks, x, info):
+    """
+    Runs the patched blocks with activation checkpointing. Every block gets the token size,
+    sources and windows it started from as explicit state instead of reading what later blocks
+    left in info, and reuses its merge plan when it is recomputed.
+    """
+    info["plans"] = {}
+    for block in blocks:
+        state = {key: info[key] for key in ("size", "source", "windows")}
+        x, info["size"], info["source"], info["windows"] = checkpoint(
+            partial(_run_block, block, info, state), x, use_reentrant=False
+        )
+    return x
+
 
 class PiToMeBlockUsingRatio(Block):
     """
@@ -39,14 +106,18 @@ class PiToMeBlockUsingRatio(Block):
         x_attn, metric, attn = self.attn(self.norm1(x), attn_size)
         x = x + self._drop_path1(x_attn)
 
-        ratio = self._tome_info["ratio"].pop(0)
+        ratio = self._tome_info["ratio"][self.layer_idx]
         if ratio < 1.0:
-            merge, isolated_score = pitome_vision(
+            merge, isolated_score = pitome_vision_block(
+                self._tome_info,
+                self.layer_idx,
                 ratio=ratio,
                 metric=metric,
                 margin=self.margin,
                 prune=self.margin >=0.75,
-                class_token=self._tome_info["class_token"]
+                class_token=self._tome_info["class_token"],
+                approx=self._tome_info.get("approx"),
+                rank=self._tome_info.get("rank", 64),
             )
 
             if self._tome_info["trace_source"]:
@@ -85,18 +156,21 @@ class PiToMeBlock(Block):
         return self.drop_path2(x) if hasattr(self, "drop_path2") else self.drop_path(x)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        r = self._tome_info["r"].pop(0)
+        r = self._tome_info["r"][self.layer_idx]
         attn_size = self._tome_info["size"] if self._tome_info["prop_attn"] else None
-        x_attn, metric = self.attn(self.norm1(x), attn_size)
+        x_attn, metric, _ = self.attn(self.norm1(x), attn_size)
         x = x + self._drop_path1(x_attn)
         x = x + self._drop_path2(self.mlp(self.norm2(x)))
         if r > 0:
-            merge, isolated_score = pitome_vision(
+            merge, isolated_score = pitome_vision_block(
+                self._tome_info,
+                self.layer_idx,
                 r=r,
                 metric=metric,
                 margin=self.margin,
                 class_token=self._tome_info["class_token"],
-                dropout=self.merge_dropout
+                approx=self._tome_info.get("approx"),
+                rank=self._tome_info.get("rank", 64),
             )
 
             if self._tome_info["trace_source"]:
@@ -113,20 +187,19 @@ class PiToMeBlock(Block):
                 weight = self._tome_info["size"] 
                 x, self._tome_info["size"] = merge_wavg(merge, x, weight)
 
-            
-
-            return x
+        return x
 
 class PiToMeAttention(Attention):
     """
     Modifications:
     - Apply proportional attention
     - Return the mean of k over heads from attention
+    - Run on scaled_dot_product_attention, the N x N attention is only returned with need_attn=True
     """
 
     def forward(
-        self, x: torch.Tensor, isolation_score: torch.Tensor = None
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        self, x: torch.Tensor, isolation_score: torch.Tensor = None, need_attn: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # Note: this is copied from timm.models.vision_transformer.Attention with modifications.
         B, N, C = x.shape
         qkv = (
@@ -140,19 +213,17 @@ class PiToMeAttention(Attention):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
         # Apply proportional attention
-        if isolation_score is not None:
-            attn = attn +  isolation_score.log()[:, None, None, :, 0]
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        x, attn = attention(
+            q, k, v,
+            bias=size_bias(isolation_score),
+            scale=self.scale,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+            need_weights=need_attn,
+        )
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
-        # print(attn.shape)
 
         return x, k.mean(1), attn
-
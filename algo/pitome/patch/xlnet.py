@@ -14,6 +14,7 @@ from typing import Tuple
 import torch
 import torch.nn as nn
 from transformers.models.xlnet.modeling_xlnet import XLNetLayer, XLNetModel 
+from ...common.context import thread_local_info
 from ..merge import merge_source, pitome_text,merge_wavg, merge_attention_mask
 from typing import Optional, Union 
 import math
@@ -49,7 +50,7 @@ class PiToMeXLNetLayer(XLNetLayer):
             head_mask=head_mask,
             output_attentions=output_attentions,
         )
-        ratio = self._tome_info["ratio"].pop()
+        ratio = self._tome_info["ratio"][self.layer_idx]
         if output_attentions:
             sa_output, metric ,sa_weights = sa_output  # (bs, seq_length, dim), (bs, n_heads, seq_length, seq_length)
         else:  # To handle these `output_attentions` or `output_hidden_states` cases returning tuples
@@ -142,13 +143,17 @@ def make_tome_class(transformer_class):
         ): 
 
             len_layers = len(self.layer)
-            self._tome_info["ratio"] = [self.ratio if i in [
+            ratios = [self.ratio if i in [
                 len_layers - 1, 
                 len_layers - 2,
                 len_layers - 3,
                 # len_layers - 6,
                 # len_layers - 9,
             ] else 1.0 for i in range(len_layers) ]
+            # indexed by layer, the last entries go to the first layers
+            self._tome_info["ratio"] = tuple(reversed(ratios))
+            if self.schedule is not None:
+                self._tome_info["ratio"] = self.schedule.ratios(self.ratio, len_layers)
             # self._tome_info["ratio"] = [self.ratio for i in range(len(self.layer))]
             all_hidden_states = () if output_hidden_states else None
             all_attentions = () if output_attentions else None
@@ -209,6 +214,7 @@ def apply_patch(
     model.__class__ = PiToMeTransformers
     model.ratio = 1.0 
     model.r=0.0
+    model.schedule = None
     
     # model.compress_method = 'tome' 
     model._tome_info = {
@@ -232,7 +238,8 @@ def apply_patch(
             module.__class__ = PiToMeDistilBertBlock 
             module.init_margin(margins[current_layer])
             module._tome_info = model._tome_info
+            module.layer_idx = current_layer
             current_layer +=1
         if isinstance(module, MultiHeadSelfAttention):
-            module.__class__ = PiToMeDistilBertAttention 
-
+            module.__class__ = PiToMeDistilBertAttention
+    thread_local_info(model, "_tome_info")
@@ -5,12 +5,15 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
+import math
 import time
-from typing import List, Tuple, Union
+from typing import List, MutableMapping, NamedTuple, Tuple, Union
 
 import torch
 from tqdm import tqdm
 
+from .merge import Workspace
+
 
 def benchmark(
     model: torch.nn.Module,
@@ -77,6 +80,16 @@ def benchmark(
     return throughput
 
 
+def quantize_linear(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Dynamic int8 quantization of the nn.Linear layers of a patched model, in place, for CPU
+    inference. Only the Linear modules are swapped, the patched attention and block classes
+    stay, and their outputs (keys, hidden states) are dequantized to fp32, so the merge
+    scores are still computed in fp32.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
 def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> List[int]:
     """
     Process a constant r or r schedule into a list for use internally.
@@ -103,3 +116,231 @@ def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> Lis
     step = (max_val - min_val) / (num_layers - 1)
 
     return [int(min_val + step * i) for i in range(num_layers)]
+
+
+class MergeSchedule:
+    """
+    Decides which layers of a patched model merge and by how much, so that the energy score
+    does not have to be recomputed at every layer.
+
+    kind can be:
+     - "every": every layer merges with ratio / r.
+     - "every_k": one bigger merge every k layers (at layers 0, k, 2k, ...) with ratio**k and
+       k*r, so the model ends up with about the same number of tokens as with "every".
+     - "layers": only the given layers merge with ratio / r.
+     - "decreasing": the reduction per layer trends like parse_r with the given inflection,
+       -1 removes the most tokens at the first layer and none at the last one.
+
+    Set it as model.schedule on a PiToMe-patched model, None keeps the patch's own schedule.
+    """
+
+    KINDS = ("every", "every_k", "layers", "decreasing")
+
+    def __init__(self, kind: str = "every", k: int = 1, layers: Tuple[int, ...] = (), inflect: float = -1.0):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown schedule {kind}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.k = max(1, int(k))
+        self.layers = tuple(int(i) for i in layers)
+        self.inflect = float(inflect)
+
+    @classmethod
+    def parse(cls, spec: str) -> "MergeSchedule":
+        """
+        Parses a command line spec: "every", "every_k:2", "layers:0,4,8" or "decreasing:-1".
+        """
+        kind, _, arg = spec.partition(":")
+        if kind == "every_k":
+            return cls(kind, k=int(arg or 2))
+        if kind == "layers":
+            return cls(kind, layers=[int(i) for i in arg.split(",") if i])
+        if kind == "decreasing":
+            return cls(kind, inflect=float(arg or -1.0))
+        return cls(kind)
+
+    def _weights(self, num_layers: int) -> List[float]:
+        # relative amount of reduction of every layer
+        if self.kind == "every_k":
+            return [min(self.k, num_layers - i) if i % self.k == 0 else 0 for i in range(num_layers)]
+        if self.kind == "layers":
+            return [1 if i in self.layers else 0 for i in range(num_layers)]
+        if self.kind == "decreasing" and num_layers > 1:
+            low, high = 1.0 - self.inflect, 1.0 + self.inflect
+            return [low + (high - low) * i / (num_layers - 1) for i in range(num_layers)]
+        return [1] * num_layers
+
+    def ratios(self, ratio: float, num_layers: int) -> Tuple[float, ...]:
+        if self.kind == "decreasing":
+            return tuple(min(1.0, max(0.0, 1 - (1 - ratio) * w)) for w in self._weights(num_layers))
+        return tuple(ratio ** w if w > 0 else 1.0 for w in self._weights(num_layers))
+
+    def rs(self, r: int, num_layers: int) -> Tuple[int, ...]:
+        if self.kind == "decreasing":
+            return tuple(parse_r(num_layers, (int(r), self.inflect)))
+        return tuple(int(r * w) for w in self._weights(num_layers))
+
+    def __repr__(self) -> str:
+        if self.kind == "every_k":
+            return f"every_k:{self.k}"
+        if self.kind == "layers":
+            return "layers:" + ",".join(str(i) for i in self.layers)
+        if self.kind == "decreasing":
+            return f"decreasing:{self.inflect:g}"
+        return self.kind
+
+
+def block_flop(num_tokens: int, dim: int) -> float:
+    """
+    FLOPs of one transformer block on num_tokens tokens of width dim, counted like the
+    calculate_block_flop methods of the patched models.
+    """
+    mhsa_flops = 4 * num_tokens * dim * dim + 2 * num_tokens * num_tokens * dim
+    ffn_flops = 8 * num_tokens * dim * dim
+    return mhsa_flops + ffn_flops
+
+
+def vision_merge_count(
+    num_tokens: int, r: int = 0, ratio: float = 1.0, margin: float = 0.5, class_token: bool = False
+) -> int:
+    """
+    Number of tokens pitome_vision removes from num_tokens tokens, without running it.
+    """
+    if margin >= 0.45:
+        # bipartite_soft_matching
+        if r > 0:
+            return min(r, (num_tokens - int(class_token)) // 2)
+    else:
+        num_tokens = num_tokens - int(class_token)
+        if r > 0:
+            return min(r, num_tokens // 2)
+    if ratio < 1.0:
+        return math.floor(num_tokens - num_tokens * ratio)
+    return 0
+
+
+class LayerPlan(NamedTuple):
+    num_tokens: int
+    r: int
+    flops: float
+
+
+class TokenPlanner:
+    """
+    Static plan of a PiToMe-patched timm ViT (deit, mae, aug). With merging driven by
+    model.ratio or model.r, the number of tokens at every layer only depends on the input
+    length, so the per-layer token counts, r values and FLOPs are computed once per schedule.
+
+    The planner also hands out one Workspace per (B, T, device), which the patched blocks pass
+    to the merge functions so that repeated inference at a fixed shape reuses the same buffers.
+    The workspaces live in the (per-thread) info dict, so they go away with their thread.
+    """
+
+    def __init__(self, model: torch.nn.Module, num_tokens: int = None):
+        self.model = model
+        if num_tokens is None:
+            info = model._tome_info
+            num_tokens = model.patch_embed.num_patches + int(info["class_token"]) + int(info["distill_token"])
+        self.num_tokens = num_tokens
+        self._plans = {}
+
+    def num_windows(self) -> int:
+        # number of merge windows of model.window_size, 0 for global merging (see init_windows)
+        window_size = getattr(self.model, "window_size", None)
+        if window_size is None:
+            return 0
+        H, W = self.model.patch_embed.grid_size
+        return (H // window_size) * (W // window_size)
+
+    def plan(
+        self, ratios: Tuple[float, ...] = None, rs: Tuple[int, ...] = None, num_tokens: int = None
+    ) -> List[LayerPlan]:
+        """
+        Returns the input token count, number of merged tokens and FLOPs of every block.
+        ratios and rs default to the schedule of model.ratio and model.r, num_tokens to the
+        token count at the resolution of patch_embed. The patched forward passes the token
+        count of its input.
+
+        With model.window_size set, the merged tokens are counted per window like
+        pitome_vision_windowed does (class token excluded), except at the global layer of
+        model.global_pass.
+        """
+        blocks = self.model.blocks
+        if ratios is None:
+            ratios = (self.model.ratio,) * len(blocks)
+        if rs is None:
+            rs = (self.model.r,) * len(blocks)
+        num_windows = self.num_windows()
+        global_layer = -1
+        if num_windows and getattr(self.model, "global_pass", False):
+            merging = [i for i in range(len(blocks)) if ratios[i] < 1.0 or rs[i] > 0]
+            global_layer = merging[-1] if merging else -1
+        num_tokens = num_tokens or self.num_tokens
+        key = (tuple(ratios), tuple(rs), num_tokens, num_windows, global_layer)
+        if key not in self._plans:
+            class_token = self.model._tome_info["class_token"]
+            dim = self.model.embed_dim
+            layers = []
+            for i, (block, ratio, r) in enumerate(zip(blocks, ratios, rs)):
+                # PiToMeBlock is driven by r, PiToMeBlockUsingRatio by ratio
+                kwargs = {"r": int(r)} if hasattr(block, "merge_dropout") else {"ratio": ratio}
+                if num_windows and i != global_layer:
+                    T_w = (num_tokens - int(class_token)) // num_windows
+                    if "r" in kwargs:
+                        kwargs["r"] = kwargs["r"] // num_windows
+                    merged = num_windows * vision_merge_count(T_w, margin=block.margin, **kwargs)
+                else:
+                    merged = vision_merge_count(num_tokens, margin=block.margin, class_token=class_token, **kwargs)
+                    if i == global_layer:
+                        num_windows = 0
+                layers.append(LayerPlan(num_tokens, merged, block_flop(num_tokens, dim)))
+                num_tokens -= merged
+            self._plans[key] = layers
+        return self._plans[key]
+
+    def flops(self, ratios: Tuple[float, ...] = None, rs: Tuple[int, ...] = None, num_tokens: int = None) -> float:
+        return sum(layer.flops for layer in self.plan(ratios, rs, num_tokens))
+
+    def workspace(self, info: MutableMapping, batch_size: int, device: torch.device, num_tokens: int = None) -> Workspace:
+        # the scratch buffers are written during merging, every thread gets its own
+        workspaces = info.setdefault("workspaces", {})
+        key = (batch_size, num_tokens or self.num_tokens, str(device))
+        if key not in workspaces:
+            workspaces[key] = Workspace()
+        return workspaces[key]
+
+
+def count_graph_breaks(
+    model: torch.nn.Module,
+    device: torch.device = "cpu",
+    input_size: Tuple[int] = (3, 224, 224),
+    batch_size: int = 2,
+    verbose: bool = False,
+) -> int:
+    """
+    Traces the given model with torch.compile's frontend on random inputs and returns the number
+    of graph breaks, see tests/test_pitome_compile.py for a PiToMe-patched DeiT.
+
+    Args:
+     - model: the module to trace
+     - device: the device to use for tracing
+     - input_size: the input size to pass to the model (channels, h, w)
+     - batch_size: the batch size of the random input
+     - verbose: whether or not to print the reasons of the graph breaks
+
+    Returns:
+     - the number of graph breaks
+    """
+    import torch._dynamo
+
+    model = model.eval().to(device)
+    input = torch.rand(batch_size, *input_size, device=device)
+
+    torch._dynamo.reset()
+    with torch.no_grad():
+        explanation = torch._dynamo.explain(model)(input)
+
+    if verbose:
+        for reason in explanation.break_reasons:
+            print(reason.reason)
+
+    return explanation.graph_break_count
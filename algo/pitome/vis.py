@@ -13,6 +13,8 @@ import torch
 import torch.nn.functional as F
 from PIL import Image
 
+from ..common.source import source_to_dense
+
 try:
     from scipy.ndimage import binary_erosion
 except ImportError:
@@ -61,6 +63,8 @@ def make_visualization(
 
     img = np.array(img.convert("RGB")) / 255.0
     source = source.detach().cpu()
+    if source.dim() == 2:
+        source = source_to_dense(source)
 
     h, w, _ = img.shape
     ph = h // patch_size
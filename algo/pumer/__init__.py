@@ -0,0 +1,3 @@
+from . import patch, reducer
+
+__all__ = ["patch", "reducer"]
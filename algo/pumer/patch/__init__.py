@@ -0,0 +1,3 @@
+from .blip import apply_patch as blip
+
+__all__ = ["blip"]
@@ -0,0 +1,193 @@
+from types import SimpleNamespace
+from typing import Sequence
+
+import torch
+from lavis.models.med import BertEncoder, BertLayer, BertModel
+from transformers.modeling_utils import apply_chunking_to_forward
+from ...common.context import thread_local_info
+from ..reducer import TokenReducer
+
+
+def image_bias(image_mask: torch.Tensor, image_size: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    # extended encoder attention mask of the reduced image tokens, with proportional attention for the merged ones
+    bias = (1.0 - image_mask[:, None, None, :].to(dtype)) * -10000.0
+    if image_size is not None:
+        bias = bias + image_size.log()[:, None, None, :, 0].to(dtype)
+    return bias
+
+
+class PuMerBertLayer(BertLayer):
+    """
+    Modifications:
+     - Take the image tokens reduced by the previous cross-attention layers from _pumer_info
+     - Reduce the image tokens with the text-to-image cross attention (TokenReducer) for the next layers
+    """
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask=None,
+        head_mask=None,
+        encoder_hidden_states=None,
+        encoder_attention_mask=None,
+        past_key_value=None,
+        output_attentions=False,
+        mode=None,
+    ):
+        # Note: this is copied from lavis.models.med.BertLayer with modifications.
+        self_attn_past_key_value = (
+            past_key_value[:2] if past_key_value is not None else None
+        )
+        self_attention_outputs = self.attention(
+            hidden_states,
+            attention_mask,
+            head_mask,
+            output_attentions=output_attentions,
+            past_key_value=self_attn_past_key_value,
+        )
+        attention_output = self_attention_outputs[0]
+
+        outputs = self_attention_outputs[1:-1]
+        present_key_value = self_attention_outputs[-1]
+
+        if mode in ["multimodal", "fusion"] and hasattr(self, "crossattention"):
+            assert (
+                encoder_hidden_states is not None
+            ), "encoder_hidden_states must be given for cross-attention layers"
+
+            if type(encoder_hidden_states) == list:
+                # several images per text (NLVR), not reduced
+                idx = (self.layer_num - self.config.fusion_layer) % len(encoder_hidden_states)
+                cross_attention_outputs = self.crossattention(
+                    attention_output,
+                    attention_mask,
+                    head_mask,
+                    encoder_hidden_states[idx],
+                    encoder_attention_mask[idx],
+                    output_attentions=output_attentions,
+                )
+                attention_output = cross_attention_outputs[0]
+                outputs = outputs + cross_attention_outputs[1:-1]
+            else:
+                attention_output, cross_attn = self.cross_attend(
+                    attention_output, attention_mask, head_mask, encoder_hidden_states, encoder_attention_mask
+                )
+                if output_attentions:
+                    outputs = outputs + (cross_attn,)
+
+        layer_output = apply_chunking_to_forward(
+            self.feed_forward_chunk,
+            self.chunk_size_feed_forward,
+            self.seq_len_dim,
+            attention_output,
+        )
+        outputs = (layer_output,) + outputs
+
+        outputs = outputs + (present_key_value,)
+
+        return outputs
+
+    def cross_attend(self, attention_output, attention_mask, head_mask, encoder_hidden_states, encoder_attention_mask):
+        info = self._pumer_info
+        if not info["enabled"]:
+            cross_attention_outputs = self.crossattention(
+                attention_output, attention_mask, head_mask, encoder_hidden_states, encoder_attention_mask,
+                output_attentions=True,
+            )
+            return cross_attention_outputs[0], cross_attention_outputs[1]
+
+        B = encoder_hidden_states.shape[0]
+        if info["image_states"] is None:
+            # first cross-attention layer of this forward pass
+            info["image_states"] = encoder_hidden_states
+            if encoder_attention_mask is None:
+                info["image_mask"] = torch.ones(encoder_hidden_states.shape[:2], dtype=torch.long, device=encoder_hidden_states.device)
+            else:
+                info["image_mask"] = (encoder_attention_mask.reshape(B, -1) == 0).long()
+            info["image_size"] = None
+            bias = encoder_attention_mask
+        else:
+            bias = image_bias(info["image_mask"], info["image_size"], attention_output.dtype)
+
+        cross_attention_outputs = self.crossattention(
+            attention_output, attention_mask, head_mask, info["image_states"], bias, output_attentions=True,
+        )
+        attention_output, cross_attn = cross_attention_outputs[0], cross_attention_outputs[1]
+
+        # real text tokens from the (extended) self-attention mask, last query row
+        if attention_mask is None:
+            text_mask = torch.ones(attention_output.shape[:2], dtype=attention_output.dtype, device=attention_output.device)
+        else:
+            text_mask = (attention_mask[:, 0, -1] == 0).to(attention_output.dtype)
+        image_states, image_mask, _, layer_keep_info = self.reducer(
+            self.layer_num,
+            attention_output,
+            text_mask,
+            info["image_states"],
+            info["image_mask"],
+            cross_attn,
+            None,
+            image_size=info["image_size"],
+        )
+        if layer_keep_info is not None:
+            info["image_states"], info["image_mask"], info["image_size"] = image_states, image_mask, layer_keep_info[1]
+        info["image_tokens"].append(info["image_states"].shape[1])
+        return attention_output, cross_attn
+
+
+class PuMerBertEncoder(BertEncoder):
+    """
+    Modifications:
+     - Reset the reduced image tokens at the start of every forward pass
+    """
+
+    def forward(self, *args, **kwargs):
+        self._pumer_info["image_states"] = None
+        self._pumer_info["image_mask"] = None
+        self._pumer_info["image_size"] = None
+        self._pumer_info["image_tokens"] = []
+        return super().forward(*args, **kwargs)
+
+
+def apply_patch(
+    model: BertModel, prune_layers: Sequence[int] = None, keep_ratio: float = 0.9, merge_ratio: float = 0.1
+):
+    """
+    Applies PuMer to the cross-attention layers of a BLIP / ALBEF text encoder (lavis.models.med,
+    e.g. model.text_encoder), which is where the ITM re-ranking spends its compute.
+
+    At every layer in prune_layers the image tokens are pruned to keep_ratio of them by the
+    text-to-image cross attention, then merge_ratio of the kept ones are merged. The following
+    cross-attention layers attend to the reduced tokens. By default every second
+    cross-attention layer is reduced, except for the first and the last one.
+
+    Turn it off with model._pumer_info.defaults["enabled"] = False. The image token count of
+    every cross-attention layer of the last forward pass is in model._pumer_info["image_tokens"].
+    """
+    print('using', 'pumer')
+    cross_layers = [layer.layer_num for layer in model.encoder.layer if hasattr(layer, "crossattention")]
+    if prune_layers is None:
+        prune_layers = cross_layers[1:-1:2]
+
+    reducer = TokenReducer(SimpleNamespace(
+        prune_layers=list(prune_layers),
+        keep_ratio=keep_ratio,
+        merge_ratio=merge_ratio,
+        hidden_size=model.config.hidden_size,
+    ))
+    model._pumer_info = {
+        "enabled": True,
+        "image_states": None,
+        "image_mask": None,
+        "image_size": None,
+        "image_tokens": [],
+    }
+
+    model.encoder.__class__ = PuMerBertEncoder
+    model.encoder._pumer_info = model._pumer_info
+    for layer in model.encoder.layer:
+        if hasattr(layer, "crossattention"):
+            layer.__class__ = PuMerBertLayer
+            layer.reducer = reducer
+            layer._pumer_info = model._pumer_info
+    thread_local_info(model, "_pumer_info")
@@ -4,6 +4,8 @@ from typing import Callable, Tuple
 import torch
 import torch.nn as nn
 
+from ..common import rank_indices
+
 
 def do_nothing(x, mode=None):
     return x
@@ -22,9 +24,9 @@ def bipartite_diff_matching(x, attn, r, mode="mean"):
         node_min, node_idx = scores.min(
             dim=-1
         )  # for each token in a, find most similar text-relevant (attn score difference is smallest) token in b, node_min is for a, node_idx is for b
-        edge_idx = node_min.argsort(dim=-1)[..., None]  # [bs, 36, 1], get indices of top similar tokens
+        edge_idx = rank_indices(node_min, r, descending=False)[..., None]  # [bs, 36, 1], get indices of top similar tokens
 
-        unmerged_idx = edge_idx[..., r:, :]  # Unmerged Tokens, [bs, 36, 1]
+        unmerged_idx = edge_idx[..., r:, :]  # Unmerged Tokens in position order, [bs, 36, 1]
         merged_idx = edge_idx[..., :r, :]  # Merged Tokens, [bs, 8, 1], indices for most similar tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=merged_idx)  # [bs, 8, 1], merged_idx in b
 
@@ -52,14 +54,11 @@ def bipartite_weighted_matching(x, metric, attn, r, mode="mean"):
         scores[..., 0, :] = -math.inf  # cls token
 
         node_max, node_idx = scores.max(dim=-1)
-        edge_idx = node_max.argsort(dim=-1, descending=True)[
-            ..., None
-        ]  # [bs, 36, 1], get indices of top similar tokens
+        edge_idx = rank_indices(node_max, r)[..., None]  # [bs, 36, 1], get indices of top similar tokens
 
-        unmerged_idx = edge_idx[..., r:, :]  # Unmerged Tokens, [bs, 36, 1]
+        unmerged_idx = edge_idx[..., r:, :]  # Unmerged Tokens in position order, [bs, 36, 1]
         merged_idx = edge_idx[..., :r, :]  # Merged Tokens, [bs, 8, 1], indices for most similar tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=merged_idx)  # [bs, 8, 1], merged_idx in b
-        unmerged_idx = unmerged_idx.sort(dim=1)[0]  # Sort to ensure the class token is at the start
 
     src, dst = x[..., ::2, :], x[..., 1::2, :]
     n, t1, c = src.shape  # bs, 36, 768
@@ -94,7 +93,7 @@ def bipartite_soft_matching(
     r = min(r, (t - protected) // 2)
 
     if r <= 0:
-        return do_nothing, do_nothing
+        return do_nothing
 
     with torch.no_grad():
         metric = metric / metric.norm(dim=-1, keepdim=True)
@@ -107,18 +106,12 @@ def bipartite_soft_matching(
         node_max, node_idx = scores.max(
             dim=-1
         )  # for each token in a, find most similar token in b, node_max is for a, node_idx is for b
-        edge_idx = node_max.argsort(dim=-1, descending=True)[
-            ..., None
-        ]  # [bs, 99, 1], get indices of top similar tokens
+        edge_idx = rank_indices(node_max, r)[..., None]  # [bs, 99, 1], get indices of top similar tokens
 
-        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens, [bs, 91, 1]
+        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens in position order (class token first), [bs, 91, 1]
         src_idx = edge_idx[..., :r, :]  # Merged Tokens, [bs, 8, 1], indices for most similar tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)  # [bs, 8, 1], src_idx in b
 
-        if class_token:
-            # Sort to ensure the class token is at the start
-            unm_idx = unm_idx.sort(dim=1)[0]
-
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         src, dst = x[..., ::2, :], x[..., 1::2, :]
         n, t1, c = src.shape  # 1, 99, 768
@@ -267,14 +260,22 @@ class TomeMerger(nn.Module):
 
 
 class TokenReducer(nn.Module):
+    """
+    Text-informed reduction of the image tokens of a cross-attention layer, without learned
+    parameters. At every layer of config.prune_layers the image tokens the text attends
+    least to are pruned (config.keep_ratio of them are kept) and config.merge_ratio of the
+    kept tokens are merged by bipartite soft matching. The image class token is never reduced.
+    """
     def __init__(self, config):
         super().__init__()
         self.config = config
-        # merge_n = 8
-        # keep_ratio = 0.5
+        self.prune_layers = config.prune_layers
+        self.keep_ratio = config.keep_ratio
+        self.merge_ratio = getattr(config, "merge_ratio", 0.0)
 
     def forward(
-        self, layer_idx, text_states, text_mask, image_states, image_mask, cross_attn, previous_keep_mask, **kwargs
+        self, layer_idx, text_states, text_mask, image_states, image_mask, cross_attn, previous_keep_mask,
+        image_size=None, **kwargs
     ):
         layer_keep_info = None
         if not self.prune_layers or layer_idx not in self.prune_layers or not self.config.keep_ratio:
@@ -283,29 +284,35 @@ class TokenReducer(nn.Module):
         we use cross attention to remove and combine tokens
         """
         batch_size = text_states.shape[0]
-        # text_len = text_states.shape[1]
         image_len = image_states.shape[1]  # include cls
         image_hidden_size = image_states.shape[-1]
         image_states_no_cls = image_states[:, 1:]
         cls_states = image_states[:, :1]
         cls_mask = image_mask[:, :1]
         t_len = text_mask.sum(1, keepdim=True).unsqueeze(-1)
-
-        # elif self.config.prune_method == "all_heads":
-        # txt2img_attention = attention[:, :, :text_len, text_len + 1 :]
-        attn_scores = (cross_attn.sum(2) / t_len).transpose(1, 2)
-        token_scores = attn_scores
-        # elif self.config.prune_method == "first_head":
-        #     # txt2img_attention = attention[:, :, :text_len, text_len + 1 :]
-        #     # aggregate across text tokens for the first attention head
-        #     attn_scores = (cross_attn[:, 0].sum(1) / t_len).unsqueeze(-1)
-        #     token_scores = token_predictor(attn_scores)
-        # elif self.config.prune_method == "mean_head":
-        #     # aggregate across text tokens for all attention heads
-        #     # txt2img_attention = attention[:, :, :text_len, text_len + 1 :]
-        #     attn_scores = (cross_attn.mean(1).sum(1) / t_len).unsqueeze(-1)
-
-        new_img_states, new_img_mask = None, None
-        # TODO: use remover and combiner to do reduction
-
-        return new_img_states, new_img_mask, previous_keep_mask, layer_keep_info
\ No newline at end of file
+        if image_size is None:
+            image_size = torch.ones_like(image_states[..., 0, None])
+
+        # text-to-image attention of every image token, over the real text tokens and all heads
+        attn_scores = ((cross_attn * text_mask[:, None, :, None]).sum(2) / t_len).transpose(1, 2)  # [B, N, H]
+        token_scores = attn_scores.mean(-1)
+        scores = token_scores[:, 1:].masked_fill(image_mask[:, 1:] == 0, -math.inf)
+
+        # pruning, the kept tokens stay in position order
+        num_keep_tokens = max(1, int((image_len - 1) * self.keep_ratio))
+        keep_idx = torch.topk(scores, num_keep_tokens, dim=-1).indices.sort(dim=-1).values
+        t_idx = keep_idx.unsqueeze(2).expand(batch_size, num_keep_tokens, image_hidden_size)
+        new_img_states = torch.cat([cls_states, image_states_no_cls.gather(1, t_idx)], dim=1)
+        new_img_mask = torch.cat([cls_mask, image_mask[:, 1:].gather(1, keep_idx)], dim=1)
+        new_img_size = torch.cat([image_size[:, :1], image_size[:, 1:].gather(1, keep_idx[..., None])], dim=1)
+
+        # merging the most similar kept tokens
+        r = int(new_img_states.shape[1] * self.merge_ratio)
+        if r > 0:
+            merge = bipartite_soft_matching(new_img_states, r, class_token=True)
+            new_img_mask = merge(new_img_mask[..., None].to(new_img_states.dtype), mode="amax")[..., 0].long()
+            new_img_states, new_img_size = merge_wavg(merge, new_img_states, new_img_size)
+
+        previous_keep_mask = keep_idx
+        layer_keep_info = (token_scores, new_img_size)
+        return new_img_states, new_img_mask, previous_keep_mask, layer_keep_info
@@ -10,6 +10,9 @@ from typing import Callable, Tuple
 import torch
 import torch.nn.functional as F
 
+from ..common import rank_indices
+from ..common.source import initial_source, one_hot_token_map, remap_source, unmerge_token_map
+
 
 def do_nothing(x, mode=None):
     return x
@@ -48,15 +51,12 @@ def bipartite_soft_matching(
             scores[..., 0, :] = -math.inf
 
         node_max, node_idx = scores.max(dim=-1)
-        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        edge_idx = rank_indices(node_max, r)[..., None]
 
-        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
+        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens, in position order so the class token stays first
         src_idx = edge_idx[..., :r, :]  # Merged Tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
 
-        if class_token:
-            unm_idx = unm_idx.sort(dim=1)[0]
-
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         src, dst = x[..., ::2, :], x[..., 1::2, :]
         n, t1, c = src.shape
@@ -78,7 +78,19 @@ def bipartite_soft_matching(
 
         return torch.cat([unm, dst], dim=1)
 
-    return merge, None
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        n, _, c = unm.shape
+        src = dst.gather(dim=-2, index=dst_idx.expand(n, r, c))
+        out = torch.zeros(n, metric.shape[1], c, device=x.device, dtype=x.dtype)
+        out[..., 1::2, :] = dst
+        out.scatter_(dim=-2, index=(2 * unm_idx).expand(n, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=(2 * src_idx).expand(n, r, c), src=src)
+
+        return out
+
+    return merge, unmerge
 
 
 def kth_bipartite_soft_matching(
@@ -208,18 +220,24 @@ def merge_wavg(
 
 
 def merge_source(
-    merge: Callable, x: torch.Tensor, source: torch.Tensor = None, mode='amax'
+    merge: Callable, x: torch.Tensor, source: torch.Tensor = None, unmerge: Callable = None, mode='amax'
 ) -> torch.Tensor:
     """
-    For source tracking. Source is an adjacency matrix between the initial tokens and final merged groups.
-    x is used to find out how many tokens there are in case the source is None.
+    For source tracking, updates the group ids of common.source with this merge. The token map
+    comes from unmerge if given, except in prune mode. x is used to find out how many tokens
+    there are in case the source is None.
     """
     if source is None:
-        n, t, _ = x.shape
-        source = torch.eye(t, device=x.device)[None, ...].expand(n, t, t)
+        source = initial_source(x)
 
-    source = merge(source, mode=mode)
-    return source
+    if merge is do_nothing:
+        return source
+
+    if unmerge is not None and mode != 'prune':
+        token_map = unmerge_token_map(merge, unmerge, x)
+    else:
+        token_map = one_hot_token_map(merge, x, mode=mode)
+    return remap_source(source, token_map)
 
 def merge_attention_mask(
     merge, attention_mask: torch.Tensor
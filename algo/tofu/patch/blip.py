@@ -16,7 +16,7 @@ class ToFuBlock(Block):
     def compress_x(self, metric, x):
         ratio = self._tofu_info["ratio"].pop()
         if ratio < 1.0:
-            merge, isolated_score = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 ratio=ratio,
                 metric=metric,
                 class_token=self._tofu_info["class_token"]
@@ -24,7 +24,7 @@ class ToFuBlock(Block):
 
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"], mode='amax' if self.strategy != 'prune' else 'prune'
+                    merge, x, self._tofu_info["source"], unmerge, mode='amax' if self.strategy != 'prune' else 'prune'
                 )
             x = merge(x, mode=self.strategy)
         return x
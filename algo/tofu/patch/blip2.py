@@ -17,7 +17,7 @@ class ToFuBlock(Block):
     def compress_x(self, metric, x):
         ratio = self._tofu_info["ratio"].pop(0)
         if ratio < 1.0:
-            merge, isolated_score = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 ratio=ratio,
                 metric=metric,
                 class_token=self._tofu_info["class_token"]
@@ -25,7 +25,7 @@ class ToFuBlock(Block):
 
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"]
+                    merge, x, self._tofu_info["source"], unmerge
                 )
 
             x = merge(x, mode=self.strategy)
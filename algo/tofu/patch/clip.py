@@ -14,7 +14,7 @@ class ToFuBlock(ResidualAttentionBlock):
     def compress_x(self, metric, x):
         ratio = self._tofu_info["ratio"].pop()
         if ratio < 1.0:
-            merge, isolated_score = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 ratio=ratio,
                 metric=metric,
                 class_token=self._tofu_info["class_token"]
@@ -22,7 +22,7 @@ class ToFuBlock(ResidualAttentionBlock):
 
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"]
+                    merge, x, self._tofu_info["source"], unmerge
                 )
 
 
@@ -23,7 +23,7 @@ class ToFuCLIPEncoder(CLIPEncoder):
     def compress_x(self, metric, x, attn, idx):
         ratio = self._tofu_info["ratio"].pop()
         if ratio < 1.0:
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 ratio=ratio,
                 metric=metric,
                 class_token=self._tofu_info["class_token"]
@@ -31,7 +31,7 @@ class ToFuCLIPEncoder(CLIPEncoder):
 
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"]
+                    merge, x, self._tofu_info["source"], unmerge
                 )
             x = merge(x, mode=self.strategies[idx])
         return x
@@ -41,7 +41,7 @@ class ToFuBlock(Block):
         r = self._tofu_info["r"].pop(0)
         if r > 0:
             # Apply ToFu here
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 metric=metric,
                 r=r,
                 class_token=self._tofu_info["class_token"],
@@ -49,7 +49,7 @@ class ToFuBlock(Block):
             )
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"]
+                    merge, x, self._tofu_info["source"], unmerge
                 )
             x, self._tofu_info["size"] = merge(x, mode=self.strategy)
 
@@ -82,7 +82,7 @@ class ToFuBlockUsingRatio(Block):
         ratio = self._tofu_info["ratio"].pop(0)
         if ratio < 1.0:
             # Apply ToFu here
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 metric=metric,
                 ratio=ratio,
                 class_token=self._tofu_info["class_token"],
@@ -91,7 +91,7 @@ class ToFuBlockUsingRatio(Block):
 
             if self._tofu_info["trace_source"]:
                 self._tofu_info["source"] = merge_source(
-                    merge, x, self._tofu_info["source"]
+                    merge, x, self._tofu_info["source"], unmerge
                 )
 
             x = merge(x, mode=self.strategy)
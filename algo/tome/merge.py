@@ -10,6 +10,9 @@ from typing import Callable, Tuple
 import torch
 import torch.nn.functional as F
 
+from ..common import rank_indices
+from ..common.source import initial_source, one_hot_token_map, remap_source, unmerge_token_map
+
 
 def do_nothing(x, mode=None):
     return x
@@ -49,15 +52,12 @@ def bipartite_soft_matching(
             scores[..., 0, :] = -math.inf
 
         node_max, node_idx = scores.max(dim=-1)
-        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        edge_idx = rank_indices(node_max, r)[..., None]
 
-        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
+        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens, in position order so the class token stays first
         src_idx = edge_idx[..., :r, :]  # Merged Tokens
         dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
 
-        if class_token:
-            unm_idx = unm_idx.sort(dim=1)[0]
-
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
         src, dst = x[..., ::2, :], x[..., 1::2, :]
         n, t1, c = src.shape
@@ -211,18 +211,24 @@ def merge_wavg(
 
 
 def merge_source(
-    merge: Callable, x: torch.Tensor, source: torch.Tensor = None
+    merge: Callable, x: torch.Tensor, source: torch.Tensor = None, unmerge: Callable = None
 ) -> torch.Tensor:
     """
-    For source tracking. Source is an adjacency matrix between the initial tokens and final merged groups.
-    x is used to find out how many tokens there are in case the source is None.
+    For source tracking, updates the group ids of common.source with this merge. The token map
+    comes from unmerge if given. x is used to find out how many tokens there are in case the
+    source is None.
     """
     if source is None:
-        n, t, _ = x.shape
-        source = torch.eye(t, device=x.device)[None, ...].expand(n, t, t)
+        source = initial_source(x)
 
-    source = merge(source, mode="amax")
-    return source
+    if merge is do_nothing:
+        return source
+
+    if unmerge is not None:
+        token_map = unmerge_token_map(merge, unmerge, x)
+    else:
+        token_map = one_hot_token_map(merge, x)
+    return remap_source(source, token_map)
 
 def merge_attention_mask(
     merge, attention_mask: torch.Tensor
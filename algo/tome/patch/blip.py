@@ -21,7 +21,7 @@ class ToMeBlock(Block):
 
         if self._tome_info["trace_source"]:
             self._tome_info["source"] = merge_source(
-                merge, x, self._tome_info["source"]
+                merge, x, self._tome_info["source"], unmerge=isolated_score
             )
         if isolated_score is not None and self._tome_info["size"] is not None:
             weight = self._tome_info["size"] + isolated_score
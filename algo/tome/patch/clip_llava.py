@@ -17,7 +17,7 @@ class ToMeCLIPEncoder(CLIPEncoder):
     def compress_x(self, metric, x, attn, idx):
         ratio = self._tome_info["ratio"].pop()
         if ratio < 1.0:
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 ratio=ratio,
                 metric=metric,
                 class_token=self._tome_info["class_token"]
@@ -25,7 +25,7 @@ class ToMeCLIPEncoder(CLIPEncoder):
 
             if self._tome_info["trace_source"]:
                 self._tome_info["source"] = merge_source(
-                    merge, x, self._tome_info["source"]
+                    merge, x, self._tome_info["source"], unmerge
                 )
             x = merge(x, mode='mean')
         return x
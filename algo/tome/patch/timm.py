@@ -40,7 +40,7 @@ class ToMeBlock(Block):
         r = self._tome_info["r"].pop(0)
         if r > 0:
             # Apply ToMe here
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 metric,
                 r=r,
                 class_token=self._tome_info["class_token"],
@@ -48,7 +48,7 @@ class ToMeBlock(Block):
             )
             if self._tome_info["trace_source"]:
                 self._tome_info["source"] = merge_source(
-                    merge, x, self._tome_info["source"]
+                    merge, x, self._tome_info["source"], unmerge
                 )
             x, self._tome_info["size"] = merge_wavg(merge, x, self._tome_info["size"])
 
@@ -76,7 +76,7 @@ class ToMeBlockUsingRatio(Block):
 
         ratio = self._tome_info["ratio"].pop(0)
         if ratio < 1.0:
-            merge, _ = bipartite_soft_matching(
+            merge, unmerge = bipartite_soft_matching(
                 metric=metric,
                 ratio=ratio,
                 class_token=self._tome_info["class_token"],
@@ -85,7 +85,7 @@ class ToMeBlockUsingRatio(Block):
 
             if self._tome_info["trace_source"]:
                 self._tome_info["source"] = merge_source(
-                    merge, x, self._tome_info["source"]
+                    merge, x, self._tome_info["source"], unmerge
                 )
             x, self._tome_info["size"] = merge_wavg(merge, x, self._tome_info["size"])
 
@@ -0,0 +1,63 @@
+# --------------------------------------------------------
+# Explicit attention vs. the sdpa path of algo.common.attention.
+#
+# Run from the repository root:
+#   python -m benchmarks.attention --device cuda
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict, Tuple
+
+import torch
+
+from algo.common.attention import attention, size_bias
+
+
+def benchmark_attention(
+    num_tokens: int = 577,
+    dim: int = 64,
+    num_heads: int = 12,
+    batch_size: int = 8,
+    device: torch.device = "cpu",
+    runs: int = 10,
+    verbose: bool = True,
+) -> Dict[str, Tuple[float, float]]:
+    """
+    Compares the explicit attention with the sdpa path and a size bias.
+    Returns {method: (milliseconds per call, max abs difference to the explicit output)}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    q, k, v = torch.randn(3, batch_size, num_heads, num_tokens, dim, device=device).unbind(0)
+    bias = size_bias(torch.randint(1, 4, (batch_size, num_tokens, 1), device=device).float())
+    reference, _ = attention(q, k, v, bias, need_weights=True)
+
+    methods = {
+        "explicit": lambda: attention(q, k, v, bias, need_weights=True)[0],
+        "sdpa": lambda: attention(q, k, v, bias)[0],
+    }
+    results = {}
+    with torch.no_grad():
+        for name, fn in methods.items():
+            error = (fn() - reference).abs().max().item()
+            if is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn()
+            if is_cuda:
+                torch.cuda.synchronize()
+            results[name] = ((time.perf_counter() - start) * 1000 / runs, error)
+            if verbose:
+                print(f"T={num_tokens} {name}: {results[name][0]:.2f} ms, max err {error:.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("attention benchmark")
+    parser.add_argument("--num_tokens", default=577, type=int)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--runs", default=10, type=int)
+    args = parser.parse_args()
+    benchmark_attention(num_tokens=args.num_tokens, batch_size=args.batch_size, device=args.device, runs=args.runs)
@@ -0,0 +1,79 @@
+# --------------------------------------------------------
+# Decode step time of a PiToMe-patched BART against the encoder ratio.
+#
+# Run from the repository root:
+#   python -m benchmarks.bart_decode --model facebook/bart-base --ratios 1.0 0.9 0.8 0.7
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict, Tuple
+
+import torch
+from transformers import BartModel
+
+from algo.pitome import patch
+
+
+def benchmark_decode(
+    model: BartModel,
+    ratios: Tuple[float, ...] = (1.0, 0.9, 0.8, 0.7),
+    batch_size: int = 4,
+    num_tokens: int = 1024,
+    steps: int = 64,
+    device: torch.device = "cpu",
+    verbose: bool = True,
+) -> Dict[float, Tuple[int, float]]:
+    """
+    Times the decoder steps of a patched BartModel against the encoder ratio, with the encoder
+    output and the cross-attention keys computed once like in generate().
+    Returns {ratio: (encoder tokens left, milliseconds per decode step)}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    model = model.eval().to(device)
+    input_ids = torch.randint(4, model.config.vocab_size, (batch_size, num_tokens), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    start_ids = torch.full((batch_size, 1), model.config.decoder_start_token_id, device=device)
+
+    results = {}
+    with torch.no_grad():
+        for ratio in ratios:
+            model.encoder.ratio = ratio
+            encoder_outputs = model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+            past_key_values = None
+            for step in range(steps + 1):
+                if step == 1:
+                    # the first step builds the cross-attention cache
+                    if is_cuda:
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                out = model(
+                    attention_mask=attention_mask, encoder_outputs=encoder_outputs, decoder_input_ids=start_ids,
+                    past_key_values=past_key_values, use_cache=True,
+                )
+                past_key_values = out.past_key_values
+            if is_cuda:
+                torch.cuda.synchronize()
+            results[ratio] = (
+                encoder_outputs.last_hidden_state.shape[1],
+                (time.perf_counter() - start) * 1000 / steps,
+            )
+            if verbose:
+                print(f"ratio={ratio} tokens={results[ratio][0]}: {results[ratio][1]:.2f} ms / step")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("bart decode benchmark")
+    parser.add_argument("--model", default="facebook/bart-base")
+    parser.add_argument("--ratios", default=[1.0, 0.9, 0.8, 0.7], type=float, nargs="+")
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--num_tokens", default=1024, type=int)
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    model = BartModel.from_pretrained(args.model)
+    patch.bart(model)
+    benchmark_decode(
+        model, tuple(args.ratios), batch_size=args.batch_size, num_tokens=args.num_tokens, device=args.device
+    )
@@ -0,0 +1,13 @@
+# --------------------------------------------------------
+# Inputs shared by the benchmark scripts.
+# --------------------------------------------------------
+
+import torch
+
+
+def clustered_tokens(batch_size: int, num_tokens: int, dim: int, num_clusters: int = 16) -> torch.Tensor:
+    # random tokens around a few centers, closer to real patch features than isotropic noise
+    centers = torch.randn(batch_size, num_clusters, dim)
+    assign = torch.randint(0, num_clusters, (batch_size, num_tokens))
+    x = centers.gather(1, assign[..., None].expand(-1, -1, dim)) + 0.5 * torch.randn(batch_size, num_tokens, dim)
+    return torch.nn.functional.normalize(x, dim=-1)
@@ -0,0 +1,78 @@
+# --------------------------------------------------------
+# FFT round trip vs. the cached DCT basis matmul of algo.dct.merge.dc_transform.
+#
+# Run from the repository root:
+#   python -m benchmarks.dct --device cuda
+# --------------------------------------------------------
+
+import argparse
+import math
+import time
+from typing import Dict, Tuple
+
+import torch
+
+from algo.dct.merge import dc_transform, dct, idct
+
+
+def _fft_transform(x: torch.Tensor, kept: int) -> torch.Tensor:
+    # reference: full DCT over the tokens, truncation, inverse DCT over the kept positions
+    x_dct = dct(x.float().transpose(1, 2), norm='ortho')[..., :kept]
+    return idct(x_dct, norm='ortho').transpose(1, 2).to(x.dtype)
+
+
+def benchmark_dc_transform(
+    token_counts: Tuple[int, ...] = (196, 576, 2880),
+    dim: int = 768,
+    ratio: float = 0.9,
+    batch_size: int = 32,
+    device: torch.device = "cpu",
+    dtype: torch.dtype = torch.float32,
+    runs: int = 20,
+    verbose: bool = True,
+) -> Dict[int, Tuple[float, float, float]]:
+    """
+    Times the FFT round trip against dc_transform (one matmul with the cached basis) for one
+    layer, and checks that they agree. Returns {T: (fft ms, basis ms, max abs difference)}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    results = {}
+
+    def timeit(fn):
+        fn()
+        if is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn()
+        if is_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) * 1000 / runs
+
+    with torch.no_grad():
+        for T in token_counts:
+            x = torch.randn(batch_size, T, dim, device=device, dtype=dtype)
+            kept = math.ceil(T * ratio)
+            error = (_fft_transform(x, kept).float() - dc_transform(x, ratio=ratio, class_token=False).float()).abs().max().item()
+            results[T] = (
+                timeit(lambda: _fft_transform(x, kept)),
+                timeit(lambda: dc_transform(x, ratio=ratio, class_token=False)),
+                error,
+            )
+            if verbose:
+                print(f"T={T} fft: {results[T][0]:.2f} ms, basis: {results[T][1]:.2f} ms, error: {error:.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("dct benchmark")
+    parser.add_argument("--token_counts", default=[196, 576, 2880], type=int, nargs="+")
+    parser.add_argument("--ratio", default=0.9, type=float)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--runs", default=20, type=int)
+    args = parser.parse_args()
+    benchmark_dc_transform(
+        token_counts=tuple(args.token_counts), ratio=args.ratio, batch_size=args.batch_size,
+        device=args.device, runs=args.runs,
+    )
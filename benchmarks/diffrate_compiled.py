@@ -0,0 +1,67 @@
+# --------------------------------------------------------
+# Throughput of a DiffRate-patched DeiT at a fixed schedule before and after
+# compile_static.
+#
+# Run from the repository root:
+#   python -m benchmarks.diffrate_compiled --schedule schedule.json
+# --------------------------------------------------------
+
+import argparse
+import copy
+from typing import Dict, Tuple
+
+import timm
+import torch
+import torch.nn as nn
+
+from algo.DiffRate import patch
+from algo.DiffRate.compile import compile_static, load_schedule
+from algo.DiffRate.utils import benchmark
+
+
+def benchmark_compiled(
+    model: nn.Module,
+    device: torch.device = 0,
+    input_size: Tuple[int] = (3, 224, 224),
+    batch_size: int = 64,
+    runs: int = 40,
+    use_fp16: bool = False,
+    verbose: bool = True,
+) -> Dict[str, float]:
+    '''
+    Throughput of a DiffRate-patched model at its current schedule before and after
+    compile_static, measured with utils.benchmark on a compiled copy. Also returns the
+    number of architecture parameters removed.
+    '''
+    compiled = compile_static(copy.deepcopy(model))
+    params = sum(p.numel() for p in nn.Module.parameters(model))
+    params_compiled = sum(p.numel() for p in nn.Module.parameters(compiled))
+
+    results = {"params_removed": params - params_compiled}
+    for name, m in (("searched", model), ("compiled", compiled)):
+        results[name] = benchmark(
+            m, device=device, input_size=input_size, batch_size=batch_size, runs=runs, use_fp16=use_fp16
+        )
+        if verbose:
+            print(f"{name}: {results[name]:.2f} im/s")
+    if verbose:
+        print(f"architecture parameters removed: {results['params_removed']}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("diffrate compile benchmark")
+    parser.add_argument("--model", default="deit_small_patch16_224")
+    parser.add_argument("--schedule", default="", help="schedule written by export_schedule, otherwise --r per layer")
+    parser.add_argument("--r", default=13, type=int)
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    model = timm.create_model(args.model)
+    patch.deit(model)
+    if args.schedule:
+        model.set_kept_num(*load_schedule(args.schedule))
+    else:
+        model.init_kept_num_using_r(args.r)
+    benchmark_compiled(model, device=args.device, batch_size=args.batch_size)
@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Exact PiToMe energy score vs. its nystrom approximation.
+#
+# Run from the repository root:
+#   python -m benchmarks.energy_score --num_tokens 2880 --device cuda
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict
+
+import torch
+
+from algo.pitome.merge import approx_energy_score, energy_score
+from benchmarks.common import clustered_tokens
+
+
+def benchmark_energy_score(
+    num_tokens: int = 2880,
+    dim: int = 64,
+    rank: int = 64,
+    batch_size: int = 4,
+    device: torch.device = "cpu",
+    runs: int = 10,
+    verbose: bool = True,
+) -> Dict[str, float]:
+    """
+    Times the exact energy score against the nystrom approximation.
+    Returns {method: milliseconds per call}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    x = clustered_tokens(batch_size, num_tokens, dim).to(device)
+    methods = {
+        "exact": lambda: energy_score(x, 0.3, chunk_size=128),
+        "nystrom": lambda: approx_energy_score(x, 0.3, approx="nystrom", rank=rank),
+    }
+    results = {}
+    with torch.no_grad():
+        for name, fn in methods.items():
+            fn()
+            if is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn()
+            if is_cuda:
+                torch.cuda.synchronize()
+            results[name] = (time.perf_counter() - start) * 1000 / runs
+            if verbose:
+                print(f"T={num_tokens} {name}: {results[name]:.2f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("energy score benchmark")
+    parser.add_argument("--num_tokens", default=2880, type=int)
+    parser.add_argument("--rank", default=64, type=int)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--runs", default=10, type=int)
+    args = parser.parse_args()
+    benchmark_energy_score(
+        num_tokens=args.num_tokens, rank=args.rank, batch_size=args.batch_size, device=args.device, runs=args.runs
+    )
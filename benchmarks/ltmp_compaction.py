@@ -0,0 +1,55 @@
+# --------------------------------------------------------
+# Throughput of an LTMP model with the masked forward vs. the compacting
+# inference path, with the mean number of tokens left after every block.
+#
+# Run from the repository root:
+#   python -m benchmarks.ltmp_compaction --model ltpm_deit_small_patch16_224
+# --------------------------------------------------------
+
+import argparse
+from typing import Dict, Tuple
+
+import timm
+import torch
+
+from algo.ltmp.patch.timm import compact_inference
+from algo.ltmp.utils import benchmark
+
+
+def benchmark_compaction(
+    model: torch.nn.Module,
+    device: torch.device = 0,
+    input_size: Tuple[int] = (3, 224, 224),
+    batch_size: int = 64,
+    runs: int = 40,
+    verbose: bool = True,
+) -> Dict[str, object]:
+    """
+    Throughput of an LTPM model with the masked forward against the compacting inference
+    path (compact_inference), with the mean number of tokens left after every block.
+    """
+    compact_inference(model, False)
+    masked = benchmark(model, device=device, input_size=input_size, batch_size=batch_size, runs=runs)
+    compact_inference(model, True)
+    compacted = benchmark(model, device=device, input_size=input_size, batch_size=batch_size, runs=runs)
+    tokens = [count.float().mean().item() for count in model.token_counts]
+    compact_inference(model, False)
+
+    if verbose:
+        print(f"masked: {masked:.2f} im/s, compact: {compacted:.2f} im/s")
+        print("tokens per block: " + ", ".join(f"{t:.1f}" for t in tokens))
+    return {"masked": masked, "compact": compacted, "tokens": tokens}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("ltmp compaction benchmark")
+    parser.add_argument("--model", default="ltpm_deit_small_patch16_224")
+    parser.add_argument("--checkpoint", default="", help="trained LTMP thresholds, random weights otherwise")
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    model = timm.create_model(args.model)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    benchmark_compaction(model, device=args.device, batch_size=args.batch_size)
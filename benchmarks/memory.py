@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Peak CUDA memory of a PiToMe-patched BERT classifier.
+#
+# Run from the repository root:
+#   python -m benchmarks.memory --ratio 0.9 --backward
+# --------------------------------------------------------
+
+import argparse
+from typing import Dict
+
+import torch
+from transformers import BertForSequenceClassification
+
+from algo.pitome import patch
+
+
+def benchmark_memory(
+    model: torch.nn.Module,
+    inputs: Dict[str, torch.Tensor],
+    device: torch.device = 0,
+    backward: bool = False,
+    verbose: bool = False,
+) -> float:
+    """
+    Peak CUDA memory in MB of one forward pass (and backward pass if backward=True).
+
+    inputs are passed to model as keyword arguments, e.g. the tokenizer output of a text model:
+    benchmark_memory(model, {"input_ids": torch.randint(0, 30522, (24, 512))}) is the IMDB
+    setting of tc/engine.py. The model's parameters are counted as well.
+    """
+    device = torch.device(device)
+    model = model.to(device).train(backward)
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    with torch.set_grad_enabled(backward):
+        out = model(**inputs)
+        if backward:
+            out = out[0] if isinstance(out, (tuple, list)) else getattr(out, "logits", out)
+            out.float().sum().backward()
+    torch.cuda.synchronize(device)
+
+    peak = torch.cuda.max_memory_allocated(device) / 2**20
+    if verbose:
+        print(f"peak memory: {peak:.0f} MB")
+    return peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("memory benchmark")
+    parser.add_argument("--model", default="bert-base-uncased")
+    parser.add_argument("--ratio", default=1.0, type=float)
+    parser.add_argument("--batch_size", default=24, type=int)
+    parser.add_argument("--seq_len", default=512, type=int)
+    parser.add_argument("--backward", action="store_true")
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    model = BertForSequenceClassification.from_pretrained(args.model)
+    patch.bert(model.bert.encoder)
+    model.bert.encoder.ratio = args.ratio
+    inputs = {"input_ids": torch.randint(0, model.config.vocab_size, (args.batch_size, args.seq_len))}
+    benchmark_memory(model, inputs, device=args.device, backward=args.backward, verbose=True)
@@ -0,0 +1,78 @@
+# --------------------------------------------------------
+# CPU latency of a PiToMe-patched DeiT in eager mode, as a TorchScript trace
+# and as an onnxruntime session of its ONNX export.
+#
+# Run from the repository root (needs onnx and onnxruntime):
+#   python -m benchmarks.onnx_export --ratio 0.9
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict, Tuple, Union
+
+import timm
+import torch
+import torch.nn as nn
+
+from algo.pitome import patch
+from algo.pitome.export import ExportWrapper, _as_tuple, export_mode, export_onnx, trace
+
+
+def _ort_session(path: str):
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ImportError("benchmarking an ONNX export needs onnxruntime: pip install onnxruntime")
+    return ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+
+def benchmark_onnx(
+    model: nn.Module,
+    example_inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    path: str,
+    runs: int = 20,
+    verbose: bool = True,
+    **kwargs,
+) -> Dict[str, float]:
+    """
+    CPU latency of the eager patched model, its TorchScript trace and its onnxruntime export
+    at the current ratio / schedule. Returns {backend: milliseconds per call}.
+    """
+    example_inputs = tuple(x.cpu() for x in _as_tuple(example_inputs))
+    model = model.cpu()
+    export_onnx(model, example_inputs, path, **kwargs)
+    session = _ort_session(path)
+    feeds = {i.name: x.numpy() for i, x in zip(session.get_inputs(), example_inputs)}
+    traced = trace(model, example_inputs, **kwargs)
+
+    results = {}
+    with export_mode(model), torch.no_grad():
+        eager = ExportWrapper(model, **kwargs)
+        backends = {
+            "eager": lambda: eager(*example_inputs),
+            "torchscript": lambda: traced(*example_inputs),
+            "onnxruntime": lambda: session.run(None, feeds),
+        }
+        for name, fn in backends.items():
+            fn()
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn()
+            results[name] = (time.perf_counter() - start) * 1000 / runs
+            if verbose:
+                print(f"{name}: {results[name]:.2f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("onnx export benchmark")
+    parser.add_argument("--model", default="deit_small_patch16_224")
+    parser.add_argument("--ratio", default=0.9, type=float)
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--path", default="pitome.onnx")
+    args = parser.parse_args()
+
+    model = timm.create_model(args.model)
+    patch.deit(model)
+    model.ratio = args.ratio
+    benchmark_onnx(model, torch.randn(args.batch_size, 3, 224, 224), args.path, return_flop=False)
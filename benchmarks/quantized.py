@@ -0,0 +1,55 @@
+# --------------------------------------------------------
+# CPU throughput of a PiToMe-patched DeiT in fp32 and with int8 dynamic
+# quantization of its Linear layers.
+#
+# Run from the repository root:
+#   python -m benchmarks.quantized --ratios 1.0 0.9 0.8
+# --------------------------------------------------------
+
+import argparse
+import copy
+from typing import Dict, Tuple
+
+import timm
+import torch
+
+from algo.pitome import patch
+from algo.pitome.utils import benchmark, quantize_linear
+
+
+def benchmark_quantized(
+    model: torch.nn.Module,
+    ratios: Tuple[float, ...] = (1.0, 0.9, 0.8),
+    input_size: Tuple[int] = (3, 224, 224),
+    batch_size: int = 16,
+    runs: int = 20,
+    verbose: bool = True,
+) -> Dict[float, Tuple[float, float]]:
+    """
+    End-to-end CPU throughput of a patched ViT in fp32 and with int8 dynamic quantization
+    (quantize_linear on a copy), for every ratio. Returns {ratio: (fp32 im/s, int8 im/s)}.
+    """
+    model = model.cpu()
+    quantized = quantize_linear(copy.deepcopy(model))
+    results = {}
+    for ratio in ratios:
+        model.ratio = quantized.ratio = ratio
+        results[ratio] = tuple(
+            benchmark(m, device="cpu", input_size=input_size, batch_size=batch_size, runs=runs)
+            for m in (model, quantized)
+        )
+        if verbose:
+            print(f"ratio={ratio} fp32: {results[ratio][0]:.2f} im/s, int8: {results[ratio][1]:.2f} im/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("int8 quantization benchmark")
+    parser.add_argument("--model", default="deit_small_patch16_224")
+    parser.add_argument("--ratios", default=[1.0, 0.9, 0.8], type=float, nargs="+")
+    parser.add_argument("--batch_size", default=16, type=int)
+    args = parser.parse_args()
+
+    model = timm.create_model(args.model)
+    patch.deit(model)
+    benchmark_quantized(model, ratios=tuple(args.ratios), batch_size=args.batch_size)
@@ -0,0 +1,71 @@
+# --------------------------------------------------------
+# Throughput and GFLOPs of a PiToMe-patched DeiT under several merge schedules.
+#
+# Run from the repository root:
+#   python -m benchmarks.schedules --ratio 0.9 --schedules every every_k:2 layers:0,4,8
+# --------------------------------------------------------
+
+import argparse
+from typing import Callable, Dict, List, Union
+
+import timm
+import torch
+
+from algo.pitome import patch
+from algo.pitome.utils import MergeSchedule, benchmark
+
+
+def benchmark_schedules(
+    model: torch.nn.Module,
+    schedules: List[Union[str, MergeSchedule]],
+    evaluate: Callable[[torch.nn.Module], float] = None,
+    verbose: bool = True,
+    **kwargs,
+) -> List[Dict]:
+    """
+    Benchmarks a PiToMe-patched model under several merge schedules at its current ratio / r.
+
+    Args:
+     - model: the patched model, its schedule is restored afterwards
+     - schedules: MergeSchedule objects or command line specs, None for the patch's default
+     - evaluate: optional function returning the accuracy of the model
+     - kwargs: passed on to benchmark (device, input_size, batch_size, ...)
+
+    Returns:
+     - one dict per schedule with its throughput, GFLOPs (timm models only) and accuracy
+    """
+    original = model.schedule
+    rows = []
+    for schedule in schedules:
+        if isinstance(schedule, str):
+            schedule = MergeSchedule.parse(schedule)
+        model.schedule = schedule
+        row = {"schedule": repr(schedule) if schedule is not None else "default"}
+        row["throughput"] = benchmark(model, **kwargs)
+        if hasattr(model, "planner"):
+            num_layers = len(model.blocks)
+            ratios = schedule.ratios(model.ratio, num_layers) if schedule is not None else None
+            rs = schedule.rs(model.r, num_layers) if schedule is not None else None
+            row["gflops"] = model.planner.flops(ratios, rs) / 1e9
+        if evaluate is not None:
+            row["acc"] = evaluate(model)
+        if verbose:
+            print(", ".join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}" for k, v in row.items()))
+        rows.append(row)
+    model.schedule = original
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("merge schedule benchmark")
+    parser.add_argument("--model", default="deit_small_patch16_224")
+    parser.add_argument("--ratio", default=0.9, type=float)
+    parser.add_argument("--schedules", default=["every", "every_k:2", "decreasing:-1"], nargs="+")
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    model = timm.create_model(args.model)
+    patch.deit(model)
+    model.ratio = args.ratio
+    benchmark_schedules(model, args.schedules, device=args.device, batch_size=args.batch_size)
@@ -0,0 +1,64 @@
+# --------------------------------------------------------
+# Full argsort against rank_indices for a typical per-layer reduction.
+#
+# Run from the repository root:
+#   python -m benchmarks.selection --tokens 197 577 2880 --device cuda
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict, Tuple
+
+import torch
+
+from algo.common.select import rank_indices
+
+
+def benchmark_selection(
+    token_counts: Tuple[int, ...] = (197, 577, 2880),
+    batch_size: int = 32,
+    ratio: float = 0.9,
+    device: torch.device = "cpu",
+    runs: int = 50,
+    verbose: bool = True,
+) -> Dict[int, Tuple[float, float]]:
+    """
+    Times a full argsort against rank_indices for a typical per-layer reduction
+    (k = (1 - ratio) * T merged tokens). Returns {T: (argsort_ms, rank_indices_ms)}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    results = {}
+
+    def timeit(fn):
+        for _ in range(5):
+            fn()
+        if is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn()
+        if is_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) * 1000 / runs
+
+    for t in token_counts:
+        scores = torch.randn(batch_size, t, device=device)
+        k = max(1, int((1 - ratio) * t))
+        full = timeit(lambda: scores.argsort(dim=-1, descending=True))
+        partial = timeit(lambda: rank_indices(scores, k))
+        results[t] = (full, partial)
+        if verbose:
+            print(f"T={t:5d} k={k:4d}  argsort {full:.3f} ms  rank_indices {partial:.3f} ms")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("partial top-k selection benchmark")
+    parser.add_argument("--tokens", default=[197, 577, 2880], type=int, nargs="+")
+    parser.add_argument("--ratio", default=0.9, type=float)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    benchmark_selection(tuple(args.tokens), batch_size=args.batch_size, ratio=args.ratio, device=args.device)
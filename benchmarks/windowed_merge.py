@@ -0,0 +1,74 @@
+# --------------------------------------------------------
+# Global pitome_vision vs. window-local merging on growing patch grids.
+#
+# Run from the repository root:
+#   python -m benchmarks.windowed_merge --device cuda
+# --------------------------------------------------------
+
+import argparse
+import time
+from typing import Dict, Tuple
+
+import torch
+
+from algo.pitome.merge import pitome_vision, pitome_vision_windowed, window_partition
+from benchmarks.common import clustered_tokens
+
+
+def benchmark_windowed_merge(
+    grid_sizes: Tuple[int, ...] = (14, 24, 48, 72),
+    window_size: int = 12,
+    dim: int = 64,
+    ratio: float = 0.9,
+    batch_size: int = 4,
+    device: torch.device = "cpu",
+    runs: int = 10,
+    verbose: bool = True,
+) -> Dict[int, Tuple[float, float]]:
+    """
+    Times one pitome_vision merge against the window-local one on square patch grids of
+    growing side. Grids the window does not divide are merged in a single window.
+    Returns {grid side: (global ms, windowed ms)}.
+    """
+    is_cuda = torch.device(device).type == "cuda"
+    results = {}
+    with torch.no_grad():
+        for side in grid_sizes:
+            x = clustered_tokens(batch_size, side * side, dim).to(device)
+            window = window_size if side % window_size == 0 else side
+            window_idx = window_partition((side, side), window, device=device)
+            methods = {
+                "global": lambda: pitome_vision(x, ratio=ratio, margin=0.3),
+                "windowed": lambda: pitome_vision_windowed(
+                    x, num_windows=(side // window) ** 2, window_idx=window_idx, ratio=ratio, margin=0.3
+                ),
+            }
+            times = []
+            for name, fn in methods.items():
+                fn()
+                if is_cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(runs):
+                    fn()
+                if is_cuda:
+                    torch.cuda.synchronize()
+                times.append((time.perf_counter() - start) * 1000 / runs)
+            results[side] = tuple(times)
+            if verbose:
+                print(f"T={side * side} global: {times[0]:.2f} ms, windowed: {times[1]:.2f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("windowed merge benchmark")
+    parser.add_argument("--grid_sizes", default=[14, 24, 48, 72], type=int, nargs="+")
+    parser.add_argument("--window_size", default=12, type=int)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--runs", default=10, type=int)
+    args = parser.parse_args()
+    benchmark_windowed_merge(
+        grid_sizes=tuple(args.grid_sizes), window_size=args.window_size, batch_size=args.batch_size,
+        device=args.device, runs=args.runs,
+    )
@@ -57,6 +57,39 @@ def train_one_epoch(model: torch.nn.Module, criterion,
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 @torch.no_grad()
+def search_one_epoch(search, criterion, data_loader: Iterable, optimizer: torch.optim.Optimizer,
+                    epoch: int, accelerator:Accelerator, logger, mixup_fn: Optional[Mixup] = None, lamb: float = 5.0,
+    ):
+    # one-shot DiffRate search of every FLOPs target of search (DiffRate.search.MultiBudgetSearch)
+    model = search.model
+    model.train()
+    metric_logger = MetricLogger(delimiter="  ")
+    header = 'Epoch: [{}]'.format(epoch)
+    logger.info_freq = 10
+
+    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, logger.info_freq, header,logger)):
+        with accelerator.autocast():
+            optimizer.zero_grad()
+
+            if mixup_fn is not None:
+                samples, targets = mixup_fn(samples, targets)
+
+            # the shared blocks run once, every selector backpropagates its own graph
+            with search.shared_prefix():
+                for k, target_flops in enumerate(search.target_flops):
+                    search.select(k)
+                    outputs, flops = model(samples)
+                    loss_cls = criterion(outputs, targets)
+                    loss_flops = ((flops/1e9)-target_flops)**2
+                    accelerator.backward(loss_cls + lamb * loss_flops)
+                    metric_logger.update(**{f'loss_cls_{target_flops}': loss_cls.item(), f'flops_{target_flops}': flops.item()/1e9})
+            optimizer.step()
+
+    metric_logger.synchronize_between_processes()
+    accelerator.print(f"Averaged stats:{metric_logger}")
+    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+
+
 def evaluate(data_loader, model, accelerator=None):
     criterion = torch.nn.CrossEntropyLoss()
     metric_logger = MetricLogger(delimiter="  ")
@@ -164,6 +164,12 @@ def parse_eval_args() -> argparse.Namespace:
         action="store_true",
         help="use compression on llm",
     )
+    parser.add_argument(
+        "--visual_token_budget",
+        default=None,
+        type=int,
+        help="merge the visual tokens of every image to this many tokens before the projector",
+    )
     args = parser.parse_args()
     return args
 
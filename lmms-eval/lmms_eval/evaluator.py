@@ -114,6 +114,7 @@ def simple_evaluate(
             "algo": cli_args.algo,
             "compress_vit": cli_args.compress_vit,
             "compress_llm": cli_args.compress_llm,
+            "visual_token_budget": getattr(cli_args, "visual_token_budget", None),
         },
     )
 
@@ -60,6 +60,7 @@ class Llava(lmms):
         truncate_context=False,  # whether to truncate the context in generation, set it False for LLaVA-1.6
         compress_llm=False,
         compress_vit=False,
+        visual_token_budget=None,
         algo:str=None,  # whether to truncate the context in generation, set it False for LLaVA-1.6
         ratio=None,  # whether to truncate the context in generation, set it False for LLaVA-1.6
         **kwargs,
@@ -120,11 +121,16 @@ class Llava(lmms):
             self.model.to(self._device)
             self._rank = 0
             self._world_size = 1
-        # if compress_llm:
-        #     # print(self.model)
-        #     if algo == PITOME:
-        #         pitome.patch.llama(self.model.model)
-        #         self.model.model.vision_tower.vision_tower.vision_model.encoder.ratio=ratio
+        if compress_llm:
+            if algo == PITOME:
+                # merges the image tokens inside the first decoder layers during prefill
+                pitome.patch.llama(self.model)
+                self.model.get_model().ratio=ratio
+
+        if visual_token_budget is not None:
+            if algo == PITOME:
+                # exact number of visual tokens per image, merged before the mm_projector
+                pitome.patch.llava_projector(self.model, budget=int(visual_token_budget))
 
         if compress_vit:
             if algo == PITOME:
@@ -15,7 +15,7 @@ from timm.data import Mixup
 from timm.models import create_model
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 import ic.models_mae
-from ic.accelerated_engine import train_one_epoch, evaluate
+from ic.accelerated_engine import train_one_epoch, search_one_epoch, evaluate
 from ic.samplers import RASampler
 import ic.utils as utils
 import shutil
@@ -106,6 +106,14 @@ def get_args_parser():
     parser.add_argument('--epochs', default=10, type=int)
     parser.add_argument('--ratio', default=0.9125, type=float)
     parser.add_argument('--reduced_token', default=8, type=int)
+    parser.add_argument('--schedule', default=None, type=str,
+                        help='pitome merge schedule: every, every_k:<k>, layers:<i,j,...> or decreasing:<inflect>')
+    parser.add_argument('--window_size', default=None, type=int,
+                        help='merge inside non-overlapping windows of this many patches per side (pitome)')
+    parser.add_argument('--global_pass', action='store_true',
+                        help='match all the tokens at the last merging layer of window-local merging')
+    parser.add_argument('--grad_checkpointing', action='store_true',
+                        help='checkpoint the merging blocks to fine-tune with larger batches (pitome)')
     parser.add_argument('--algo', default=PITOME) 
 
     # Model parameters
@@ -245,6 +253,11 @@ def get_args_parser():
     parser.add_argument('--target_flops', type=float, default=3.0)
     parser.add_argument('--granularity', type=int, default=4, help='the token number gap between each compression rate candidate')
     parser.add_argument('--load_compression_rate', action='store_true', help='eval by exiting compression rate in compression_rate.json')
+    parser.add_argument('--diffrate_schedule', default='', help='DiffRate schedule (.json or .npz) to load, written by --export_schedule')
+    parser.add_argument('--export_schedule', default='', help='write the searched DiffRate schedule to this .json or .npz file')
+    parser.add_argument('--compile', action='store_true', default=False, help='evaluate the DiffRate model compiled to its fixed schedule')
+    parser.add_argument('--target_flops_list', type=float, nargs='+', default=None, help='search one DiffRate schedule per FLOPs target in a single run')
+    parser.add_argument('--compression_rate_file', default='compression_rate.json', help='compression rate table read by --load_compression_rate and written by --target_flops_list')
     parser.add_argument('--warmup_compression_rate', action='store_true', default=False, help='inactive computational constraint in first epoch')
     return parser
 
@@ -283,6 +296,11 @@ def get_pitome_model(model, args):
         model.r=int(args.reduced_token)
     else:
         raise ValueError("only support deit, mae and caformer in this codebase")
+    if args.schedule is not None:
+        model.schedule = pitome.utils.MergeSchedule.parse(args.schedule)
+    model.window_size = args.window_size
+    model.global_pass = args.global_pass
+    model.set_grad_checkpointing(args.grad_checkpointing)
 
 
 
@@ -314,14 +332,16 @@ def get_diffrate_model(model, args):
         raise ValueError("only support deit, mae and caformer in this codebase")
 
     
-    if args.load_compression_rate:
-        with open('compression_rate.json', 'r') as f:
+    if args.diffrate_schedule:
+        model.set_kept_num(*DiffRate.compile.load_schedule(args.diffrate_schedule))
+    elif args.load_compression_rate:
+        with open(args.compression_rate_file, 'r') as f:
             compression_rate = json.load(f) 
             model_name = model_dict[args.model]
             if not str(args.target_flops) in compression_rate[model_name]:
                 raise ValueError(f"compression_rate.json does not contaion {model_name} with {args.target_flops}G flops")
-            prune_kept_num = eval(compression_rate[model_name][str(args.target_flops)]['prune_kept_num'])
-            merge_kept_num = eval(compression_rate[model_name][str(args.target_flops)]['merge_kept_num'])
+            prune_kept_num = DiffRate.compile.parse_kept_num(compression_rate[model_name][str(args.target_flops)]['prune_kept_num'])
+            merge_kept_num = DiffRate.compile.parse_kept_num(compression_rate[model_name][str(args.target_flops)]['merge_kept_num'])
             model.set_kept_num(prune_kept_num, merge_kept_num)
     
     else:
@@ -331,6 +351,42 @@ def get_diffrate_model(model, args):
             model.init_kept_num_using_ratio(args.ratio)
             
 
+def multi_budget_search(model, args, accelerator, data_loader_train, data_loader_val, mixup_fn, logger):
+    search = DiffRate.search.MultiBudgetSearch(model, args.target_flops_list).to(accelerator.device)
+    optimizer = torch.optim.AdamW(search.arch_parameters(), lr=args.lr, weight_decay=0)
+    optimizer, data_loader_train, data_loader_val = accelerator.prepare(optimizer, data_loader_train, data_loader_val)
+    if mixup_fn is not None:
+        criterion = SoftTargetCrossEntropy()
+    elif args.smoothing:
+        criterion = LabelSmoothingCrossEntropy(smoothing=args.smoothing)
+    else:
+        criterion = torch.nn.CrossEntropyLoss()
+
+    for epoch in range(args.start_epoch, args.epochs):
+        lamb = 0 if args.warmup_compression_rate and epoch == 0 else 5
+        search_one_epoch(search, criterion, data_loader_train, optimizer, epoch, accelerator, logger, mixup_fn, lamb=lamb)
+        if args.output_dir:
+            ic.utils.save_on_master({'search': search.state_dict(), 'epoch': epoch, 'args': args}, Path(args.output_dir) / 'search.pth')
+
+    rows = []
+    for k, target_flops in enumerate(search.target_flops):
+        prune_kept_num, merge_kept_num = search.get_kept_num(k)
+        test_stats = evaluate(data_loader_val, model, accelerator)
+        rows.append({
+            'target_flops': target_flops,
+            'flops': float(test_stats['flops']),
+            'acc1': float(test_stats['acc1']),
+            'prune_kept_num': prune_kept_num,
+            'merge_kept_num': merge_kept_num,
+        })
+    front = DiffRate.search.pareto_front(rows)
+    for row in front:
+        logger.info(f"target {row['target_flops']}G: {row['flops']:.3f}G flops, acc1 {row['acc1']:.2f}")
+    if accelerator.is_main_process:
+        DiffRate.search.write_compression_rate(args.compression_rate_file, model_dict[args.model], front)
+    return front
+
+
 def get_dct_model(model, args):
     if 'deit' in args.model:
         dct.patch.deit(model,use_k=args.use_k)
@@ -474,6 +530,12 @@ def main(args):
         checkpoint_model['pos_embed'] = new_pos_embed
         model.load_state_dict(checkpoint_model, strict=False)
 
+    if args.algo == DIFFRATE and args.compile:
+        DiffRate.compile.compile_static(model)
+
+    if args.algo == DIFFRATE and args.target_flops_list and not args.eval:
+        multi_budget_search(model, args, accelerator, data_loader_train, data_loader_val, mixup_fn, logger)
+        return None
     
     model = accelerator.prepare(model)
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
@@ -490,6 +552,8 @@ def main(args):
         test_stats = evaluate(data_loader_val, model, accelerator)
         accelerator.print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         test_stats['best acc'] = test_stats['acc1']
+        if args.algo == DIFFRATE and args.export_schedule and accelerator.is_main_process:
+            DiffRate.compile.export_schedule(accelerator.unwrap_model(model), args.export_schedule, model=model_dict[args.model], flops=float(test_stats['flops']))
         return test_stats
     else:
         # pass
@@ -578,6 +642,8 @@ def main(args):
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     accelerator.print('Training time {}'.format(total_time_str))
+    if args.algo == DIFFRATE and args.export_schedule and accelerator.is_main_process:
+        DiffRate.compile.export_schedule(accelerator.unwrap_model(model), args.export_schedule, model=model_dict[args.model], flops=float(test_stats['flops']))
     test_stats['best acc'] = f'{max_accuracy:.2f}'
     return test_stats
 
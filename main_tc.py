@@ -42,6 +42,7 @@ if __name__ == "__main__":
     parser.add_argument("--model", default=BERT_BASE, choices=[BERT_BASE, DISTILBERT_BASE, BERT_LARGE, ALBERT],
                         help="choose an LRA dataset from available options")
     parser.add_argument("--ratio", default=0.55, help="remain ratio")
+    parser.add_argument("--schedule", default=None, help="pitome merge schedule: every, every_k:<k>, layers:<i,j,...> or decreasing:<inflect>")
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
     parser.add_argument('--batch_size', default=8, help='Perform evaluation only')
     args = parser.parse_args()
@@ -57,7 +58,8 @@ if __name__ == "__main__":
         ratio=float(args.ratio),
         algo=args.algo,
         enable_log=not args.eval,
-        trained=args.eval
+        trained=args.eval,
+        schedule=args.schedule,
     )
     engine.init_logger()
     if args.eval:
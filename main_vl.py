@@ -32,12 +32,14 @@ from algo import (
     DCT,
     TOFU,
     LTMP,
+    PUMER,
     NONE, 
     pitome,
     tome,
     DiffRate,
     tofu,
     dct, 
+    pumer,
     # ltmp
 )
 
@@ -79,6 +81,11 @@ def get_pitome_model(model, args):
         model.visual_encoder_m.r=int(args.reduced_token)
     else:
         raise ValueError("only support clip, blip, albef and blip2 in this codebase")
+    if args.schedule is not None:
+        schedule = pitome.utils.MergeSchedule.parse(args.schedule)
+        for module in model.modules():
+            if hasattr(module, "schedule"):
+                module.schedule = schedule
 
 def get_diffrate_model(model, args):
     if 'clip' in args.model:
@@ -144,6 +151,15 @@ def get_dct_model(model, args):
         raise ValueError("only support clip, blip and blip2 in this codebase")
 
 
+def get_pumer_model(model, args):
+    if 'clip' in args.model or 'blip2' in args.model:
+        raise ValueError("pumer only supports the cross-attention text encoders of blip and albef")
+    # the image encoder stays full, tome with ratio 1.0 only counts its flops
+    tome.patch.blip(model.visual_encoder,use_k=args.use_k)
+    prune_layers = [int(layer) for layer in args.pumer_layers.split(',')] if args.pumer_layers else None
+    pumer.patch.blip(model.text_encoder, prune_layers=prune_layers, keep_ratio=float(args.ratio), merge_ratio=float(args.merge_ratio))
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Training")
     parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
@@ -152,7 +168,10 @@ def parse_args():
     parser.add_argument("--use_k", default=False)
     parser.add_argument("--ratio", default=0.9, type=float)
     parser.add_argument("--reduced_token", default=12, type=int)
+    parser.add_argument("--schedule", default=None, type=str, help="pitome merge schedule: every, every_k:<k>, layers:<i,j,...> or decreasing:<inflect>")
     parser.add_argument('--granularity', type=int, default=4, help='the token number gap between each compression rate candidate')
+    parser.add_argument('--merge_ratio', default=0.1, type=float, help='pumer: fraction of the kept image tokens merged at every reduction layer')
+    parser.add_argument('--pumer_layers', default=None, type=str, help='pumer: comma separated cross-attention layers reducing the image tokens')
     parser.add_argument('--dataset', default='flickr', help='dataset')
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
     parser.add_argument(
@@ -264,11 +283,13 @@ def main():
         get_tofu_model(model, args)
     elif args.algo == DCT:
         get_dct_model(model, args)
+    elif args.algo == PUMER:
+        get_pumer_model(model, args)
     elif args.algo == NONE:
         args.ratio = 1.0
         get_tome_model(model, args)
     else:
-        raise ValueError("only support pitome, tome, tofu, dct, diffrate for image retrieval task")
+        raise ValueError("only support pitome, tome, tofu, dct, diffrate, pumer for image retrieval task")
 
 
     runner = RunnerBase(
@@ -97,7 +97,7 @@ model_dict  = {
 }
 class Engine:
 
-    def __init__(self, task_name, model_ckt, ratio=1.0, algo=NONE, batch_size=None, enable_log=False, trained=False):
+    def __init__(self, task_name, model_ckt, ratio=1.0, algo=NONE, batch_size=None, enable_log=False, trained=False, schedule=None):
 
         self.accelerator = Accelerator(
             mixed_precision='fp16',
@@ -108,6 +108,7 @@ class Engine:
         if task_name == 'imdb' and algo==NONE: self.batch_size = 12
         else: self.batch_size = batch_sizes[task_name] if batch_size is None else batch_size
         self.ratio = ratio
+        self.schedule = pitome.utils.MergeSchedule.parse(schedule) if schedule is not None else None
         self.config, self.model_config = task.config_getter()    
         self.train_dataset = task.dataset_fn(self.config, split='train')
         self.eval_dataset = task.dataset_fn(self.config, split='eval')    
@@ -182,6 +183,8 @@ class Engine:
             self.set_ratio(1.0)
 
         self.model.bert.encoder.ratio = self.ratio 
+        if self.schedule is not None:
+            self.model.bert.encoder.schedule = self.schedule
         self.tokenizer = AutoTokenizer.from_pretrained(model_ckt, cache_dir=f'{DATA_PATH}/.cache')
         self.model = self.accelerator.prepare(self.model)
     
@@ -206,6 +209,8 @@ class Engine:
             self.set_ratio(1.0)
 
         self.model.distilbert.transformer.ratio = self.ratio 
+        if self.schedule is not None:
+            self.model.distilbert.transformer.schedule = self.schedule
         self.tokenizer = AutoTokenizer.from_pretrained(model_ckt, cache_dir=f'{DATA_PATH}/.cache')
         self.model = self.accelerator.prepare(self.model)
     
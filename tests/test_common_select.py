@@ -0,0 +1,67 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from algo.common.select import complement_indices, rank_indices, stable_ranking  # noqa: E402
+
+
+def test_complement_is_sorted_rest():
+    torch.manual_seed(0)
+    idx = torch.stack([torch.randperm(50)[:12] for _ in range(4)])
+    rest = complement_indices(idx, 50)
+
+    assert rest.shape == (4, 38)
+    for row, taken in zip(rest.tolist(), idx.tolist()):
+        assert row == sorted(set(range(50)) - set(taken))
+
+
+@pytest.mark.parametrize("descending", [True, False])
+@pytest.mark.parametrize("k", [0, 1, 19, 197])
+def test_top_k_matches_argsort(k, descending):
+    torch.manual_seed(0)
+    scores = torch.randn(3, 197)
+    ranked = rank_indices(scores, k, descending=descending)
+    expected = scores.argsort(dim=-1, descending=descending)
+
+    assert ranked.shape == expected.shape
+    assert torch.equal(ranked[..., :k], expected[..., :k])
+    # every index appears once, the rest in position order
+    assert torch.equal(ranked.sort(dim=-1).values, torch.arange(197).expand(3, -1))
+    if k < 197:
+        rest = ranked[..., k:]
+        assert torch.equal(rest, rest.sort(dim=-1).values)
+
+
+def test_unsorted_top_k_is_same_set():
+    torch.manual_seed(0)
+    scores = torch.randn(2, 64)
+    ranked = rank_indices(scores, 8, sorted=False)
+    expected = scores.argsort(dim=-1, descending=True)[..., :8]
+    assert torch.equal(ranked[..., :8].sort(dim=-1).values, expected.sort(dim=-1).values)
+
+
+@pytest.mark.parametrize("descending", [True, False])
+@pytest.mark.parametrize("k", [5, 40])
+def test_stable_ranking_breaks_ties_by_index(k, descending):
+    torch.manual_seed(0)
+    scores = torch.randint(0, 4, (3, 40)).float()
+    scores[0, 7] = -math.inf
+    with stable_ranking():
+        ranked = rank_indices(scores, k, descending=descending)
+    expected = scores.argsort(dim=-1, descending=descending, stable=True)
+    assert torch.equal(ranked[..., :k], expected[..., :k])
+    assert torch.equal(ranked.sort(dim=-1).values, torch.arange(40).expand(3, -1))
+
+
+def test_stable_ranking_traces():
+    scores = torch.tensor([[1.0, 3.0, 3.0, 2.0, 3.0, 0.0]])
+
+    def top3(s):
+        return rank_indices(s, 3)
+
+    with stable_ranking():
+        traced = torch.jit.trace(top3, scores)
+    assert traced(scores).tolist() == [[1, 2, 4, 0, 3, 5]]
+    assert traced(scores.flip(-1)).tolist() == [[1, 3, 4, 0, 2, 5]]
@@ -0,0 +1,38 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from algo.dct.merge import dc_transform, dct, dct_basis, idct  # noqa: E402
+
+
+@pytest.mark.parametrize("num_tokens, kept", [(196, 177), (576, 519), (16, 16)])
+def test_basis_rows_are_orthonormal(num_tokens, kept):
+    basis = dct_basis(num_tokens, kept, torch.float64)
+    assert basis.shape == (kept, num_tokens)
+    torch.testing.assert_close(basis @ basis.t(), torch.eye(kept, dtype=torch.float64), rtol=0, atol=1e-10)
+
+
+def test_basis_is_cached_per_dtype():
+    assert dct_basis(64, 60) is dct_basis(64, 60)
+    assert dct_basis(64, 60, torch.float64) is not dct_basis(64, 60)
+    assert dct_basis(64, 60, torch.float64).dtype == torch.float64
+
+
+@pytest.mark.parametrize("num_tokens", [196, 197])
+def test_matches_fft_round_trip(num_tokens):
+    torch.manual_seed(0)
+    x = torch.randn(2, num_tokens, 32, dtype=torch.float64)
+    kept = math.ceil(num_tokens * 0.9)
+    expected = idct(dct(x.transpose(1, 2), norm="ortho")[..., :kept], norm="ortho").transpose(1, 2)
+    torch.testing.assert_close(dc_transform(x, ratio=0.9, class_token=False), expected)
+
+
+def test_class_token_and_full_ratio():
+    torch.manual_seed(0)
+    x = torch.randn(2, 197, 32)
+    out = dc_transform(x, ratio=0.9, class_token=True)
+    assert out.shape == (2, 1 + math.ceil(196 * 0.9), 32)
+    assert torch.equal(out[:, 0], x[:, 0])
+    assert torch.equal(dc_transform(x, ratio=1.0, class_token=True), x)
@@ -0,0 +1,64 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+vision_transformer = pytest.importorskip("timm.models.vision_transformer")
+DiffRate = pytest.importorskip("algo.DiffRate")
+
+from algo.DiffRate.compile import (  # noqa: E402
+    StaticRate, compile_static, load_compiled, load_schedule, save_schedule,
+)
+from algo.DiffRate.ddp import DiffRate as DiffRateModule  # noqa: E402
+
+
+def tiny_diffrate(r=2):
+    torch.manual_seed(0)
+    model = vision_transformer.VisionTransformer(
+        img_size=64, patch_size=16, embed_dim=64, depth=4, num_heads=4, num_classes=10
+    )
+    DiffRate.patch.deit(model)
+    model.init_kept_num_using_r(r)
+    return model.eval()
+
+
+def test_compiled_matches_searched():
+    model = tiny_diffrate()
+    compiled = compile_static(copy.deepcopy(model))
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        expected = model(x, return_flop=False)
+        out = compiled(x, return_flop=False)
+
+    torch.testing.assert_close(out, expected)
+    assert compiled.get_kept_num() == model.get_kept_num()
+    assert not any(isinstance(m, DiffRateModule) for m in compiled.modules())
+    params = sum(p.numel() for p in torch.nn.Module.parameters(model))
+    params_compiled = sum(p.numel() for p in torch.nn.Module.parameters(compiled))
+    assert params_compiled < params
+
+
+def test_compiled_is_inference_only():
+    compiled = compile_static(tiny_diffrate())
+    rate = compiled.blocks[1].merge_ddp
+    assert isinstance(rate, StaticRate)
+    with pytest.raises(RuntimeError):
+        rate.update_kept_token_number()
+
+
+@pytest.mark.parametrize("suffix", [".json", ".npz"])
+def test_schedule_round_trip(tmp_path, suffix):
+    model = tiny_diffrate(r=3)
+    path = str(tmp_path / f"schedule{suffix}")
+    save_schedule(path, *model.get_kept_num(), model="tiny")
+    assert load_schedule(path) == model.get_kept_num()
+
+    other = tiny_diffrate(r=1)
+    load_compiled(other, path)
+    assert other.get_kept_num() == model.get_kept_num()
+
+
+def test_schedule_rejects_mismatched_lengths(tmp_path):
+    with pytest.raises(ValueError):
+        save_schedule(str(tmp_path / "schedule.json"), [17, 17], [17])
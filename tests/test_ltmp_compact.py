@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("timm.layers")
+ltmp_timm = pytest.importorskip("algo.ltmp.patch.timm")
+
+LTPMBlock = ltmp_timm.LTPMBlock
+LTPMVisionTransformer = ltmp_timm.LTPMVisionTransformer
+compact_inference = ltmp_timm.compact_inference
+
+
+def tiny_ltpm(depth):
+    torch.manual_seed(0)
+    model = LTPMVisionTransformer(
+        img_size=64, patch_size=16, embed_dim=64, depth=depth, num_heads=4, block_fn=LTPMBlock, num_classes=10
+    )
+    return model.eval()
+
+
+def masked_and_compact(model, x):
+    with torch.no_grad():
+        compact_inference(model, False)
+        masked = model.forward_features(x)
+        compact_inference(model, True)
+        compacted = model.forward_features(x)
+        compact_inference(model, False)
+    return masked, compacted
+
+
+def test_without_reduction_compact_is_masked():
+    # the default thresholds (prune below 0, merge above cosine 1) keep every token
+    model = tiny_ltpm(depth=3)
+    x = torch.randn(2, 3, 64, 64)
+    masked, compacted = masked_and_compact(model, x)
+    assert [count.tolist() for count in model.token_counts] == [[17, 17]] * 3
+    torch.testing.assert_close(compacted, masked, rtol=1e-5, atol=1e-5)
+
+
+def test_pruning_keeps_the_masked_tokens():
+    model = tiny_ltpm(depth=1)
+    # prune the tokens with less than average attention
+    model.blocks[0].prune_masker.threshold.data.fill_(1 / 17)
+    x = torch.randn(2, 3, 64, 64)
+    masked, compacted = masked_and_compact(model, x)
+
+    kept = model.masks[0].bool()
+    assert model.token_counts[0].tolist() == kept.sum(1).tolist()
+    assert compacted.shape[1] == int(kept.sum(1).max())
+    for b in range(x.shape[0]):
+        n = int(kept[b].sum())
+        torch.testing.assert_close(compacted[b, :n], masked[b][kept[b]], rtol=1e-5, atol=1e-5)
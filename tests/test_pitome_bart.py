@@ -0,0 +1,61 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+bart = pytest.importorskip("algo.pitome.patch.bart")
+
+
+def tiny_bart():
+    torch.manual_seed(0)
+    config = transformers.BartConfig(
+        vocab_size=100, d_model=32, encoder_layers=4, decoder_layers=2, encoder_attention_heads=4,
+        decoder_attention_heads=4, encoder_ffn_dim=64, decoder_ffn_dim=64, max_position_embeddings=128,
+    )
+    return transformers.BartModel(config).eval()
+
+
+def inputs(batch_size=2, num_tokens=48):
+    torch.manual_seed(1)
+    input_ids = torch.randint(4, 100, (batch_size, num_tokens))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, num_tokens - 10:] = 0
+    decoder_input_ids = torch.randint(4, 100, (batch_size, 5))
+    return input_ids, attention_mask, decoder_input_ids
+
+
+def test_without_merging_matches_bart():
+    model = tiny_bart()
+    patched = copy.deepcopy(model)
+    bart.apply_patch(patched, ratio=1.0)
+    input_ids, attention_mask, decoder_input_ids = inputs()
+    with torch.no_grad():
+        expected = model(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids)
+        out = patched(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids)
+    torch.testing.assert_close(out.last_hidden_state, expected.last_hidden_state, rtol=1e-4, atol=1e-5)
+
+
+def test_cached_decode_matches_full_decode():
+    model = tiny_bart()
+    bart.apply_patch(model, ratio=0.8)
+    input_ids, attention_mask, decoder_input_ids = inputs()
+    with torch.no_grad():
+        encoder_outputs = model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        full = model(
+            attention_mask=attention_mask, encoder_outputs=encoder_outputs, decoder_input_ids=decoder_input_ids,
+        ).last_hidden_state
+
+        steps, past_key_values = [], None
+        for i in range(decoder_input_ids.shape[1]):
+            out = model(
+                attention_mask=attention_mask, encoder_outputs=encoder_outputs,
+                decoder_input_ids=decoder_input_ids[:, i:i + 1], past_key_values=past_key_values, use_cache=True,
+            )
+            past_key_values = out.past_key_values
+            steps.append(out.last_hidden_state)
+
+    merged = encoder_outputs.last_hidden_state
+    assert merged.shape[1] < input_ids.shape[1]
+    assert encoder_outputs.attention_mask.shape == merged.shape[:2]
+    torch.testing.assert_close(torch.cat(steps, dim=1), full, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,28 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+patch = pytest.importorskip("algo.pitome.patch")
+
+
+def input_grad(model, x, checkpointing):
+    model.set_grad_checkpointing(checkpointing)
+    x = x.clone().requires_grad_(True)
+    out, _ = model(x)
+    out.float().sum().backward()
+    return x.grad
+
+
+@pytest.mark.parametrize("window_size", [None, 7])
+def test_checkpointing_gives_the_same_gradients(window_size):
+    torch.manual_seed(0)
+    # no dropout / drop path, so that both runs are the same function
+    model = timm.create_model("deit_tiny_patch16_224", drop_rate=0.0, drop_path_rate=0.0)
+    patch.deit(model)
+    model.ratio = 0.9
+    model.window_size = window_size
+    model.train()
+
+    x = torch.randn(2, 3, 224, 224)
+    expected = input_grad(model, x, checkpointing=False)
+    torch.testing.assert_close(input_grad(model, x, checkpointing=True), expected, rtol=1e-4, atol=1e-6)
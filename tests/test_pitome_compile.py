@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+pytest.importorskip("torch._dynamo")
+patch = pytest.importorskip("algo.pitome.patch")
+
+from algo.pitome.utils import count_graph_breaks  # noqa: E402
+
+
+def patched_deit(ratio):
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224").eval()
+    patch.deit(model)
+    model.ratio = ratio
+    return model
+
+
+@pytest.mark.parametrize("ratio", [1.0, 0.9])
+def test_fixed_ratio_has_no_graph_breaks(ratio):
+    model = patched_deit(ratio)
+    assert count_graph_breaks(model, device="cpu", batch_size=2, verbose=True) == 0
+
+
+def test_fullgraph_compile_matches_eager():
+    model = patched_deit(0.9)
+    x = torch.randn(2, 3, 224, 224)
+    torch._dynamo.reset()
+    # the eager backend runs the captured graph with the eager kernels, so this checks the capture
+    # itself. Inductor rounds differently, which can flip near-tied token rankings and merge other
+    # tokens, so its output is not compared here.
+    compiled = torch.compile(model, fullgraph=True, backend="eager")
+    with torch.no_grad():
+        expected, flops = model(x)
+        out, compiled_flops = compiled(x)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+    assert compiled_flops == flops
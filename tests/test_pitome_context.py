@@ -0,0 +1,84 @@
+import gc
+import threading
+import weakref
+
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+patch = pytest.importorskip("algo.pitome.patch")
+
+from algo.common.context import ThreadLocalInfo  # noqa: E402
+
+
+def run_in_thread(fn, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(out=fn(*args)))
+    thread.start()
+    thread.join()
+    return result["out"]
+
+
+def patched_deit(ratio=0.9):
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224").eval()
+    patch.deit(model)
+    model.ratio = ratio
+    return model
+
+
+def test_info_is_per_thread():
+    info = ThreadLocalInfo({"size": None, "ratio": 1.0})
+    info["size"] = 3
+    assert run_in_thread(lambda: info["size"]) is None
+    info.defaults["ratio"] = 0.5
+    assert run_in_thread(lambda: info["ratio"]) == 0.5
+    assert info["ratio"] == 1.0
+
+
+def test_concurrent_inference_matches_sequential():
+    model = patched_deit()
+    inputs = [torch.randn(batch_size, 3, 224, 224) for batch_size in (1, 2, 3, 4)]
+    with torch.no_grad():
+        expected = [model(x)[0] for x in inputs]
+    outputs = [[] for _ in inputs]
+
+    def run(i):
+        with torch.no_grad():
+            for _ in range(4):
+                outputs[i].append(model(inputs[i])[0])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for outs, ref in zip(outputs, expected):
+        assert len(outs) == 4
+        for out in outs:
+            torch.testing.assert_close(out, ref, rtol=0, atol=0)
+
+
+def test_settings_reach_every_thread():
+    model = patched_deit()
+    model.approx, model.rank = "nystrom", 32
+
+    def settings():
+        with torch.no_grad():
+            model(torch.randn(1, 3, 224, 224))
+        return model._tome_info["approx"], model._tome_info["rank"]
+
+    assert run_in_thread(settings) == ("nystrom", 32)
+
+
+def test_workspaces_go_away_with_their_thread():
+    model = patched_deit()
+
+    def workspace():
+        with torch.no_grad():
+            model(torch.randn(2, 3, 224, 224))
+        return weakref.ref(model._tome_info["workspace"])
+
+    ref = run_in_thread(workspace)
+    gc.collect()
+    assert ref() is None
@@ -0,0 +1,58 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from algo.pitome.merge import approx_energy_score, energy_score  # noqa: E402
+
+
+def clustered_tokens(batch_size, num_tokens, dim, num_clusters=16):
+    # random tokens around a few centers, closer to real patch features than isotropic noise
+    centers = torch.randn(batch_size, num_clusters, dim)
+    assign = torch.randint(0, num_clusters, (batch_size, num_tokens))
+    x = centers.gather(1, assign[..., None].expand(-1, -1, dim)) + 0.5 * torch.randn(batch_size, num_tokens, dim)
+    return F.normalize(x, dim=-1)
+
+
+def spearman(a, b):
+    a, b = a.argsort(-1).argsort(-1).float(), b.argsort(-1).argsort(-1).float()
+    a, b = a - a.mean(-1, keepdim=True), b - b.mean(-1, keepdim=True)
+    return ((a * b).sum(-1) / (a.norm(dim=-1) * b.norm(dim=-1))).min().item()
+
+
+def top_overlap(a, b, k):
+    top_a = torch.zeros_like(a).scatter_(-1, a.topk(k, dim=-1).indices, 1)
+    top_b = torch.zeros_like(b).scatter_(-1, b.topk(k, dim=-1).indices, 1)
+    return ((top_a * top_b).sum(-1) / k).min().item()
+
+
+@pytest.mark.parametrize("kernel", ["vision", "text"])
+def test_nystrom_with_every_token_as_landmark_is_exact(kernel):
+    torch.manual_seed(0)
+    x = clustered_tokens(2, 48, 64).double()
+    torch.testing.assert_close(
+        approx_energy_score(x, 0.3, kernel=kernel, approx="nystrom", rank=48),
+        energy_score(x, 0.3, kernel=kernel),
+        rtol=1e-4, atol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("rank, min_spearman, min_overlap", [(64, 0.8, 0.75), (160, 0.98, 0.9)])
+def test_nystrom_ranks_like_exact_score(rank, min_spearman, min_overlap, seed):
+    # over seeds 0-15, rank 64 gives a Spearman correlation of 0.84-0.99, rank 160 (T/4) 0.99-1.0
+    torch.manual_seed(seed)
+    x = clustered_tokens(2, 577, 64)
+    exact = energy_score(x, 0.3)
+    approximate = approx_energy_score(x, 0.3, approx="nystrom", rank=rank)
+    # the merge only uses the ranking, in particular the 2r highest scores
+    k = 2 * math.floor(577 - 577 * 0.9)
+    assert spearman(exact, approximate) > min_spearman
+    assert top_overlap(exact, approximate, k) > min_overlap
+
+
+def test_unknown_approximation():
+    with pytest.raises(ValueError):
+        approx_energy_score(clustered_tokens(1, 16, 8), 0.3, approx="rff")
@@ -0,0 +1,118 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+ort = pytest.importorskip("onnxruntime")
+patch = pytest.importorskip("algo.pitome.patch")
+
+from algo.pitome.export import ExportWrapper, export_mode, export_onnx, trace  # noqa: E402
+
+
+def patched_bert(ratio):
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=100, hidden_size=64, num_hidden_layers=4, num_attention_heads=4, intermediate_size=128,
+        max_position_embeddings=64, attn_implementation="eager",
+    )
+    model = transformers.BertForSequenceClassification(config)
+    patch.bert(model.bert.encoder)
+    model.bert.encoder.ratio = ratio
+    return model.eval()
+
+
+def bert_inputs():
+    torch.manual_seed(1)
+    input_ids = torch.randint(1, 100, (2, 32))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 24:] = 0
+    return input_ids, attention_mask
+
+
+def patched_clip(ratio):
+    torch.manual_seed(0)
+    config = transformers.CLIPVisionConfig(
+        hidden_size=64, intermediate_size=128, num_hidden_layers=4, num_attention_heads=4, image_size=96,
+        patch_size=16,
+    )
+    model = transformers.CLIPVisionModel(config)
+    patch.clip_hf(model.vision_model.encoder)
+    model.vision_model.encoder.ratio = ratio
+    return model.eval()
+
+
+def onnx_output(path, inputs):
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    feed = {arg.name: x.numpy() for arg, x in zip(session.get_inputs(), inputs)}
+    return torch.from_numpy(session.run(None, feed)[0])
+
+
+def patched_deit(ratio):
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224")
+    patch.deit(model)
+    model.ratio = ratio
+    return model.eval()
+
+
+def eager(model, *inputs, **kwargs):
+    kwargs = kwargs or {"return_flop": False}
+    with export_mode(model), torch.no_grad():
+        return ExportWrapper(model, **kwargs)(*inputs)
+
+
+@pytest.mark.parametrize("ratio", [1.0, 0.9])
+def test_onnx_matches_eager(tmp_path, ratio):
+    model = patched_deit(ratio)
+    x = torch.randn(2, 3, 224, 224)
+    path = export_onnx(model, x, str(tmp_path / "deit.onnx"), return_flop=False)
+
+    torch.testing.assert_close(onnx_output(path, (x,)), eager(model, x), rtol=1e-4, atol=1e-4)
+
+
+def test_trace_matches_eager():
+    model = patched_deit(0.9)
+    x = torch.randn(2, 3, 224, 224)
+    traced = trace(model, x, return_flop=False)
+    with torch.no_grad():
+        torch.testing.assert_close(traced(x), eager(model, x), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("ratio", [1.0, 0.8])
+def test_bert_onnx_matches_eager(tmp_path, ratio):
+    model = patched_bert(ratio)
+    inputs = bert_inputs()
+    path = export_onnx(model, inputs, str(tmp_path / "bert.onnx"), return_dict=False)
+    expected = eager(model, *inputs, return_dict=False)
+    torch.testing.assert_close(onnx_output(path, inputs), expected, rtol=1e-4, atol=1e-4)
+
+    traced = trace(model, inputs, return_dict=False)
+    with torch.no_grad():
+        torch.testing.assert_close(traced(*inputs), expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("ratio", [1.0, 0.8])
+def test_clip_hf_onnx_matches_eager(tmp_path, ratio):
+    model = patched_clip(ratio)
+    x = torch.randn(2, 3, 96, 96)
+    path = export_onnx(model, x, str(tmp_path / "clip.onnx"), return_dict=True)
+    expected = eager(model, x, return_dict=True)
+    if ratio < 1.0:
+        assert expected.shape[1] < 37
+    torch.testing.assert_close(onnx_output(path, (x,)), expected, rtol=1e-4, atol=1e-4)
+
+    traced = trace(model, x, return_dict=True)
+    with torch.no_grad():
+        torch.testing.assert_close(traced(x), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_export_mode_restores_settings():
+    model = patched_deit(0.9)
+    model.train()
+    model._tome_info["trace_source"] = True
+    with export_mode(model):
+        assert not model.training
+        assert model._tome_info["trace_source"] is False
+    assert model.training
+    assert model._tome_info["trace_source"] is True
@@ -0,0 +1,95 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("LLaVA.llava")
+
+from algo.pitome.patch.llama import apply_patch  # noqa: E402
+
+NUM_LAYERS = 4
+PROMPT_LENGTH = 48
+NUM_IMAGE_TOKENS = 32
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256,
+    )
+    reference = transformers.LlamaForCausalLM(config).eval()
+    model = copy.deepcopy(reference)
+    apply_patch(model.model, merge_layers=2)
+    return reference, model
+
+
+def inputs(padding_side):
+    input_ids = torch.randint(0, 128, (2, PROMPT_LENGTH))
+    attention_mask = torch.ones_like(input_ids)
+    image_mask = torch.zeros_like(input_ids, dtype=torch.bool)
+    if padding_side == "right":
+        attention_mask[1, -5:] = 0
+        image_mask[:, 4:4 + NUM_IMAGE_TOKENS] = True
+    else:
+        attention_mask[1, :5] = 0
+        image_mask[:, 8:8 + NUM_IMAGE_TOKENS] = True
+    return input_ids, attention_mask, image_mask
+
+
+@pytest.mark.parametrize("padding_side", ["right", "left"])
+def test_ratio_one_matches_llama(padding_side):
+    reference, model = tiny_llama()
+    input_ids, attention_mask, image_mask = inputs(padding_side)
+    with torch.no_grad():
+        model.model._pitome_info["image_mask"] = image_mask
+        out = model(input_ids, attention_mask=attention_mask).logits
+        expected = reference(input_ids, attention_mask=attention_mask).logits
+    keep = attention_mask.bool()
+    torch.testing.assert_close(out[keep], expected[keep], rtol=1e-4, atol=1e-4)
+
+
+def test_cache_lengths_after_decoding():
+    _, model = tiny_llama()
+    input_ids, attention_mask, image_mask = inputs("right")
+    ratio, new_tokens = 0.5, 4
+    model.model.ratio = ratio
+    with torch.no_grad():
+        model.model._pitome_info["image_mask"] = image_mask
+        out = model(input_ids, attention_mask=attention_mask, use_cache=True)
+        past_key_values = out.past_key_values
+        next_token = out.logits[:, -1:].argmax(-1)
+        for _ in range(new_tokens):
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_token)], dim=1)
+            position_ids = attention_mask.cumsum(-1)[:, -1:] - 1
+            out = model(
+                next_token, attention_mask=attention_mask, position_ids=position_ids,
+                past_key_values=past_key_values, use_cache=True,
+            )
+            past_key_values = out.past_key_values
+            next_token = out.logits[:, -1:].argmax(-1)
+
+    expected, tokens, images = [], PROMPT_LENGTH, NUM_IMAGE_TOKENS
+    for i in range(NUM_LAYERS):
+        expected.append(tokens + new_tokens)
+        if i < 2:
+            merged = min(int(images - images * ratio), images // 2)
+            tokens, images = tokens - merged, images - merged
+    assert [layer[0].shape[2] for layer in past_key_values] == expected
+
+
+def test_left_padding_keeps_last_token_last():
+    _, model = tiny_llama()
+    input_ids, attention_mask, image_mask = inputs("left")
+    model.model.ratio = 0.5
+    with torch.no_grad():
+        model.model._pitome_info["image_mask"] = image_mask
+        model(input_ids, attention_mask=attention_mask)
+    info = model.model._pitome_info
+    # generate reads logits[:, -1], which has to be the last prompt token of every row
+    assert info["mask"].shape[1] < PROMPT_LENGTH
+    assert bool(info["mask"][:, -1].all())
+    assert info["order"][:, -1].tolist() == [PROMPT_LENGTH - 1] * 2
+    both_kept = (info["mask"][:, 1:] & info["mask"][:, :-1]).bool()
+    assert bool((info["order"].diff(dim=1)[both_kept] > 0).all())
@@ -0,0 +1,159 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+F = torch.nn.functional
+
+from algo.pitome.merge import (  # noqa: E402
+    MergePlan,
+    Workspace,
+    energy_score,
+    merge_source,
+    merge_wavg,
+    pitome_text,
+    pitome_text_varlen,
+    pitome_vision,
+    unmerge_source,
+)
+
+
+def reference_pitome_vision(metric, ratio, margin, class_token):
+    # the closure-based pitome_vision the merge plans replaced (energy path and bipartite path)
+    if margin >= 0.45:
+        B, T, _ = metric.shape
+        r = math.floor(T - T * ratio)
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+        if class_token:
+            scores[..., 0, :] = -math.inf
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx, src_idx = edge_idx[..., r:, :], edge_idx[..., :r, :]
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+        if class_token:
+            # keeps the class token first
+            unm_idx = unm_idx.sort(dim=1)[0]
+
+        def merge(x, mode="mean"):
+            src, dst = x[..., ::2, :], x[..., 1::2, :]
+            n, t1, c = src.shape
+            unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+            src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+            dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+            return torch.cat([unm, dst], dim=1)
+
+        return merge
+
+    if class_token:
+        metric = metric[:, 1:, :]
+    B, T, _ = metric.shape
+    r = math.floor(T - T * ratio)
+    metric = F.normalize(metric, p=2, dim=-1)
+    sigma = 1 - margin
+    sim = metric @ metric.transpose(-1, -2)
+    score = (2 * torch.exp(-(((1 - sim) / sigma) ** 2)) - 1).mean(-1) / (sigma * math.sqrt(2 * math.pi))
+    indices = torch.argsort(score, descending=True)
+    merge_idx, protected_idx = indices[..., :2 * r], indices[..., 2 * r:]
+
+    def merge(x, mode="mean"):
+        x_cls = x[:, :1] if class_token else None
+        x = x[:, 1:] if class_token else x
+        B, T, C = x.shape
+        batch_idx = torch.arange(B)[:, None]
+        protected = x[batch_idx, protected_idx, :]
+        a_idx, b_idx = merge_idx[..., ::2], merge_idx[..., 1::2]
+        scores = sim.gather(dim=-1, index=b_idx.unsqueeze(-2).expand(B, T, r))
+        scores = scores.gather(dim=-2, index=a_idx.unsqueeze(-1).expand(B, r, r))
+        _, dst_idx = scores.max(dim=-1)
+        src, dst = x[batch_idx, a_idx, :], x[batch_idx, b_idx, :]
+        dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(2).expand(B, r, C), src, reduce=mode)
+        return torch.cat([t for t in (x_cls, protected, dst) if t is not None], dim=1)
+
+    return merge
+
+
+def sort_tokens(x):
+    # the token order inside the protected and merged groups is not part of the result
+    return x.gather(1, x.sum(-1).argsort(dim=1)[..., None].expand(-1, -1, x.shape[-1]))
+
+
+@pytest.mark.parametrize("margin", [0.3, 0.9])
+@pytest.mark.parametrize("class_token", [False, True])
+def test_merge_plan_matches_reference(margin, class_token):
+    torch.manual_seed(0)
+    x = torch.randn(2, 197, 64)
+    merge, _ = pitome_vision(x, ratio=0.9, margin=margin, class_token=class_token)
+    expected = reference_pitome_vision(x, ratio=0.9, margin=margin, class_token=class_token)(x)
+    out = merge(x)
+    assert out.shape == expected.shape
+    if class_token:
+        torch.testing.assert_close(out[:, 0], expected[:, 0], rtol=0, atol=0)
+    torch.testing.assert_close(sort_tokens(out), sort_tokens(expected), rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("margin", [0.3, 0.9])
+def test_workspace_does_not_change_the_merge(margin):
+    torch.manual_seed(0)
+    workspace = Workspace()
+    for _ in range(3):
+        x = torch.randn(2, 197, 64)
+        expected = pitome_vision(x, ratio=0.9, margin=margin, class_token=True)[0](x)
+        out = pitome_vision(x, ratio=0.9, margin=margin, class_token=True, workspace=workspace)[0](x)
+        assert torch.equal(out, expected)
+
+
+def test_energy_score_workspace_and_chunks():
+    torch.manual_seed(0)
+    x = F.normalize(torch.randn(2, 300, 64), dim=-1)
+    expected = energy_score(x, 0.3)
+    torch.testing.assert_close(energy_score(x, 0.3, chunk_size=64), expected)
+    torch.testing.assert_close(energy_score(x, 0.3, chunk_size=64, workspace=Workspace()), expected)
+
+
+def test_unmerge_round_trip():
+    torch.manual_seed(0)
+    x = torch.randn(2, 197, 64)
+    merge, _ = pitome_vision(x, ratio=0.8, margin=0.3, class_token=True)
+    assert isinstance(merge, MergePlan)
+    y = merge(x)
+    # every input position gets the token it was merged into, merging that back is the identity
+    torch.testing.assert_close(merge(merge.unmerge(y, x.shape[1])), y)
+
+
+def test_unmerge_source_gives_group_means():
+    torch.manual_seed(0)
+    x0 = torch.randn(2, 197, 64)
+    x, size, source = x0, None, None
+    for _ in range(4):
+        merge, _ = pitome_vision(x, ratio=0.9, margin=0.5, class_token=True)
+        source = merge_source(merge, x, source)
+        x, size = merge_wavg(merge, x, size)
+
+    ids = source.long()[..., None].expand(-1, -1, x0.shape[-1])
+    group_sum = torch.zeros_like(x).scatter_add_(1, ids, x0)
+    expected = (group_sum / size).gather(1, ids)
+    torch.testing.assert_close(unmerge_source(x, source), expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("ratio", [0.9, 0.6])
+@pytest.mark.parametrize("class_token", [False, True])
+def test_varlen_matches_unpadded_pitome_text(ratio, class_token):
+    # one padded batch against pitome_text on every sequence without its padding
+    torch.manual_seed(0)
+    lengths = [40, 23, 31, 8]
+    x = torch.randn(len(lengths), max(lengths), 32)
+    attention_mask = (torch.arange(max(lengths))[None] < torch.tensor(lengths)[:, None]).long()
+    merge, weight, mask = pitome_text_varlen(x, attention_mask, ratio=ratio, margin=0.5, class_token=class_token)
+    out, _ = merge_wavg(merge, x, weight)
+
+    for i, n in enumerate(lengths):
+        expected_merge, expected_weight = pitome_text(x[i:i + 1, :n], ratio=ratio, margin=0.5, class_token=class_token)
+        expected, _ = merge_wavg(expected_merge, x[i:i + 1, :n], expected_weight)
+        kept = int(mask[i].sum())
+        assert kept == expected.shape[1]
+        assert mask[i, :kept].all()
+        if class_token:
+            torch.testing.assert_close(out[i, 0], expected[0, 0])
+        torch.testing.assert_close(sort_tokens(out[i:i + 1, :kept]), sort_tokens(expected))
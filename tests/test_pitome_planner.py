@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+patch = pytest.importorskip("algo.pitome.patch")
+
+from algo.pitome.utils import block_flop  # noqa: E402
+
+
+def block_tokens(model, x):
+    tokens = []
+    hooks = [block.register_forward_pre_hook(lambda m, args: tokens.append(args[0].shape[1])) for block in model.blocks]
+    with torch.no_grad():
+        model(x)
+    for hook in hooks:
+        hook.remove()
+    return tokens
+
+
+@pytest.mark.parametrize("window_size, global_pass", [(None, False), (12, False), (12, True)])
+@pytest.mark.parametrize("ratio", [0.9, 0.7])
+def test_plan_matches_forward(window_size, global_pass, ratio):
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", img_size=384).eval()
+    patch.deit(model)
+    model.ratio = ratio
+    model.window_size = window_size
+    model.global_pass = global_pass
+
+    tokens = block_tokens(model, torch.randn(2, 3, 384, 384))
+    assert [layer.num_tokens for layer in model.planner.plan()] == tokens
+
+
+def test_window_merge_count():
+    # 4 windows of 144 tokens at ratio 0.9 merge floor(144 - 129.6) = 14 tokens each
+    model = timm.create_model("deit_tiny_patch16_224", img_size=384).eval()
+    patch.deit(model)
+    model.ratio = 0.9
+    model.window_size = 12
+    plan = model.planner.plan()
+    assert plan[0].num_tokens == 577
+    assert plan[0].r == 56
+
+
+@pytest.mark.parametrize("use_k", [False, True])
+def test_flops_follow_input_resolution(use_k):
+    # 160x160 images give 1 + 10x10 tokens instead of the 197 of patch_embed
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", dynamic_img_size=True).eval()
+    patch.deit(model, use_k=use_k)
+    if use_k:
+        model.r = 8
+    else:
+        model.ratio = 0.9
+    x = torch.randn(2, 3, 160, 160)
+
+    tokens = block_tokens(model, x)
+    with torch.no_grad():
+        _, flops = model(x)
+    assert tokens[0] == 101
+    assert tokens[-1] < tokens[0]
+    assert flops == sum(block_flop(n, model.embed_dim) for n in tokens)
+    assert [layer.num_tokens for layer in model.planner.plan(num_tokens=101)] == tokens
@@ -0,0 +1,29 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+timm = pytest.importorskip("timm")
+patch = pytest.importorskip("algo.pitome.patch")
+
+from algo.pitome.utils import quantize_linear  # noqa: E402
+
+
+def test_quantize_keeps_the_patch():
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224").eval()
+    patch.deit(model)
+    model.ratio = 0.9
+    quantized = quantize_linear(copy.deepcopy(model))
+
+    assert not any(type(m) is torch.nn.Linear for m in quantized.modules())
+    assert type(quantized.blocks[0]) is type(model.blocks[0])
+
+    x = torch.randn(2, 3, 224, 224)
+    with torch.no_grad():
+        out, flops = quantized(x)
+        expected, expected_flops = model(x)
+    assert out.dtype == torch.float32
+    assert flops == expected_flops
+    # int8 weights, the logits only point the same way
+    assert torch.nn.functional.cosine_similarity(out, expected).min() > 0.9
@@ -0,0 +1,78 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+med = pytest.importorskip("lavis.models.med")
+pumer = pytest.importorskip("algo.pumer")
+
+IMAGE_TOKENS = 65  # class token + 8x8 patches
+
+
+def tiny_text_encoder(num_layers=6):
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=100, hidden_size=32, num_hidden_layers=num_layers, num_attention_heads=4,
+        intermediate_size=64, add_cross_attention=True,
+    )
+    config.encoder_width = 48
+    config.add_type_embeddings = False
+    return med.BertModel(config, add_pooling_layer=False).eval()
+
+
+def forward(model, batch_size=2, text_len=7):
+    torch.manual_seed(1)
+    input_ids = torch.randint(1, 100, (batch_size, text_len))
+    image_embeds = torch.randn(batch_size, IMAGE_TOKENS, 48)
+    with torch.no_grad():
+        out = model(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=torch.ones(image_embeds.shape[:2], dtype=torch.long),
+            return_dict=True,
+            mode="multimodal",
+        )
+    return out.last_hidden_state
+
+
+def run(model, **kwargs):
+    out = forward(model, **kwargs)
+    return out, list(model._pumer_info["image_tokens"])
+
+
+def reduced(n, keep_ratio, merge_ratio):
+    kept = 1 + max(1, int((n - 1) * keep_ratio))
+    r = min(int(kept * merge_ratio), (kept - 1) // 2)
+    return kept - r
+
+
+@pytest.mark.parametrize("keep_ratio,merge_ratio", [(0.9, 0.1), (0.7, 0.0), (0.5, 0.3)])
+def test_kept_tokens_per_cross_layer(keep_ratio, merge_ratio):
+    model = tiny_text_encoder()
+    pumer.patch.blip(model, keep_ratio=keep_ratio, merge_ratio=merge_ratio)
+    _, tokens = run(model)
+
+    # the default reduces after cross-attention layers 1 and 3 of 0..5
+    first = reduced(IMAGE_TOKENS, keep_ratio, merge_ratio)
+    second = reduced(first, keep_ratio, merge_ratio)
+    assert tokens == [IMAGE_TOKENS, first, first, second, second, second]
+
+
+def test_prune_layers():
+    model = tiny_text_encoder()
+    pumer.patch.blip(model, prune_layers=[0], keep_ratio=0.5, merge_ratio=0.0)
+    _, tokens = run(model)
+    assert tokens == [33] * 6
+
+
+def test_disabled_keeps_every_token():
+    model = tiny_text_encoder()
+    base = forward(copy.deepcopy(model))
+    pumer.patch.blip(model)
+    model._pumer_info.defaults["enabled"] = False
+    out, tokens = run(model)
+
+    assert tokens == []
+    assert torch.allclose(out, base, atol=1e-5)